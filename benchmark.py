@@ -0,0 +1,237 @@
+"""
+Benchmark suite for the search engine.
+Generates a synthetic corpus in the format indexer.read_file expects, builds the index from it and
+measures build time, peak memory, index size, startup time and query latency.
+The results can be saved as a baseline and later runs are compared against it.
+
+Usage: python benchmark.py [number of posts] [--save baseline.json] [--compare baseline.json]
+"""
+import json
+import os
+import pickle
+import random
+import resource
+import sys
+import tempfile
+import time
+import indexer
+import main
+
+# query mixes, every placeholder is replaced by a word of the given frequency class,
+# {frequent2} by a frequent word other than {frequent}.
+query_mixes = {'term': ['{frequent}', '{medium}', '{rare}'],
+               'AND': ['{frequent} AND {medium}', '{medium} AND {rare}'],
+               'OR': ['{frequent} OR {medium}', '{medium} OR {rare}'],
+               'NOT': ['{frequent} NOT {medium}', '{medium} NOT {rare}'],
+               'phrase': ['"{frequent} {frequent2}"', '"{medium} {frequent}"'],
+               'NEAR': ['{frequent} NEAR5 {medium}', '{medium} NEAR10 {rare}'],
+               'WITHIN': ['{frequent} WITHIN5 {medium}', '{medium} WITHIN10 {rare}']}
+
+# a run is reported as regression if it is slower or bigger than the baseline by this factor.
+tolerance = 1.2
+
+
+def make_vocabulary(size, rng):
+    """
+    Generates a vocabulary of made up lower case words.
+    :param size: number of words.
+    :param rng: random.Random instance.
+    :return: list of distinct words.
+    """
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    vocabulary = set()
+    while len(vocabulary) < size:
+        vocabulary.add(''.join(rng.choice(letters) for _ in range(rng.randint(2, 12))))
+    return sorted(vocabulary)
+
+
+def generate_corpus(file_name, posts, vocabulary_size=50000, seed=0):
+    """
+    Writes a synthetic corpus into a CSV file with the 9 columns separated by "," that indexer.read_file expects.
+    Word frequencies follow Zipf's law and post lengths a log-normal distribution, as in real forum posts.
+    :param file_name: name of the CSV file to write.
+    :param posts: number of posts, e.g. 10000 to 10000000.
+    :param vocabulary_size: number of distinct words.
+    :param seed: seed of the random generator, the same seed always gives the same corpus.
+    :return: list of the vocabulary, sorted by descending frequency.
+    """
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(vocabulary_size, rng)
+    rng.shuffle(vocabulary)
+    # Zipf: the word of rank r has a weight of 1/r
+    weights = [1 / rank for rank in range(1, vocabulary_size + 1)]
+    cumulative = []
+    total = 0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    file = open(file_name, mode='w', encoding='utf8')
+    for ID in range(1, posts + 1):
+        length = max(1, int(rng.lognormvariate(3.0, 0.8)))
+        words = rng.choices(vocabulary, cum_weights=cumulative, k=length)
+        member_id = rng.randint(1, max(1, posts // 20))
+        file.write('"{}","1","2019-01-01","thread","title","{}","member","0","{}"\n'.format(
+            ID, member_id, ' '.join(words)))
+    file.close()
+    return vocabulary
+
+
+def peak_rss():
+    """
+    :return: peak resident set size of this process in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in bytes on macOS and in kilobytes everywhere else
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def directory_size(path):
+    """
+    :param path: directory.
+    :return: size of all files below the directory in bytes.
+    """
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+def percentile(values, p):
+    """
+    Nearest rank percentile.
+    :param values: list of numbers.
+    :param p: percentile between 0 and 100.
+    :return: the percentile of the values.
+    >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 50)
+    5
+    >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 99)
+    10
+    """
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def latencies(timings):
+    """
+    :param timings: list of seconds.
+    :return: dictionary with p50, p95 and p99 in milliseconds.
+    """
+    return {'p50': percentile(timings, 50) * 1000,
+            'p95': percentile(timings, 95) * 1000,
+            'p99': percentile(timings, 99) * 1000}
+
+
+def make_queries(vocabulary, ii, per_mix, rng):
+    """
+    Fills the query mixes with words from the index.
+    :param vocabulary: list of words sorted by descending frequency.
+    :param ii: Inverted Index.
+    :param per_mix: number of queries per mix.
+    :param rng: random.Random instance.
+    :return: dictionary {mix: [query1, query2,...]}.
+    """
+    indexed = [word for word in vocabulary if word in ii]
+    classes = {'frequent': indexed[:20],
+               'medium': indexed[len(indexed) // 20:len(indexed) // 10] or indexed,
+               'rare': indexed[len(indexed) // 2:] or indexed}
+    queries = dict()
+    for mix, templates in query_mixes.items():
+        queries[mix] = []
+        for n in range(per_mix):
+            template = templates[n % len(templates)]
+            words = {name: rng.choice(words) for name, words in classes.items()}
+            if '{frequent2}' in template:
+                others = [word for word in classes['frequent'] if word != words['frequent']]
+                words['frequent2'] = rng.choice(others or classes['frequent'])
+            queries[mix].append(template.format(**words))
+    return queries
+
+
+def run(posts, per_mix=50, seed=0, directory=None):
+    """
+    Runs the whole benchmark in a temporary directory.
+    :param posts: number of posts of the synthetic corpus.
+    :param per_mix: number of queries per query mix.
+    :param seed: seed of the corpus and the queries.
+    :param directory: working directory, a temporary directory if None.
+    :return: dictionary with all measurements.
+    """
+    directory = directory or tempfile.mkdtemp(prefix='ncat_benchmark_')
+    old_directory = os.getcwd()
+    os.chdir(directory)
+    try:
+        os.makedirs('postings_1M', exist_ok=True)
+        vocabulary = generate_corpus('corpus.csv', posts, seed=seed)
+        results = {'posts': posts}
+
+        started = time.perf_counter()
+        indexer.inverted_index.clear()
+        indexer.counting_index.clear()
+        file_dict = indexer.read_file('corpus.csv')
+        indexer.generate_index_new(file_dict)
+        del file_dict
+        pickle_out = open('100k_index.pickle', 'wb')
+        pickle.dump(indexer.inverted_index, pickle_out)
+        pickle_out.close()
+        results['build seconds'] = time.perf_counter() - started
+        results['peak rss bytes'] = peak_rss()
+        results['index bytes'] = directory_size('postings_1M') + os.path.getsize('100k_index.pickle')
+
+        started = time.perf_counter()
+        ii = main.unpickle()
+        results['startup seconds'] = time.perf_counter() - started
+
+        queries = make_queries(vocabulary, ii, per_mix, random.Random(seed))
+        results['latency ms'] = dict()
+        for mix, mix_queries in queries.items():
+            timings = []
+            for query in mix_queries:
+                started = time.perf_counter()
+                main.run_main(query, ii)
+                timings.append(time.perf_counter() - started)
+            results['latency ms'][mix] = latencies(timings)
+        return results
+    finally:
+        os.chdir(old_directory)
+
+
+def compare(results, baseline):
+    """
+    Compares a benchmark run against a saved baseline.
+    :param results: dictionary returned by run.
+    :param baseline: dictionary returned by an earlier run.
+    :return: list of strings describing every measurement that got worse than the tolerance allows.
+    >>> compare({'build seconds': 3.0, 'latency ms': {'AND': {'p50': 1.0}}},
+    ...         {'build seconds': 2.0, 'latency ms': {'AND': {'p50': 1.1}}})
+    ['build seconds: 3.000 (baseline 2.000)']
+    """
+    regressions = []
+    for key in ['build seconds', 'peak rss bytes', 'index bytes', 'startup seconds']:
+        if key in results and key in baseline and results[key] > baseline[key] * tolerance:
+            regressions.append('{}: {:.3f} (baseline {:.3f})'.format(key, results[key], baseline[key]))
+    for mix, values in results.get('latency ms', dict()).items():
+        for p, value in values.items():
+            old_value = baseline.get('latency ms', dict()).get(mix, dict()).get(p)
+            if old_value is not None and value > old_value * tolerance:
+                regressions.append('{} {}: {:.3f} ms (baseline {:.3f} ms)'.format(mix, p, value, old_value))
+    return regressions
+
+
+if __name__ == '__main__':
+    number_of_posts = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 10000
+    benchmark = run(number_of_posts)
+    print(json.dumps(benchmark, indent=2))
+    if '--save' in sys.argv:
+        baseline_file = open(sys.argv[sys.argv.index('--save') + 1], mode='w')
+        json.dump(benchmark, baseline_file, indent=2)
+        baseline_file.close()
+    if '--compare' in sys.argv:
+        baseline_file = open(sys.argv[sys.argv.index('--compare') + 1])
+        found = compare(benchmark, json.load(baseline_file))
+        baseline_file.close()
+        for regression in found:
+            print("REGRESSION", regression)
+        if found:
+            sys.exit(1)
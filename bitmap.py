@@ -0,0 +1,257 @@
+"""
+Compressed bitmaps of DocIDs for very frequent terms, organized like roaring bitmaps:
+the DocIDs are split by their upper 16 bits into containers, and every container holds the lower 16 bits
+either as a sorted array (up to 4096 DocIDs) or as a bitset of 65536 bits (more than 4096 DocIDs).
+Intersection, union and complement work container by container, on bitsets with a single integer operation.
+"""
+import doctest
+import os
+import struct
+from array import array
+import postings
+
+# containers with more DocIDs than this are stored as bitsets.
+array_limit = 4096
+ARRAY = 0
+BITSET = 1
+# bitmaps that were already read, keyed by postings path and term, as several indexes can share a term.
+cache = dict()
+
+
+def bits_to_lows(bits):
+    """
+    :param bits: bitset as integer.
+    :return: sorted list of the numbers of the set bits.
+    """
+    lows = []
+    while bits:
+        lowest = bits & -bits
+        lows.append(lowest.bit_length() - 1)
+        bits ^= lowest
+    return lows
+
+
+def lows_to_bits(lows):
+    """
+    :param lows: iterable of numbers below 65536.
+    :return: bitset as integer.
+    """
+    bits = 0
+    for low in lows:
+        bits |= 1 << low
+    return bits
+
+
+def make_container(lows=None, bits=None):
+    """
+    Creates the smaller container for a set of lower 16 bits, given as sorted numbers or as bitset.
+    :return: tuple (kind, content), or None if the container would be empty.
+    """
+    if bits is not None:
+        size = bits.bit_count()
+        if size == 0:
+            return None
+        if size > array_limit:
+            return BITSET, bits
+        lows = bits_to_lows(bits)
+    if not lows:
+        return None
+    if len(lows) > array_limit:
+        return BITSET, lows_to_bits(lows)
+    return ARRAY, array('H', lows)
+
+
+def container_bits(container):
+    """
+    :param container: tuple (kind, content).
+    :return: the container as bitset.
+    """
+    if container[0] == BITSET:
+        return container[1]
+    return lows_to_bits(container[1])
+
+
+def container_size(container):
+    """
+    :param container: tuple (kind, content).
+    :return: number of DocIDs in the container.
+    """
+    if container[0] == BITSET:
+        return container[1].bit_count()
+    return len(container[1])
+
+
+class Bitmap:
+    """
+    Set of DocIDs.
+    >>> a = Bitmap.from_ids([1, 5, 70000, 70001])
+    >>> b = Bitmap.from_ids([5, 70001, 200000])
+    >>> list(a & b), list(a | b), list(a - b)
+    ([5, 70001], [1, 5, 70000, 70001, 200000], [1, 70000])
+    >>> 70000 in a, 70000 in b, len(a | b)
+    (True, False, 5)
+    >>> c = Bitmap.from_ids(range(0, 20000, 2))
+    >>> len(c & a), len(Bitmap.from_bytes(c.to_bytes()))
+    (0, 10000)
+    """
+    def __init__(self, containers=None):
+        # {upper 16 bits: (kind, content)}
+        self.containers = containers if containers is not None else dict()
+
+    @classmethod
+    def from_ids(cls, ids):
+        """
+        :param ids: sorted iterable of integer DocIDs.
+        :return: Bitmap.
+        """
+        groups = dict()
+        for ID in ids:
+            groups.setdefault(ID >> 16, []).append(ID & 0xFFFF)
+        return cls({high: make_container(lows) for high, lows in groups.items()})
+
+    def __len__(self):
+        return sum(container_size(container) for container in self.containers.values())
+
+    def __contains__(self, ID):
+        container = self.containers.get(ID >> 16)
+        if container is None:
+            return False
+        low = ID & 0xFFFF
+        if container[0] == BITSET:
+            return (container[1] >> low) & 1 == 1
+        lows = container[1]
+        # binary search in the sorted array
+        start = 0
+        end = len(lows)
+        while start < end:
+            middle = (start + end) // 2
+            if lows[middle] < low:
+                start = middle + 1
+            else:
+                end = middle
+        return start < len(lows) and lows[start] == low
+
+    def __iter__(self):
+        for high in sorted(self.containers):
+            kind, content = self.containers[high]
+            lows = bits_to_lows(content) if kind == BITSET else content
+            for low in lows:
+                yield (high << 16) | low
+
+    def combine(self, other, operation, keep_left, keep_right):
+        """
+        Combines two Bitmaps container by container.
+        :param other: Bitmap.
+        :param operation: function of two bitsets.
+        :param keep_left: True if containers only found in this Bitmap are kept.
+        :param keep_right: True if containers only found in the other Bitmap are kept.
+        :return: Bitmap.
+        """
+        containers = dict()
+        for high in set(self.containers) | set(other.containers):
+            left = self.containers.get(high)
+            right = other.containers.get(high)
+            if left is not None and right is not None:
+                container = make_container(bits=operation(container_bits(left), container_bits(right)))
+            elif left is not None:
+                container = left if keep_left else None
+            else:
+                container = right if keep_right else None
+            if container is not None:
+                containers[high] = container
+        return Bitmap(containers)
+
+    def __and__(self, other):
+        return self.combine(other, lambda a, b: a & b, False, False)
+
+    def __or__(self, other):
+        return self.combine(other, lambda a, b: a | b, True, True)
+
+    def __sub__(self, other):
+        return self.combine(other, lambda a, b: a & ~b, True, False)
+
+    def to_bytes(self):
+        """
+        :return: the Bitmap serialized as bytes.
+        """
+        parts = [struct.pack('<I', len(self.containers))]
+        for high in sorted(self.containers):
+            kind, content = self.containers[high]
+            data = content.to_bytes(8192, 'little') if kind == BITSET else content.tobytes()
+            parts.append(struct.pack('<HBI', high, kind, len(data)))
+            parts.append(data)
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        :param data: bytes written by to_bytes.
+        :return: Bitmap.
+        """
+        containers = dict()
+        count, = struct.unpack_from('<I', data)
+        offset = 4
+        for n in range(count):
+            high, kind, size = struct.unpack_from('<HBI', data, offset)
+            offset += struct.calcsize('<HBI')
+            content = data[offset:offset + size]
+            offset += size
+            if kind == BITSET:
+                containers[high] = (BITSET, int.from_bytes(content, 'little'))
+            else:
+                containers[high] = (ARRAY, array('H', content))
+        return cls(containers)
+
+
+def write_bitmaps(ii, documents, counting_index=None, density=1 / 16):
+    """
+    Writes a bitmap next to the postings list of every term that occurs in at least
+    density * documents documents. This is where bitmap containers become smaller than arrays.
+    :param ii: Inverted Index mapping terms to postings paths.
+    :param documents: number of indexed documents.
+    :param counting_index: optional counting index; as collection frequencies are never smaller than
+    document frequencies, terms below the threshold are skipped without reading their postings.
+    :param density: minimal share of documents a term has to occur in.
+    :return: list of the terms a bitmap was written for.
+    """
+    threshold = documents * density
+    written = []
+    for term in ii:
+        if counting_index is not None and counting_index.get(term, 0) < threshold:
+            continue
+        postings_list = postings.retrieve_doc_ids(term, ii[term])
+        if len(postings_list) < threshold:
+            continue
+        file = open(os.path.join(ii[term], term + '$.bmp'), mode='wb')
+        file.write(Bitmap.from_ids(int(posting[0]) for posting in postings_list).to_bytes())
+        file.close()
+        cache.pop((ii[term], term), None)
+        written.append(term)
+    return written
+
+
+def exists(term, path):
+    """
+    :param term: the term.
+    :param path: postings path of the term.
+    :return: True if a bitmap was written for the term.
+    """
+    return (path, term) in cache or os.path.exists(os.path.join(path, term + '$.bmp'))
+
+
+def retrieve(term, path):
+    """
+    Reads the bitmap of a term. Bitmaps are small, so they are kept in the cache once read.
+    :param term: the term.
+    :param path: postings path of the term.
+    :return: Bitmap.
+    """
+    if (path, term) not in cache:
+        file = open(os.path.join(path, term + '$.bmp'), mode='rb')
+        cache[path, term] = Bitmap.from_bytes(file.read())
+        file.close()
+    return cache[path, term]
+
+
+if __name__ == '__main__':
+    doctest.testmod()
@@ -0,0 +1,85 @@
+"""
+Auxiliary index of word pairs. Phrases made of very frequent words, like "of the year", are slow,
+because the long postings lists of every word have to be intersected and their positions compared.
+The biword index holds a postings list for every pair of adjacent words in which at least one word
+is frequent, with the positions of the first word. searcher.exact_phrase then starts from the
+rarest pairs and only checks their candidates against the rest of the phrase.
+The biword index is a packed index file whose terms are the pairs, see pair.
+"""
+import indexer
+import packed_index
+
+
+def pair(first, second):
+    """
+    :param first: a term.
+    :param second: the term following it.
+    :return: the term of the pair in the biword index.
+    >>> pair('of', 'the')
+    'of the'
+    """
+    return first + ' ' + second
+
+
+def frequent_terms(counting_index, limit=100):
+    """
+    :param counting_index: dictionary {term: collection frequency} or Vocabulary.
+    :param limit: number of terms.
+    :return: set of the most frequent terms.
+    >>> sorted(frequent_terms({'a': 3, 'b': 7, 'c': 5}, 2))
+    ['b', 'c']
+    """
+    if hasattr(counting_index, 'top'):
+        return {term for term, frequency in counting_index.top(limit)}
+    return set(sorted(counting_index, key=lambda term: -counting_index[term])[:limit])
+
+
+def pairs(words, frequent, casefold=True, nonumbers=True):
+    """
+    Finds the pairs of adjacent indexed words of a post in which at least one word is frequent.
+    :param words: Wordlist of PostContent.
+    :param frequent: set of frequent terms.
+    :return: list of tuples (pair, position of the first word).
+    >>> pairs(['Of', 'the', 'year', '2019', 'of', 'x'], {'of', 'the'})
+    [('of the', 1), ('the year', 2), ('of x', 5)]
+    """
+    found = []
+    previous = None
+    for position, word in enumerate(words, 1):
+        term = indexer.index_term(word, casefold, nonumbers)
+        if previous is not None and term is not None and (previous in frequent or term in frequent):
+            found.append((pair(previous, term), position - 1))
+        previous = term
+    return found
+
+
+def build(file_dict, frequent, file_name, skip=()):
+    """
+    Writes the biword index of a corpus.
+    :param file_dict: dictionary {ID: (MemberID, Wordlist of PostContent)} as returned by indexer.read_file.
+    :param frequent: set of frequent terms, see frequent_terms.
+    :param file_name: name of the biword index file to write.
+    :param skip: IDs of posts which are not indexed, as in indexer.generate_index_new.
+    :return: number of pairs in the index.
+    """
+    index = dict()
+    for ID in sorted(file_dict, key=int):
+        if ID in skip:
+            continue
+        for term, position in pairs(file_dict[ID][1], frequent):
+            postings_list = index.setdefault(term, [])
+            if postings_list and postings_list[-1][0] == ID:
+                postings_list[-1][1].append(position)
+            else:
+                postings_list.append((ID, [position]))
+    terms = sorted(index, key=lambda term: term.encode('utf8'))
+    packed_index.write(((term.encode('utf8'), index[term]) for term in terms), file_name)
+    return len(terms)
+
+
+def load(file_name):
+    """
+    :param file_name: name of a biword index file.
+    :return: PackedIndex of the pairs.
+    """
+    return packed_index.PackedIndex(file_name)
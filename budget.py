@@ -0,0 +1,120 @@
+"""
+Per-query resource budgets. A Budget limits the wall time of a query, the number of postings bytes it
+reads and the size of its intermediate results. The limits are checked cooperatively: the operator
+loops of the searcher call check() every now and then, and the query plan calls it between steps.
+A query over its budget either aborts with BudgetExceeded, or, if the budget allows partial results,
+every running operator stops and returns what it found so far and the result is flagged as truncated.
+"""
+import time
+import statistics_container as stat
+
+# the operator loops check the budget once every this many iterations, so a limit can be overshot by a little.
+check_every = 1024
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised when a query goes over one of the limits of its budget.
+    """
+    def __init__(self, limit, allowed):
+        Exception.__init__(self, "query exceeded its budget of {} {}".format(allowed, limit))
+        self.limit = limit
+        self.allowed = allowed
+
+
+class Budget:
+    """
+    Limits of a single query. Every limit is optional.
+    """
+    def __init__(self, seconds=None, max_bytes=None, max_results=None, partial=False):
+        """
+        :param seconds: wall time of the query.
+        :param max_bytes: postings bytes read by the query, as counted by the profile.
+        :param max_results: size of any intermediate result.
+        :param partial: if set, a query over its budget returns partial results instead of raising BudgetExceeded.
+        """
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.max_results = max_results
+        self.partial = partial
+        self.started = None
+        # name of the limit the query went over, None while it is within its budget
+        self.truncated = None
+
+    def start(self):
+        """
+        Starts the clock, a Budget can be used for one query after another.
+        :return: None.
+        """
+        self.started = time.perf_counter()
+        self.truncated = None
+
+    def exceeded(self, size=0):
+        """
+        :param size: size of the result the caller is building.
+        :return: tuple (name of the limit, allowed value) of the first limit that is exceeded, None if there is none.
+        """
+        if self.seconds is not None and time.perf_counter() - self.started > self.seconds:
+            return 'seconds', self.seconds
+        if self.max_bytes is not None and stat.current is not None and \
+                stat.current['counters'].get('bytes read', 0) > self.max_bytes:
+            return 'bytes', self.max_bytes
+        if self.max_results is not None and size > self.max_results:
+            return 'results', self.max_results
+        return None
+
+
+# budget of the running query, None if the query has no limits.
+current = None
+# name of the limit the last query went over if its results are partial, otherwise None.
+last = None
+
+
+def begin(query_budget):
+    """
+    Makes a budget the one of the running query.
+    :param query_budget: Budget or None.
+    :return: None.
+    """
+    global current
+    current = query_budget
+    if current is not None:
+        current.start()
+
+
+def finish():
+    """
+    Ends the budget of the running query.
+    :return: the name of the limit the query went over if its result was truncated, otherwise None.
+    """
+    global current, last
+    last = current.truncated if current is not None else None
+    current = None
+    return last
+
+
+def check(size=0):
+    """
+    Checks the budget of the running query, to be called from inside the operator loops.
+    :param size: size of the result the caller is building.
+    :return: True if the caller has to stop and return what it has found so far.
+    """
+    if current is None:
+        return False
+    if current.truncated is not None:
+        return True
+    limit = current.exceeded(size)
+    if limit is None:
+        return False
+    if not current.partial:
+        raise BudgetExceeded(*limit)
+    current.truncated = limit[0]
+    stat.count('truncated')
+    return True
+
+
+def truncated():
+    """
+    :return: True if the running query went over its budget and its results are partial.
+    """
+    return current is not None and current.truncated is not None
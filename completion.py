@@ -0,0 +1,175 @@
+"""
+Search-as-you-type completion of terms. The completion file holds
+- the term table: the sorted terms as UTF-8 in one blob plus an offset array, and the weight of every term,
+- the prefix table: every distinct prefix of up to max_prefix characters, sorted, with the term IDs of its
+  k heaviest completions, computed when the file is written.
+A keystroke is answered by a binary search in the prefix table and k lookups in the term table.
+Prefixes longer than max_prefix only match a few terms, which are found by a binary search in the
+term table and ranked on the spot. Like the packed index, the file is used through a single mmap.
+"""
+import heapq
+import mmap
+import os
+import struct
+from array import array
+
+magic = b'NCATCP01'
+# magic, number of terms, size of the term blob, number of prefixes, size of the prefix blob, k, max_prefix
+header_format = '<8sQQQQQQ'
+header_size = struct.calcsize(header_format)
+# marks an empty completion slot
+empty = 0xFFFFFFFF
+
+
+def _padding(size):
+    """
+    :param size: size of a buffer in bytes.
+    :return: number of zero bytes needed to align the next buffer to 8 bytes.
+    """
+    return -size % 8
+
+
+def top_completions(terms, weights, k, max_prefix):
+    """
+    Finds the k heaviest terms of every prefix. The terms are sorted, so all terms with the same prefix
+    follow each other, and every prefix length needs a single pass over the terms.
+    :param terms: sorted list of terms.
+    :param weights: weight of every term.
+    :param k: number of completions per prefix.
+    :param max_prefix: longest prefix in characters.
+    :return: dictionary {prefix: list of term IDs, the heaviest first}.
+    >>> top_completions(['ab', 'abc', 'b'], [5, 9, 1], 1, 2)
+    {'a': [1], 'b': [2], 'ab': [1]}
+    """
+    completions = dict()
+    for length in range(1, max_prefix + 1):
+        start = 0
+        while start < len(terms):
+            if len(terms[start]) < length:
+                start += 1
+                continue
+            prefix = terms[start][:length]
+            end = start
+            while end < len(terms) and terms[end].startswith(prefix):
+                end += 1
+            completions[prefix] = heapq.nlargest(k, range(start, end), key=lambda n: (weights[n], -n))
+            start = end
+    return completions
+
+
+def build(terms, counting_index, file_name, k=10, max_prefix=6):
+    """
+    Writes the completion file of a vocabulary.
+    :param terms: iterable of terms, e.g. the keys of the Inverted Index.
+    :param counting_index: dictionary {term: collection frequency} or Vocabulary, gives the weights.
+    :param file_name: name of the completion file to write.
+    :param k: number of completions stored per prefix.
+    :param max_prefix: longest prefix in characters for which completions are stored.
+    :return: None.
+    """
+    terms = sorted(terms, key=lambda term: term.encode('utf8'))
+    weights = array('Q', [counting_index.get(term, 0) for term in terms])
+    term_offsets = array('Q', [0])
+    term_blob = bytearray()
+    for term in terms:
+        term_blob += term.encode('utf8')
+        term_offsets.append(len(term_blob))
+    completions = top_completions(terms, weights, k, max_prefix)
+    prefixes = sorted(completions, key=lambda prefix: prefix.encode('utf8'))
+    prefix_offsets = array('Q', [0])
+    prefix_blob = bytearray()
+    slots = array('I')
+    for prefix in prefixes:
+        prefix_blob += prefix.encode('utf8')
+        prefix_offsets.append(len(prefix_blob))
+        slots.extend(completions[prefix] + [empty] * (k - len(completions[prefix])))
+    file = open(file_name, mode='wb')
+    file.write(struct.pack(header_format, magic, len(terms), len(term_blob), len(prefixes), len(prefix_blob),
+                           k, max_prefix))
+    for buffer in [term_offsets, weights, prefix_offsets, slots, term_blob, prefix_blob]:
+        data = bytes(buffer)
+        file.write(data)
+        file.write(b'\0' * _padding(len(data)))
+    file.close()
+
+
+class Completion:
+    """
+    Completions served from a file written by build().
+    """
+    def __init__(self, file_name, use_mmap=True):
+        file = open(file_name, mode='rb')
+        if use_mmap:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.buffer = bytearray(os.fstat(file.fileno()).st_size)
+            file.readinto(self.buffer)
+        file.close()
+        view = memoryview(self.buffer)
+        file_magic, n_terms, term_blob_size, n_prefixes, prefix_blob_size, self.k, self.max_prefix = \
+            struct.unpack_from(header_format, view)
+        if file_magic != magic:
+            raise ValueError("{} is not a completion file".format(file_name))
+        offset = header_size
+        buffers = []
+        for code, length in [('Q', n_terms + 1), ('Q', n_terms), ('Q', n_prefixes + 1), ('I', n_prefixes * self.k),
+                             ('B', term_blob_size), ('B', prefix_blob_size)]:
+            size = length * struct.calcsize(code)
+            buffers.append(view[offset:offset + size].cast(code))
+            offset += size + _padding(size)
+        self.term_offsets, self.weights, self.prefix_offsets, self.slots, self.term_blob, self.prefix_blob = buffers
+        self.terms = n_terms
+        self.prefixes = n_prefixes
+
+    def term(self, n):
+        """
+        :param n: term ID.
+        :return: the term.
+        """
+        return bytes(self.term_blob[self.term_offsets[n]:self.term_offsets[n + 1]]).decode('utf8')
+
+    def lower_bound(self, blob, offsets, size, encoded):
+        """
+        Binary search in a sorted table of strings.
+        :return: number of the first entry which is not smaller than encoded.
+        """
+        low = 0
+        high = size
+        while low < high:
+            middle = (low + high) // 2
+            if bytes(blob[offsets[middle]:offsets[middle + 1]]) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def complete(self, prefix, k=None):
+        """
+        :param prefix: what was typed so far.
+        :param k: number of completions, at most the k the file was written with for short prefixes.
+        :return: list of tuples (term, weight), the heaviest first.
+        """
+        k = k or self.k
+        encoded = prefix.encode('utf8')
+        if 0 < len(prefix) <= self.max_prefix:
+            n = self.lower_bound(self.prefix_blob, self.prefix_offsets, self.prefixes, encoded)
+            if n == self.prefixes or bytes(self.prefix_blob[self.prefix_offsets[n]:self.prefix_offsets[n + 1]]) \
+                    != encoded:
+                return []
+            ids = [ID for ID in self.slots[n * self.k:(n + 1) * self.k] if ID != empty][:k]
+        else:
+            # no UTF-8 encoded term contains the byte 0xff, so every term with the prefix sorts before this
+            start = self.lower_bound(self.term_blob, self.term_offsets, self.terms, encoded)
+            end = self.lower_bound(self.term_blob, self.term_offsets, self.terms, encoded + b'\xff')
+            ids = heapq.nlargest(k, range(start, end), key=lambda n: (self.weights[n], -n))
+        return [(self.term(n), self.weights[n]) for n in ids]
+
+
+if __name__ == '__main__':
+    # python completion.py 1Mci.pickle 1M.complete
+    import pickle
+    import sys
+    pickle_in = open(sys.argv[1], 'rb')
+    counting = pickle.load(pickle_in)
+    pickle_in.close()
+    build(counting, counting, sys.argv[2])
@@ -0,0 +1,61 @@
+"""
+Cursors for paging through the results of a query. A cursor holds the last DocID of a page, the
+index generation the page was taken from and a fingerprint of the query, packed into an opaque string.
+The next page is evaluated as a stream whose postings lists are all entered right after that DocID,
+see postings.fetch_from, so every page costs about as much as the first one.
+"""
+import base64
+import hashlib
+import struct
+
+# last DocID, index generation (-1 if the index has none), query fingerprint
+cursor_format = '<Qq8s'
+
+
+class CursorError(ValueError):
+    """
+    Raised for a cursor which does not belong to the query or the index generation it is used with.
+    """
+
+
+def fingerprint(query):
+    """
+    :param query: The search string.
+    :return: 8 bytes identifying the query, whitespace around it does not matter.
+    >>> fingerprint(' the AND of') == fingerprint('the AND of')
+    True
+    """
+    return hashlib.sha1(query.strip().encode('utf8')).digest()[:8]
+
+
+def encode(last_id, generation, query):
+    """
+    :param last_id: the last DocID of the page.
+    :param generation: number of the index generation, None if the index has none.
+    :param query: The search string.
+    :return: the cursor.
+    >>> decode(encode(42, 7, 'the'), 7, 'the')
+    42
+    """
+    data = struct.pack(cursor_format, int(last_id), -1 if generation is None else generation, fingerprint(query))
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode(cursor, generation, query):
+    """
+    :param cursor: a cursor made by encode.
+    :param generation: number of the index generation the next page is taken from.
+    :param query: The search string.
+    :return: the last DocID of the previous page. Raises CursorError if the cursor is broken,
+    or was made for another query or index generation.
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        last_id, cursor_generation, query_fingerprint = struct.unpack(cursor_format, data)
+    except (ValueError, struct.error):
+        raise CursorError("not a cursor: {}".format(cursor))
+    if query_fingerprint != fingerprint(query):
+        raise CursorError("the cursor belongs to another query")
+    if cursor_generation != (-1 if generation is None else generation):
+        raise CursorError("the cursor belongs to index generation {}".format(cursor_generation))
+    return last_id
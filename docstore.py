@@ -0,0 +1,189 @@
+"""
+Compressed document store. The member ID and the words of every post are kept in blocks of a fixed
+number of posts; every block is compressed on its own, and a block offset table gives the place of
+every block in the file. Fetching a post decompresses exactly one block, and the decompressed blocks
+of the hottest posts stay in a small LRU cache.
+The words are stored exactly as the indexer numbered them, so the positions in the postings lists
+point straight into the stored word lists.
+Stores written with cluster IDs (see duplicates.find) also hold the near-duplicate cluster of every post.
+"""
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+magic = b'NCATDS01'
+# magic of stores which hold the cluster IDs after the DocIDs
+clustered_magic = b'NCATDS02'
+# magic, number of posts, posts per block, number of blocks
+header_format = '<8sQQQ'
+header_size = struct.calcsize(header_format)
+
+
+def encode_block(posts):
+    """
+    :param posts: list of tuples (MemberID, Wordlist of PostContent).
+    :return: the compressed block. Words never contain whitespace, so tabs and newlines separate them.
+    >>> decode_block(encode_block([('7', ['How', 'do', 'you']), ('8', [])]))
+    [('7', ['How', 'do', 'you']), ('8', [])]
+    """
+    text = '\n'.join(member_id + '\t' + ' '.join(words) for member_id, words in posts)
+    return zlib.compress(text.encode('utf8'), 6)
+
+
+def decode_block(data):
+    """
+    :param data: a block written by encode_block.
+    :return: list of tuples (MemberID, Wordlist of PostContent).
+    """
+    posts = []
+    for line in zlib.decompress(data).decode('utf8').split('\n'):
+        member_id, text = line.split('\t', 1)
+        posts.append((member_id, text.split(' ') if text else []))
+    return posts
+
+
+def build(file_dict, file_name, block_size=32, clusters=None):
+    """
+    Writes the document store of a corpus.
+    :param file_dict: dictionary {ID: (MemberID, Wordlist of PostContent)} as returned by indexer.read_file.
+    :param file_name: name of the document store file to write.
+    :param block_size: number of posts per block.
+    :param clusters: optional dictionary {integer DocID: cluster ID}, posts which are not in it are
+    clusters of their own.
+    :return: None.
+    """
+    ids = sorted(file_dict, key=int)
+    block_offsets = array('Q', [0])
+    blocks = []
+    for start in range(0, len(ids), block_size):
+        block = encode_block([file_dict[ID] for ID in ids[start:start + block_size]])
+        blocks.append(block)
+        block_offsets.append(block_offsets[-1] + len(block))
+    file = open(file_name, mode='wb')
+    file.write(struct.pack(header_format, magic if clusters is None else clustered_magic,
+                           len(ids), block_size, len(blocks)))
+    file.write(bytes(array('Q', [int(ID) for ID in ids])))
+    if clusters is not None:
+        file.write(bytes(array('Q', [clusters.get(int(ID), int(ID)) for ID in ids])))
+    file.write(bytes(block_offsets))
+    for block in blocks:
+        file.write(block)
+    file.close()
+
+
+class DocumentStore:
+    """
+    Posts served from a file written by build().
+    """
+    def __init__(self, file_name, cache_blocks=64, use_mmap=True):
+        """
+        :param file_name: name of the document store file.
+        :param cache_blocks: number of decompressed blocks kept in the LRU cache.
+        :param use_mmap: if not set, the file is read into memory instead.
+        """
+        file = open(file_name, mode='rb')
+        if use_mmap:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.buffer = bytearray(os.fstat(file.fileno()).st_size)
+            file.readinto(self.buffer)
+        file.close()
+        view = memoryview(self.buffer)
+        file_magic, self.size, self.block_size, n_blocks = struct.unpack_from(header_format, view)
+        if file_magic not in (magic, clustered_magic):
+            raise ValueError("{} is not a document store".format(file_name))
+        offset = header_size
+        self.doc_ids = view[offset:offset + 8 * self.size].cast('Q')
+        offset += 8 * self.size
+        self.clusters = None
+        if file_magic == clustered_magic:
+            self.clusters = view[offset:offset + 8 * self.size].cast('Q')
+            offset += 8 * self.size
+        self.block_offsets = view[offset:offset + 8 * (n_blocks + 1)].cast('Q')
+        self.blocks = view[offset + 8 * (n_blocks + 1):]
+        self.cache_blocks = cache_blocks
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return self.size
+
+    def locate(self, ID):
+        """
+        :param ID: DocID.
+        :return: number of the post in the store, -1 if the DocID is not stored.
+        """
+        ID = int(ID)
+        n = bisect_left(self.doc_ids, ID)
+        if n < self.size and self.doc_ids[n] == ID:
+            return n
+        return -1
+
+    def __contains__(self, ID):
+        return self.locate(ID) != -1
+
+    def cluster(self, ID):
+        """
+        :param ID: DocID.
+        :return: the ID of the near-duplicate cluster of the post, its own DocID if it has no duplicates
+        or the store holds no clusters.
+        """
+        n = self.locate(ID) if self.clusters is not None else -1
+        return int(ID) if n == -1 else self.clusters[n]
+
+    def block(self, number):
+        """
+        :param number: number of a block.
+        :return: the decompressed block, from the LRU cache if possible.
+        """
+        if number in self.cache:
+            self.cache.move_to_end(number)
+            return self.cache[number]
+        posts = decode_block(self.blocks[self.block_offsets[number]:self.block_offsets[number + 1]])
+        self.cache[number] = posts
+        if len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return posts
+
+    def get(self, ID):
+        """
+        :param ID: DocID.
+        :return: tuple (MemberID, Wordlist of PostContent).
+        """
+        n = self.locate(ID)
+        if n == -1:
+            raise KeyError(ID)
+        return self.block(n // self.block_size)[n % self.block_size]
+
+    def __getitem__(self, ID):
+        return self.get(ID)
+
+    def get_many(self, ids):
+        """
+        Fetches a page of posts, decompressing every block only once.
+        :param ids: iterable of DocIDs, e.g. of a page of results.
+        :return: list of tuples (MemberID, Wordlist of PostContent), None for DocIDs that are not stored.
+        """
+        blocks = dict()
+        posts = []
+        for ID in ids:
+            n = self.locate(ID)
+            if n == -1:
+                posts.append(None)
+                continue
+            number = n // self.block_size
+            if number not in blocks:
+                blocks[number] = self.block(number)
+            posts.append(blocks[number][n % self.block_size])
+        return posts
+
+
+if __name__ == '__main__':
+    # python docstore.py 1M.docs ID
+    import sys
+    store = DocumentStore(sys.argv[1])
+    member, words = store.get(sys.argv[2])
+    print(member, ' '.join(words))
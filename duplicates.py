@@ -0,0 +1,142 @@
+"""
+Near-duplicate detection of posts with MinHash and LSH. Every post is turned into the set of its
+word shingles, and its MinHash signature estimates how much of that set it shares with any other post.
+The signatures are cut into bands; posts that agree on all rows of at least one band land in the same
+bucket and are compared, so finding the duplicates takes a single pass over the posts instead of
+comparing every pair. Every post belongs to a cluster, whose ID is the lowest DocID in it. The cluster
+IDs are kept in the document store, and query results can be collapsed to one post per cluster.
+"""
+import random
+import zlib
+import indexer
+
+# number of words of a shingle.
+shingle_size = 3
+# the signature has bands * rows values.
+bands = 8
+rows = 4
+# share of equal signature values above which two posts are near-duplicates.
+threshold = 0.7
+
+_random = random.Random(0)
+# every signature value is the minimum of the shingle hashes xor'ed with one of these.
+masks = [_random.getrandbits(32) for n in range(bands * rows)]
+
+
+def shingles(words, size=None):
+    """
+    :param words: Wordlist of PostContent.
+    :param size: number of words of a shingle, defaults to shingle_size.
+    :return: set of the hashes of all shingles, short posts give a single shingle.
+    >>> len(shingles('a b c d'.split())), shingles(['A', 'b']) == shingles(['a', 'b'])
+    (2, True)
+    """
+    size = size or shingle_size
+    terms = [word.casefold() for word in words]
+    return {zlib.crc32(' '.join(terms[n:n + size]).encode('utf8'))
+            for n in range(max(1, len(terms) - size + 1))}
+
+
+def signature(hashes):
+    """
+    :param hashes: set of shingle hashes of a post.
+    :return: tuple of the MinHash values of the post.
+    """
+    if not hashes:
+        return tuple(masks)
+    return tuple(min(map(mask.__xor__, hashes)) for mask in masks)
+
+
+def similarity(first, second):
+    """
+    :param first: signature of a post.
+    :param second: signature of another post.
+    :return: estimated Jaccard similarity of the shingles of both posts.
+    >>> similarity((1, 2, 3, 4), (1, 2, 5, 4))
+    0.75
+    """
+    return sum(1 for a, b in zip(first, second) if a == b) / len(first)
+
+
+def exact_key(words):
+    """
+    :param words: Wordlist of PostContent.
+    :return: a key which is equal for posts with the same indexed terms.
+    """
+    terms = [indexer.index_term(word) for word in words]
+    return ' '.join(term for term in terms if term is not None)
+
+
+def find(file_dict):
+    """
+    Clusters the near-duplicates of a corpus.
+    :param file_dict: dictionary {ID: (MemberID, Wordlist of PostContent)} as returned by indexer.read_file.
+    :return: tuple (dictionary {integer DocID: cluster ID} of every post which has duplicates, the cluster
+    ID included, set of the DocIDs whose indexed terms are exactly those of a post with a lower DocID).
+    Posts without any indexed term have nothing to compare and are never clustered.
+    >>> posts = {'1': ('7', 'how do you charge per click'.split()), '2': ('8', 'something else entirely'.split()),
+    ...          '3': ('9', 'How do you charge per click'.split()), '4': ('7', []), '5': ('8', [])}
+    >>> find(posts)
+    ({1: 1, 3: 1}, {'3'})
+    """
+    clusters = dict()
+    exact = set()
+    seen = dict()
+    buckets = dict()
+    signatures = dict()
+    for ID in sorted(file_dict, key=int):
+        number = int(ID)
+        words = file_dict[ID][1]
+        key = exact_key(words)
+        if not key:
+            continue
+        if key in seen:
+            clusters[number] = clusters.setdefault(seen[key], seen[key])
+            exact.add(ID)
+            continue
+        seen[key] = number
+        values = signature(shingles(words))
+        signatures[number] = values
+        cluster = None
+        for band in range(bands):
+            bucket = buckets.setdefault((band, values[band * rows:(band + 1) * rows]), [])
+            if cluster is None:
+                for other in bucket:
+                    # the post joins the cluster of the first earlier post it is similar enough to
+                    if similarity(values, signatures[other]) >= threshold:
+                        cluster = clusters.get(other, other)
+                        break
+            bucket.append(number)
+        if cluster is not None:
+            clusters.setdefault(cluster, cluster)
+            clusters[number] = cluster
+    return clusters, exact
+
+
+def collapse(results, store):
+    """
+    Keeps only the first result of every cluster of near-duplicates.
+    :param results: List of DocID tuples with list of positions (ID, [pos1, pos2,...]).
+    :param store: docstore.DocumentStore written with cluster IDs.
+    :return: the results without the duplicates of earlier results.
+    """
+    return list(collapse_stream(results, store))
+
+
+def collapse_stream(results, store, shown_before=None):
+    """
+    Collapses the near-duplicates of a stream of results as it is read, see collapse.
+    :param results: iterator over (ID, [pos1, pos2,...]).
+    :param store: docstore.DocumentStore written with cluster IDs.
+    :param shown_before: optional function of a cluster ID, True if a result of the cluster came before
+    the stream, e.g. on an earlier page. It is called at most once per cluster.
+    :return: generator of the results without the duplicates of earlier results.
+    """
+    shown = set()
+    for posting in results:
+        cluster = store.cluster(posting[0])
+        if cluster in shown:
+            continue
+        shown.add(cluster)
+        if shown_before is None or cluster == int(posting[0]) or not shown_before(cluster):
+            yield posting
@@ -9,10 +9,25 @@ Illegal queries include:
 - Operators within an exact phrase (this might be updated in later versions). (u"\u2713")
 - WITHIN and NEAR operators without a distance number or with a distance number of more than 3 digits. (u"\u2713")
 - Empty query. (u"\u2713")
+- Operators at the beginning or end of the query. (u"\u2713")
+- Parentheses with nothing in between. (u"\u2713")
+All tests are done by lexer.scan in a single pass over the query, which reports the position of every error.
+The functions below run that pass and check for a single kind of error.
 """
 
-import re
 import doctest
+import lexer
+import statistics_container as stat
+
+
+def passes(input_string, check):
+    """
+    Scans the input string and tells whether it passes a single check.
+    :param input_string: raw input string.
+    :param check: name of the check, i.e. of one of the functions below.
+    :return: Boolean.
+    """
+    return all(name != check for name, offset in lexer.scan(input_string)[1])
 
 
 def query_is_empty(input_string):
@@ -27,10 +42,7 @@ def query_is_empty(input_string):
     >>> query_is_empty('  ')
     False
     """
-    if re.match(r'\A\s*\Z', input_string) is None:
-        return True
-    else:
-        return False
+    return passes(input_string, 'query_is_empty')
 
 
 def parentheses_are_uneven(input_string):
@@ -45,16 +57,7 @@ def parentheses_are_uneven(input_string):
     >>> parentheses_are_uneven('w w w) w ((w(w w)w) w )')
     False
     """
-    pcounter = 0
-    for char in input_string:
-        if char == '(':
-            pcounter += 1
-        elif char == ')':
-            pcounter -= 1
-    if pcounter != 0:
-        return False
-    else:
-        return True
+    return passes(input_string, 'parentheses_are_uneven')
 
 
 def operators_with_no_words_in_between(input_string):
@@ -73,12 +76,7 @@ def operators_with_no_words_in_between(input_string):
     >>> operators_with_no_words_in_between('w WITHIN5 NOT w')
     False
     """
-    op_re1 = r'\&|\||AND|OR|BUT\sNOT|NOT|\~|\,|NEAR\d{1,3}|WITHIN\d{1,3}'
-    regex = re.compile('(%s)\s*(%s)' % (op_re1, op_re1))
-    if re.search(regex, input_string) is None:
-        return True
-    else:
-        return False
+    return passes(input_string, 'operators_with_no_words_in_between')
 
 
 def operator_following_opening_parenthesis_or_before_closing_parenthesis(input_string):
@@ -97,12 +95,22 @@ def operator_following_opening_parenthesis_or_before_closing_parenthesis(input_s
     >>> operator_following_opening_parenthesis_or_before_closing_parenthesis('w AND (w AND )')
     False
     """
-    op_re1 = r'\&|\||AND|OR|BUT\sNOT|NOT|\~|\,|NEAR\d{1,3}|WITHIN\d{1,3}'
-    oppa_re = re.compile('(\(\s*(%s))|((%s)\s*\))' % (op_re1, op_re1))
-    if re.search(oppa_re, input_string) is None:
-        return True
-    else:
-        return False
+    return passes(input_string, 'operator_following_opening_parenthesis_or_before_closing_parenthesis')
+
+
+def empty_parentheses(input_string):
+    """
+    This function checks whether every pair of parentheses contains something.
+    :param input_string: raw input string.
+    :return: Boolean.
+    >>> empty_parentheses('w AND (w OR w)')
+    True
+    >>> empty_parentheses('w | ( )')
+    False
+    >>> lexer.scan('() " ( ( "')[1]
+    [('empty_parentheses', 1)]
+    """
+    return passes(input_string, 'empty_parentheses')
 
 
 # def word_parentheses(input_string):
@@ -145,14 +153,7 @@ def quotation_marks_are_uneven(input_string):
     >>> quotation_marks_are_uneven('"w w" OR "w w w" AND "w w')
     False
     """
-    qcounter = 0
-    for char in input_string:
-        if char == '"':
-            qcounter += 1
-    if qcounter % 2 != 0:
-        return False
-    else:
-        return True
+    return passes(input_string, 'quotation_marks_are_uneven')
 
 
 def operators_within_exact_phrase(input_string):
@@ -169,25 +170,7 @@ def operators_within_exact_phrase(input_string):
     >>> operators_within_exact_phrase('"w NOT w" OR w NOT w')
     False
     """
-    # incomplete
-    op_re1 = r'\&|\||AND|OR|BUT\sNOT|NOT|\~|\,|NEAR\d{1,3}|WITHIN\d{1,3}'
-    qcount = 0
-    strcount = 0
-    opqu = 0
-    clqu = 0
-    for char in input_string:
-        if char == '"':
-            if qcount == 1:
-                clqu = strcount
-                qcount -= 1
-            else:
-                qcount += 1
-                opqu = strcount
-        if qcount == 0 and strcount != 0:
-            if re.search(op_re1, input_string[opqu+1:clqu]) is not None:
-                return False
-        strcount += 1
-    return True
+    return passes(input_string, 'operators_within_exact_phrase')
 
 
 def distance_must_be_between_1_and_999(input_string):
@@ -213,34 +196,50 @@ def distance_must_be_between_1_and_999(input_string):
     >>> distance_must_be_between_1_and_999('w AND w NEAR0 w OR w')
     False
     """
-    dist_re = re.compile(r'(NEAR|WITHIN)(0|\D|\d{4,})')
-    if re.search(dist_re, input_string) is None:
-        return True
-    else:
-        return False
+    return passes(input_string, 'distance_must_be_between_1_and_999')
+
+
+def validate(input_string):
+    """
+    This function splits the input string into tokens and runs all tests in the same pass.
+    :param input_string: Raw input string from search box.
+    :return: tuple (list of tokens for the parser, list of errors (name, offset)).
+    """
+    with stat.stage('validation'):
+        return lexer.scan(input_string)
+
+
+def parse_error(error):
+    """
+    Turns an error of the parser into an error of the list returned by validate, for queries
+    which pass every check but still cannot be parsed.
+    :param error: ValueError raised by preprocessor.parse_tokens.
+    :return: error (name, offset).
+    """
+    return 'query_cannot_be_parsed', getattr(error, 'offset', 0)
+
+
+def describe(errors):
+    """
+    Turns the errors found by validate into an error message.
+    :param errors: list of errors (name, offset).
+    :return: Error message and list of errors with the position at which they were found.
+    """
+    errorlist = ["Error: {} at {}".format(name, offset) for name, offset in errors]
+    return "{} Errors found.".format(len(errors)), errorlist
 
 
 def run(input_string):
     """
     This function takes the input string and runs all tests.
     :param input_string: Raw input string from search box.
-    :return: Error message.
-    """
-    funclist =[query_is_empty,
-               parentheses_are_uneven,
-               operators_with_no_words_in_between,
-               operator_following_opening_parenthesis_or_before_closing_parenthesis,
-               quotation_marks_are_uneven,
-               operators_within_exact_phrase,
-               distance_must_be_between_1_and_999]
-    errorcount = 0
-    errorlist = []
-    for func in funclist:
-        if func(input_string) is False:
-            errorcount += 1
-            errorlist.append("Error: {}".format(func.__name__))
-    if errorcount != 0:
-        return "{} Errors found.".format(errorcount), errorlist
+    :return: Error message and list of errors with the position at which they were found.
+    >>> run('(w AND AND w')
+    ('2 Errors found.', ['Error: operators_with_no_words_in_between at 7', 'Error: parentheses_are_uneven at 0'])
+    """
+    tokens, errors = validate(input_string)
+    if errors:
+        return describe(errors)
     else:
         return True, []
 
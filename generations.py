@@ -0,0 +1,347 @@
+"""
+Crash-safe index publishing with numbered generations.
+Every build goes into a new directory root/gen-000001, root/gen-000002,... with its own postings,
+pickles, vocabulary, document store, biword index and completions. The postings paths in the Inverted Index are absolute, so a generation is never
+moved once built. Instead, the manifest of a generation is written last, and a build is published by
+atomically replacing the file root/CURRENT, which names the current generation. A crash at any point
+leaves either the old or the new generation current, never a half-written one.
+Readers pin the generation they use with a lease file, so that collect() only removes generations
+which are neither current nor in use. A Reader can hot-swap to a newly published generation.
+"""
+import json
+import os
+import pickle
+import shutil
+import time
+import biwords
+import bitmap
+import completion
+import docstore
+import duplicates
+import indexer
+import postings
+import query_plan
+import vocabulary
+
+current_name = 'CURRENT'
+manifest_name = 'MANIFEST.json'
+index_name = '1Mii.pickle'
+counting_name = '1Mci.pickle'
+vocabulary_name = '1M.vocab'
+docstore_name = '1M.docs'
+biwords_name = '1M.biwords'
+completion_name = '1M.complete'
+leases_name = 'readers'
+prefix = 'gen-'
+
+
+def generation_name(number):
+    """
+    :param number: number of a generation.
+    :return: name of the generation directory.
+    >>> generation_name(12)
+    'gen-000012'
+    """
+    return '{}{:06d}'.format(prefix, number)
+
+
+def generation_numbers(root):
+    """
+    :param root: root directory of the generations.
+    :return: sorted list of the numbers of all generation directories, finished or not.
+    """
+    numbers = []
+    for name in os.listdir(root):
+        if name.startswith(prefix) and name[len(prefix):].isdigit():
+            numbers.append(int(name[len(prefix):]))
+    return sorted(numbers)
+
+
+def fsync_directory(path):
+    """
+    Flushes a directory entry to disk, so that a rename within the directory survives a crash.
+    :param path: directory.
+    :return: None.
+    """
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def write_durable(file_name, data):
+    """
+    Writes a file and flushes it to disk before returning.
+    :param file_name: name of the file.
+    :param data: bytes.
+    :return: None.
+    """
+    file = open(file_name, mode='wb')
+    file.write(data)
+    file.flush()
+    os.fsync(file.fileno())
+    file.close()
+
+
+def build(file_name, root, find_duplicates=False):
+    """
+    Indexes a corpus into a new generation. The generation is complete once its manifest exists,
+    but it is not used by readers before it is published.
+    :param file_name: name of the CSV file to be indexed.
+    :param root: root directory of the generations.
+    :param find_duplicates: if True, the near-duplicate clusters are written into the document store.
+    :return: number of the new generation.
+    """
+    root = os.path.abspath(root)
+    os.makedirs(root, exist_ok=True)
+    number = (generation_numbers(root) or [0])[-1] + 1
+    directory = os.path.join(root, generation_name(number))
+    os.makedirs(os.path.join(directory, 'postings_1M'))
+    file_dict = indexer.read_file(file_name)
+    documents = len(file_dict)
+    clusters = duplicates.find(file_dict)[0] if find_duplicates else None
+    docstore.build(file_dict, os.path.join(directory, docstore_name), clusters=clusters)
+    old_directory = os.getcwd()
+    try:
+        # the indexer writes its postings below ./postings_1M
+        os.chdir(directory)
+        indexer.inverted_index.clear()
+        indexer.counting_index.clear()
+        indexer.generate_index_new(file_dict)
+        biwords.build(file_dict, biwords.frequent_terms(indexer.counting_index), biwords_name)
+        del file_dict
+        bitmap.write_bitmaps(indexer.inverted_index, documents, indexer.counting_index)
+        vocabulary.build(indexer.inverted_index, indexer.counting_index, vocabulary_name, documents)
+        completion.build(indexer.inverted_index, indexer.counting_index, completion_name)
+    finally:
+        os.chdir(old_directory)
+    write_durable(os.path.join(directory, index_name), pickle.dumps(indexer.inverted_index))
+    write_durable(os.path.join(directory, counting_name), pickle.dumps(indexer.counting_index))
+    # the postings files are not flushed one by one, everything is flushed before the manifest
+    os.sync()
+    manifest = {'generation': number, 'created': time.time(), 'source': os.path.abspath(file_name),
+                'documents': documents, 'terms': len(indexer.inverted_index)}
+    write_durable(os.path.join(directory, manifest_name), json.dumps(manifest, indent=2).encode('utf8'))
+    fsync_directory(directory)
+    return number
+
+
+def read_manifest(root, number):
+    """
+    :param root: root directory of the generations.
+    :param number: number of a generation.
+    :return: the manifest of the generation, None if the generation was never finished.
+    """
+    file_name = os.path.join(root, generation_name(number), manifest_name)
+    if not os.path.exists(file_name):
+        return None
+    file = open(file_name)
+    manifest = json.load(file)
+    file.close()
+    return manifest
+
+
+def publish(root, number):
+    """
+    Makes a finished generation the current one by atomically replacing root/CURRENT.
+    :param root: root directory of the generations.
+    :param number: number of the generation.
+    :return: None.
+    """
+    if read_manifest(root, number) is None:
+        raise ValueError("generation {} was not finished".format(number))
+    temporary = os.path.join(root, current_name + '.tmp')
+    write_durable(temporary, generation_name(number).encode('utf8'))
+    os.replace(temporary, os.path.join(root, current_name))
+    fsync_directory(root)
+
+
+def current(root):
+    """
+    :param root: root directory of the generations.
+    :return: number of the current generation, None if nothing was published yet.
+    """
+    try:
+        file = open(os.path.join(root, current_name))
+    except FileNotFoundError:
+        return None
+    name = file.read().strip()
+    file.close()
+    return int(name[len(prefix):])
+
+
+def process_alive(pid):
+    """
+    :param pid: process ID.
+    :return: True if the process still exists.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def pinned(root, number):
+    """
+    :param root: root directory of the generations.
+    :param number: number of a generation.
+    :return: True if a living process holds a lease on the generation.
+    """
+    leases = os.path.join(root, generation_name(number), leases_name)
+    if not os.path.isdir(leases):
+        return False
+    for name in os.listdir(leases):
+        if name.isdigit() and process_alive(int(name)):
+            return True
+    return False
+
+
+def collect(root):
+    """
+    Removes every finished generation which is neither current nor pinned by a reader.
+    Unfinished generations are left alone, a build may still be writing them.
+    :param root: root directory of the generations.
+    :return: list of the numbers of the removed generations.
+    """
+    removed = []
+    newest = current(root)
+    for number in generation_numbers(root):
+        if newest is None or number >= newest or read_manifest(root, number) is None:
+            continue
+        if not pinned(root, number):
+            shutil.rmtree(os.path.join(root, generation_name(number)))
+            removed.append(number)
+    return removed
+
+
+def load(root, number):
+    """
+    :param root: root directory of the generations.
+    :param number: number of a generation.
+    :return: tuple (Inverted Index, Vocabulary) of the generation.
+    """
+    directory = os.path.join(root, generation_name(number))
+    pickle_in = open(os.path.join(directory, index_name), mode='rb')
+    ii = pickle.load(pickle_in)
+    pickle_in.close()
+    return ii, vocabulary.Vocabulary(os.path.join(directory, vocabulary_name))
+
+
+def load_auxiliary(root, number):
+    """
+    Opens the files a generation has besides its index. Generations built before these files were
+    written have none of them.
+    :param root: root directory of the generations.
+    :param number: number of a generation.
+    :return: tuple (DocumentStore, biword PackedIndex, Completion) of the generation, None for a missing file.
+    """
+    directory = os.path.join(root, generation_name(number))
+    opened = []
+    for name, opener in [(docstore_name, docstore.DocumentStore), (biwords_name, biwords.load),
+                         (completion_name, completion.Completion)]:
+        file_name = os.path.join(directory, name)
+        opened.append(opener(file_name) if os.path.exists(file_name) else None)
+    return tuple(opened)
+
+
+class Reader:
+    """
+    Holds the index of a pinned generation and swaps to newer generations when they are published.
+    The document store, the biword index and the completions are swapped together with the index.
+    """
+    def __init__(self, root, warm_terms=1000):
+        """
+        :param root: root directory of the generations.
+        :param warm_terms: number of the most frequent terms read into the cache before a swap.
+        """
+        self.root = os.path.abspath(root)
+        self.warm_terms = warm_terms
+        self.generation = None
+        self.ii = None
+        self.vocabulary = None
+        self.store = None
+        self.biwords = None
+        self.completions = None
+        self.refresh()
+
+    def lease(self, number):
+        """
+        :param number: number of a generation.
+        :return: name of the lease file of this process on the generation.
+        """
+        return os.path.join(self.root, generation_name(number), leases_name, str(os.getpid()))
+
+    def pin(self, number):
+        """
+        Takes a lease on a generation, so that collect() keeps it.
+        :param number: number of a generation.
+        :return: None.
+        """
+        os.makedirs(os.path.dirname(self.lease(number)), exist_ok=True)
+        open(self.lease(number), mode='w').close()
+
+    def release(self, number):
+        """
+        Gives up the lease on a generation.
+        :param number: number of a generation.
+        :return: None.
+        """
+        try:
+            os.remove(self.lease(number))
+        except FileNotFoundError:
+            pass
+
+    def refresh(self):
+        """
+        Swaps to the current generation if it changed. The new index is loaded and its most frequent
+        postings lists are read before the swap, so that queries never wait for a cold cache.
+        :return: True if the generation changed.
+        """
+        number = current(self.root)
+        if number is None:
+            raise FileNotFoundError("no generation was published in {}".format(self.root))
+        if number == self.generation:
+            return False
+        self.pin(number)
+        ii, statistics = load(self.root, number)
+        store, biword_index, completions = load_auxiliary(self.root, number)
+        fetched = dict()
+        for term, frequency in statistics.top(self.warm_terms):
+            if term in ii:
+                fetched[term] = postings.read_streams(ii[term], term)[0]
+        # the caches are keyed by term, so nothing of the old generation may stay in them
+        postings.cache.clear()
+        postings.cache.update(fetched)
+        bitmap.cache.clear()
+        query_plan.clear()
+        old = self.generation
+        self.ii, self.vocabulary, self.generation = ii, statistics, number
+        self.store, self.biwords, self.completions = store, biword_index, completions
+        if old is not None:
+            self.release(old)
+        return True
+
+    def close(self):
+        """
+        Releases the pinned generation.
+        :return: None.
+        """
+        if self.generation is not None:
+            self.release(self.generation)
+            self.generation = None
+
+
+if __name__ == '__main__':
+    # python generations.py build corpus.csv root [--duplicates]    builds and publishes a new generation
+    # python generations.py collect root                            removes unused generations
+    import sys
+    if sys.argv[1] == 'build':
+        new_generation = build(sys.argv[2], sys.argv[3], find_duplicates='--duplicates' in sys.argv)
+        publish(sys.argv[3], new_generation)
+        print("published generation {}".format(new_generation))
+    else:
+        print("removed generations {}".format(collect(sys.argv[2])))
@@ -2,6 +2,12 @@ import re
 import pickle
 import time
 import postings
+import biwords
+import bitmap
+import completion
+import docstore
+import duplicates
+import vocabulary
 import gc
 # import pprint
 import sys
@@ -60,19 +66,43 @@ def read_file(file_name):
     return file_dict
 
 
-def generate_index_new(file_dict, casefold=True, nonumbers=True):
+prefilter = re.compile(r'[^a-zA-Z0-9-]+')
+numberfilter = re.compile(r'[0-9]')
+
+
+def index_term(word, casefold=True, nonumbers=True):
+    """
+    Turns a word of a post into the term it is indexed as.
+    :param word: a word of the post content.
+    :return: the term, or None if the word is not indexed.
+    """
+    if casefold is True:
+        word = word.casefold()
+    # filter out words which contain non-alphanumeric characters
+    # or start or end with a hyphen
+    if (re.search(prefilter, word) is not None or len(word) > 20
+            or re.match(r'.+\-$|\-.+', word)):
+        return None
+    if nonumbers is True:
+        if re.search(numberfilter, word) is not None:
+            return None
+    return word
+
+
+def generate_index_new(file_dict, casefold=True, nonumbers=True, skip=()):
     """
     Function that generates a temporary index in memory and once
     it reaches a certain threshold, writes the temporary index
     onto the actual inverted index and deletes the temporary index
     from memory. This should save disk-read and disk_write time.
+    Posts whose ID is in skip, e.g. exact duplicates found by duplicates.find, are not indexed.
     """
     tmp_index = dict()
-    prefilter = re.compile(r'[^a-zA-Z0-9-]+')
-    numberfilter = re.compile(r'[0-9]')
     id_counter = 0
     batchcounter = 1
     for ID in file_dict:
+        if ID in skip:
+            continue
         if id_counter % 10000 == 0:
             print("{} IDs checked".format(id_counter))
 
@@ -103,16 +133,9 @@ def generate_index_new(file_dict, casefold=True, nonumbers=True):
         # go through wordlists
         for word in file_dict[ID][1]:
             pos += 1
-            if casefold is True:
-                word = word.casefold()
-            # filter out words which contain non-alphanumeric characters
-            # or start or end with a hyphen
-            if (re.search(prefilter, word) is not None or len(word) > 20
-                    or re.match(r'.+\-$|\-.+', word)):
+            word = index_term(word, casefold, nonumbers)
+            if word is None:
                 continue
-            if nonumbers is True:
-                if re.search(numberfilter, word) is not None:
-                    continue
 
             # here we increment the counting index
             if word in counting_index:
@@ -184,9 +207,23 @@ if __name__ == "__main__":
     file_name = input("Name of File to be indexed:")
     print("reading file")
     FD = read_file(file_name)
+    # python indexer.py [--duplicates] [--skip-duplicates]
+    clusters = None
+    exact_duplicates = set()
+    if '--duplicates' in sys.argv or '--skip-duplicates' in sys.argv:
+        print("finding near-duplicates")
+        clusters, exact_duplicates = duplicates.find(FD)
     print("generating index")
-    generate_index_new(FD)
+    skipped = exact_duplicates if '--skip-duplicates' in sys.argv else ()
+    generate_index_new(FD, skip=skipped)
+    documents = len(FD)
+    print("writing document store")
+    docstore.build(FD, '1M.docs', clusters=clusters)
+    print("writing biword index")
+    biwords.build(FD, biwords.frequent_terms(counting_index), '1M.biwords', skip=skipped)
     del(FD)
+    print("writing bitmaps of frequent terms")
+    bitmap.write_bitmaps(inverted_index, documents, counting_index)
     time2 = time.time()
     print("pickling index")
     file = open('1Mii.pickle', mode='wb')
@@ -198,3 +235,7 @@ if __name__ == "__main__":
     ci_file = open('1Mci.pickle', mode='wb')
     pickle.dump(counting_index, ci_file)
     ci_file.close()
+    print("writing completions")
+    completion.build(inverted_index, counting_index, '1M.complete')
+    print("writing vocabulary statistics")
+    vocabulary.build(inverted_index, counting_index, '1M.vocab', documents)
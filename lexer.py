@@ -0,0 +1,220 @@
+"""
+The lexer splits a raw query into tokens in a single pass over the string.
+Operator aliases are resolved while scanning:
+- & and AND become AND,
+- | , and OR become OR,
+- ~ NOT and BUT NOT become NOT,
+- NEARn and WITHINn keep their distance, even if the next word follows without whitespace (NEAR7word).
+Every token is a tuple (kind, value, offset), where offset is the position of the token in the raw query.
+The same pass also finds every error of the query, see scan.
+"""
+
+import doctest
+
+WORD = 'WORD'
+PHRASE = 'PHRASE'
+OPERATOR = 'OPERATOR'
+OPEN = '('
+CLOSE = ')'
+
+symbols = {'&': 'AND', '|': 'OR', ',': 'OR', '~': 'NOT'}
+keywords = {'AND', 'OR', 'NOT'}
+delimiters = set(' \t\n\r()"') | set(symbols)
+
+
+def is_distance_operator(word):
+    """
+    :param word: a word of the query.
+    :return: True if the word is NEAR or WITHIN followed by digits.
+    """
+    name = 'NEAR' if word.startswith('NEAR') else 'WITHIN' if word.startswith('WITHIN') else None
+    return name is not None and word[len(name):len(name) + 1].isdigit()
+
+
+def contains_operator(phrase):
+    """
+    :param phrase: the content of an exact phrase.
+    :return: True if there is an operator within the phrase.
+    """
+    if any(char in symbols for char in phrase):
+        return True
+    words = phrase.split()
+    for n, word in enumerate(words):
+        if word in keywords or is_distance_operator(word) or \
+                word == 'BUT' and n + 1 < len(words) and words[n + 1] == 'NOT':
+            return True
+    return False
+
+
+class Scanner:
+    """
+    Collects the tokens of a query and checks every token against the one before it,
+    so that all errors of the query are found in the same pass that splits it into tokens.
+    Every error is a tuple (name, offset), the names are those of the checks in error_catcher.
+    """
+    def __init__(self):
+        self.tokens = []
+        self.errors = []
+        self.open_parentheses = []
+
+    def error(self, name, offset):
+        self.errors.append((name, offset))
+
+    def emit(self, kind, value, offset):
+        """
+        Adds a token after checking it against the previous token.
+        :param kind: WORD, PHRASE, OPERATOR, OPEN or CLOSE.
+        :param value: the normalized token.
+        :param offset: position of the token in the raw query.
+        :return: None.
+        """
+        previous = self.tokens[-1][0] if self.tokens else None
+        if kind == OPERATOR:
+            if previous == OPERATOR:
+                self.error('operators_with_no_words_in_between', offset)
+            elif previous == OPEN:
+                self.error('operator_following_opening_parenthesis_or_before_closing_parenthesis', offset)
+            elif previous is None:
+                self.error('operator_at_beginning_or_end', offset)
+            if value.startswith(('NEAR', 'WITHIN')):
+                distance = value[4:] if value.startswith('NEAR') else value[6:]
+                if distance.startswith('0') or len(distance) > 3:
+                    self.error('distance_must_be_between_1_and_999', offset)
+        elif kind == OPEN:
+            self.open_parentheses.append(offset)
+        elif kind == CLOSE:
+            if previous == OPERATOR:
+                self.error('operator_following_opening_parenthesis_or_before_closing_parenthesis', offset)
+            elif previous == OPEN:
+                self.error('empty_parentheses', offset)
+            if self.open_parentheses:
+                self.open_parentheses.pop()
+            else:
+                self.error('parentheses_are_uneven', offset)
+        self.tokens.append((kind, value, offset))
+
+    def finish(self):
+        """
+        Checks the end of the query.
+        :return: None.
+        """
+        if not self.tokens:
+            self.error('query_is_empty', 0)
+        elif self.tokens[-1][0] == OPERATOR and len(self.tokens) > 1:
+            # a query of a single operator was already reported by emit
+            self.error('operator_at_beginning_or_end', self.tokens[-1][2])
+        for offset in self.open_parentheses:
+            self.error('parentheses_are_uneven', offset)
+
+
+def scan(query):
+    """
+    Splits a query into tokens and finds all errors on the way.
+    :param query: the raw query.
+    :return: tuple (list of tokens (kind, value, offset), list of errors (name, offset)).
+    >>> scan('(w1 AND "w2 OR w3") NEAR0 w4 ~')[1]
+    [('operators_within_exact_phrase', 8), ('distance_must_be_between_1_and_999', 20), \
+('operator_at_beginning_or_end', 29)]
+    >>> scan('w1 NEARx w2 NOT w3')[1]
+    [('distance_must_be_between_1_and_999', 3)]
+    """
+    scanner = Scanner()
+    i = 0
+    length = len(query)
+    while i < length:
+        char = query[i]
+        if char.isspace():
+            i += 1
+        elif char == '(' or char == ')':
+            scanner.emit(char, char, i)
+            i += 1
+        elif char in symbols:
+            scanner.emit(OPERATOR, symbols[char], i)
+            i += 1
+        elif char == '"':
+            end = query.find('"', i + 1)
+            if end == -1:
+                scanner.error('quotation_marks_are_uneven', i)
+                end = length
+            if contains_operator(query[i + 1:end]):
+                scanner.error('operators_within_exact_phrase', i)
+            scanner.emit(PHRASE, '"' + ' '.join(query[i + 1:end].split()) + '"', i)
+            i = end + 1
+        else:
+            start = i
+            while i < length and query[i] not in delimiters:
+                i += 1
+            word = query[start:i]
+            # look behind the whitespace following the word for the NOT of BUT NOT
+            following = i
+            while following < length and query[following].isspace():
+                following += 1
+            if word in keywords:
+                scanner.emit(OPERATOR, word, start)
+            elif word == 'BUT' and query[following:following + 3] == 'NOT' and \
+                    (following + 3 == length or query[following + 3] in delimiters):
+                scanner.emit(OPERATOR, 'NOT', start)
+                i = following + 3
+            elif is_distance_operator(word):
+                digits = 5 if word.startswith('NEAR') else 7
+                while digits < len(word) and word[digits].isdigit():
+                    digits += 1
+                scanner.emit(OPERATOR, word[:digits], start)
+                if digits < len(word):
+                    scanner.emit(WORD, word[digits:], start + digits)
+            else:
+                # as before the lexer, NEAR and WITHIN without a distance are an error, also within a word (NEARx)
+                if word.startswith(('NEAR', 'WITHIN')):
+                    scanner.error('distance_must_be_between_1_and_999', start)
+                scanner.emit(WORD, word, start)
+    scanner.finish()
+    return scanner.tokens, scanner.errors
+
+
+def tokenize(query):
+    """
+    Splits a query into tokens.
+    :param query: the raw query.
+    :return: list of tokens (kind, value, offset).
+    >>> [value for kind, value, offset in tokenize('w1 &w2 BUT NOT "w3  w4"|NEAR7w5')]
+    ['w1', 'AND', 'w2', 'NOT', '"w3 w4"', 'OR', 'NEAR7', 'w5']
+    >>> tokenize('(ORANGE,w)')
+    [('(', '(', 0), ('WORD', 'ORANGE', 1), ('OPERATOR', 'OR', 7), ('WORD', 'w', 8), (')', ')', 9)]
+    """
+    return scan(query)[0]
+
+
+def is_operand_end(token):
+    """
+    :param token: a token.
+    :return: True if the token can be the last token of an operand.
+    """
+    return token[0] in (WORD, PHRASE, CLOSE)
+
+
+def is_operand_start(token):
+    """
+    :param token: a token.
+    :return: True if the token can be the first token of an operand.
+    """
+    return token[0] in (WORD, PHRASE, OPEN)
+
+
+def insert_default_and(tokens):
+    """
+    Inserts an AND between two operands which follow each other without an operator.
+    :param tokens: list of tokens.
+    :return: list of tokens with AND operators inserted.
+    >>> [value for kind, value, offset in insert_default_and(tokenize('w1 w2 (w3 "w4 w5")'))]
+    ['w1', 'AND', 'w2', 'AND', '(', 'w3', 'AND', '"w4 w5"', ')']
+    """
+    result = []
+    for token in tokens:
+        if result and is_operand_end(result[-1]) and is_operand_start(token):
+            result.append((OPERATOR, 'AND', token[2]))
+        result.append(token)
+    return result
+
+
+if __name__ == '__main__':
+    doctest.testmod()
@@ -1,12 +1,34 @@
 import preprocessor
 import searcher
 import pickle
-from parse_tree import ParseTree
+import biwords
+import budget
+import completion
+import cursors
+import docstore
+import duplicates
 import error_catcher
-# import statistics_container as stat
-# import time
+import generations
+import lexer
+import packed_index
+import postings
+import query_plan
+import ranked
+import result_writer
+import shards
+import snippets
+import spill
+import statistics_container as stat
+import vocabulary
+import warmup
 from pprint import pprint
-import re
+from multiprocessing import Pool
+import itertools
+import sys
+import time
+
+# optional vocabulary.Vocabulary, gives the query planner its document frequencies.
+vocabulary_statistics = None
 
 
 def unpickle():
@@ -25,38 +47,446 @@ def unpickle():
     return inverted_index
 
 
-def run_main(query, ii):
+def run_main(query, ii, query_budget=None, collapse=None):
     """
     The main function of the search engine. Takes a query string and returns a list of DocIDs.
+    Every call is profiled, the profile can be found in statistics_container.last.
     :param query: The search string.
     :param ii: The Inverted Index to be used.
+    :param query_budget: optional budget.Budget. A query over its budget raises budget.BudgetExceeded,
+    or returns partial results if the budget allows them, in which case budget.last names the limit.
+    :param collapse: optional docstore.DocumentStore with near-duplicate clusters, only the first result
+    of every cluster is kept, see duplicates.collapse.
     :return: List of DocID tuples with list of positions (ID, [pos1, pos2,...]).
     """
+    stat.begin(query)
+    budget.begin(query_budget)
+    answer = None
+    try:
+        answer = _run(query, ii)
+        if answer is not None and collapse is not None:
+            answer = duplicates.collapse(answer[0], collapse), answer[1]
+    finally:
+        budget.finish()
+        stat.finish(len(answer[0]) if answer else None)
+    return answer
+
+
+def compile_plan(query, ii):
+    """
+    Validates a query and returns its plan, printing the errors of an invalid query.
+    :param query: The search string.
+    :param ii: The Inverted Index to be used.
+    :return: query_plan.Plan, None if the query is invalid.
+    """
     query = query.strip()
-    eval, elist = error_catcher.run(query)
-    if eval != True:
-        print(eval, elist)
+    tokens, errors = error_catcher.validate(query)
+    if errors:
+        print(*error_catcher.describe(errors))
         return None
-    if re.match(r'\b\w+\b$', query):
-        stats = dict()
-        stats[query] = dict()
-        stats[query]['Result: '] = ii[query]
-        return ii[query], stats
-    elif re.match(r'".+?"$', query):
-        query = query[1:-1].split()
-        return searcher.exact_phrase(query, ii)
-    else:
-        processed_query = preprocessor.run(query)
-        tree = ParseTree()
-        tree.generate(processed_query)
-        return searcher.run_main(tree.current, ii)
+    try:
+        return query_plan.compile_query(query, tokens, ii, frequencies=vocabulary_statistics)
+    except ValueError as error:
+        print(*error_catcher.describe([error_catcher.parse_error(error)]))
+        return None
+
+
+def _run(query, ii):
+    """
+    Validates, parses and evaluates a query, see run_main.
+    :param query: The search string.
+    :param ii: The Inverted Index to be used.
+    :return: List of DocID tuples with list of positions (ID, [pos1, pos2,...]).
+    """
+    plan = compile_plan(query, ii)
+    if plan is None:
+        return None
+    return plan.execute(ii)
+
+
+def run_count(query, ii, query_budget=None):
+    """
+    Counts the results of a query without building the result list, see query_plan.Plan.count.
+    :param query: The search string.
+    :param ii: The Inverted Index to be used.
+    :param query_budget: optional budget.Budget, see run_main.
+    :return: number of documents found, None if the query is invalid.
+    """
+    stat.begin(query)
+    budget.begin(query_budget)
+    count = None
+    try:
+        plan = compile_plan(query, ii)
+        if plan is not None:
+            count = plan.count(ii)
+    finally:
+        budget.finish()
+        stat.finish(count)
+    return count
+
+
+def run_ranked(query, ii, k=10):
+    """
+    Finds the k best results of a single term or of terms joined by AND or OR, see ranked.search.
+    :param query: The search string.
+    :param ii: The Inverted Index to be used.
+    :param k: number of results.
+    :return: list of tuples (ID, score), the best first, None if the query is not supported.
+    """
+    stat.begin(query)
+    best = None
+    try:
+        best = ranked.search(query, ii, k)
+    finally:
+        stat.finish(len(best) if best is not None else None)
+    return best
+
+
+def run_exists(query, ii, query_budget=None):
+    """
+    Checks whether a query has any result. It is evaluated like run_count, see query_plan.Plan.exists,
+    so both always agree.
+    :param query: The search string.
+    :param ii: The Inverted Index to be used.
+    :param query_budget: optional budget.Budget, see run_main.
+    :return: True if at least one document is found, None if the query is invalid.
+    """
+    stat.begin(query)
+    budget.begin(query_budget)
+    found = None
+    try:
+        plan = compile_plan(query, ii)
+        if plan is not None:
+            found = plan.exists(ii)
+    finally:
+        budget.finish()
+        stat.finish(None if found is None else int(found))
+    return found
+
+
+def run_stream(query, ii, start=0):
+    """
+    Streaming version of run_main. Returns a generator over the results instead of a list, so
+    that no intermediate or final result list is ever built.
+    :param query: The search string.
+    :param ii: The Inverted Index to be used.
+    :param start: the lowest DocID to look at.
+    :return: generator of DocID tuples with list of positions (ID, [pos1, pos2,...]).
+    """
+    query = query.strip()
+    tokens, errors = error_catcher.validate(query)
+    if errors:
+        print(*error_catcher.describe(errors))
+        return iter([])
+    if len(tokens) == 1 and tokens[0][0] == lexer.WORD:
+        if tokens[0][1] not in ii:
+            return iter([])
+        return iter(postings.fetch_from(tokens[0][1], ii, start))
+    if len(tokens) == 1 and tokens[0][0] == lexer.PHRASE:
+        return searcher.stream_exact_phrase(tokens[0][1][1:-1].split(), ii, start)
+    try:
+        tree = preprocessor.parse_tokens(tokens)
+    except ValueError as error:
+        print(*error_catcher.describe([error_catcher.parse_error(error)]))
+        return iter([])
+    return searcher.stream(tree.current, ii, start)
+
+
+def run_page(query, ii, cursor=None, size=None, generation=None, collapse=None):
+    """
+    Evaluates a single page of results. The query is evaluated as a stream which stops once the page
+    is full, and the page after it starts right behind its last DocID, so deep pages are as cheap as the first.
+    :param query: The search string.
+    :param ii: The Inverted Index to be used.
+    :param cursor: cursor returned with the previous page, None for the first page.
+    :param size: number of results per page, defaults to snippets.page_size.
+    :param generation: number of the index generation of ii, if it has one. Cursors of another generation
+    are refused with cursors.CursorError, so that the pages of a query always come from the same index.
+    :param collapse: optional docstore.DocumentStore with near-duplicate clusters, only the first result
+    of every cluster is kept, over all pages. The ID of a cluster is its lowest DocID, so only a result
+    whose cluster starts before the page can have a duplicate on an earlier page; the results between
+    the start of such a cluster and the page are checked for it.
+    :return: tuple (DocID list of the page, cursor of the next page or None if this is the last page).
+    >>> import shutil, tempfile
+    >>> path = tempfile.mkdtemp()
+    >>> lists = {'a': [(1, [1]), (2, [5]), (4, [1])], 'b': [(1, [2]), (2, [6]), (4, [2])], 'c': [(2, [7]), (4, [3])]}
+    >>> for term in lists:
+    ...     postings.write_streams(path, term, lists[term])
+    >>> ii = dict.fromkeys(lists, path)
+    >>> first, cursor = run_page('"a b" AND "b c"', ii, size=1)
+    >>> second, cursor = run_page('"a b" AND "b c"', ii, cursor, size=1)
+    >>> [posting[0] for posting in first + second], cursor, [posting[0] for posting in run_main('"a b" AND "b c"', ii)[0]]
+    ([2, 4], None, [2, 4])
+    >>> shutil.rmtree(path)
+    """
+    size = size or snippets.page_size
+    start = 0 if cursor is None else cursors.decode(cursor, generation, query) + 1
+    stat.begin(query)
+    page = []
+    try:
+        results = run_stream(query, ii, start)
+        if collapse is not None:
+            def shown_before(cluster):
+                if cluster >= start:
+                    return False
+                earlier = itertools.takewhile(lambda posting: int(posting[0]) < start, run_stream(query, ii, cluster))
+                return any(collapse.cluster(posting[0]) == cluster for posting in earlier)
+            results = duplicates.collapse_stream(results, collapse, shown_before)
+        # one result more than needed tells whether there is a next page
+        page = list(itertools.islice(results, size + 1))
+    finally:
+        stat.finish(min(len(page), size))
+    if len(page) <= size:
+        return page, None
+    page = page[:size]
+    return page, cursors.encode(page[-1][0], generation, query)
+
+
+def query_terms(query):
+    """
+    Collects all search words of a query, including the words of exact phrases.
+    :param query: The search string.
+    :return: Set of words whose postings lists are needed to answer the query.
+    """
+    terms = set()
+    for kind, value, offset in lexer.tokenize(query):
+        if kind == lexer.WORD:
+            terms.add(value)
+        elif kind == lexer.PHRASE:
+            terms.update(value[1:-1].split())
+    return terms
+
+
+# Inverted Index of a batch worker process, set by _batch_worker_init.
+batch_index = dict()
+
+
+def worker_index(ii):
+    """
+    :param ii: The Inverted Index to be used.
+    :return: what a worker process needs to get the same index: the file name of a packed index,
+    whose buffers cannot be sent to another process, or the index itself.
+    """
+    if isinstance(ii, packed_index.PackedIndex):
+        return ii.file_name
+    return ii
+
+
+def _batch_worker_init(ii):
+    """
+    Initializes a batch worker process, which reads the postings lists from disk itself.
+    :param ii: The Inverted Index to be used, or the file name of a packed index as given by worker_index.
+    :return: None.
+    """
+    global batch_index
+    if isinstance(ii, str):
+        ii = packed_index.PackedIndex(ii)
+    batch_index = ii
+
+
+def _batch_worker(job):
+    """
+    Runs a single query of a batch inside a worker process.
+    :param job: tuple (number of the query in the batch, query string).
+    :return: tuple (number of the query, query string, result of run_main).
+    """
+    number, query = job
+    answer = run_main(query, batch_index)
+    if answer is not None and isinstance(answer[0], spill.SpilledPostings):
+        # the temporary file of a spilled result stays in this process, only a list can be sent back
+        answer = list(answer[0]), answer[1]
+    return number, query, answer
+
+
+def run_batch(queries, ii, processes=None):
+    """
+    Runs many queries at once. All queries are validated and parsed first, then the postings files
+    of every distinct term are read ahead once, in on-disk order, into the page cache that all worker
+    processes share. Nothing is decoded or kept in this process, and no postings list is copied into
+    the workers. The queries are then evaluated in a pool of worker processes and the results are
+    yielded as soon as they are done.
+    :param queries: iterable of search strings.
+    :param ii: The Inverted Index to be used.
+    :param processes: number of worker processes, defaults to the number of CPUs.
+    :return: generator of tuples (number of the query, query string, result of run_main).
+    Invalid queries yield None as result.
+    """
+    queries = list(queries)
+    terms = set()
+    for query in queries:
+        tokens, errors = error_catcher.validate(query.strip())
+        if not errors:
+            terms.update(query_terms(query))
+    if isinstance(ii, dict):
+        for term in postings.disk_order(terms, ii):
+            warmup.advise(term, ii[term])
+    with Pool(processes, initializer=_batch_worker_init, initargs=(worker_index(ii),)) as pool:
+        for answer in pool.imap_unordered(_batch_worker, enumerate(queries)):
+            yield answer
 
 
 if __name__ == '__main__':
-    II = unpickle()
+    # python main.py [--debug] [--stream jsonl|csv] [--packed index.pack] [--vocabulary 1M.vocab]
+    #                    [--shards shards.json] [--generations root] [--warm seconds] [--warm-queries file]
+    #                    [--log-queries file] [--docs 1M.docs]
+    #                    [--biwords 1M.biwords] [--complete 1M.complete]
+    #                    [--max-seconds s] [--max-bytes n] [--max-results n] [--partial] [--collapse]
+    searcher.debug = '--debug' in sys.argv
+    query_budget = None
+    if {'--max-seconds', '--max-bytes', '--max-results'} & set(sys.argv):
+        query_budget = budget.Budget(
+            seconds=float(sys.argv[sys.argv.index('--max-seconds') + 1]) if '--max-seconds' in sys.argv else None,
+            max_bytes=int(sys.argv[sys.argv.index('--max-bytes') + 1]) if '--max-bytes' in sys.argv else None,
+            max_results=int(sys.argv[sys.argv.index('--max-results') + 1]) if '--max-results' in sys.argv else None,
+            partial='--partial' in sys.argv)
+    if '--log-queries' in sys.argv:
+        stat.log_queries(sys.argv[sys.argv.index('--log-queries') + 1])
+    output_format = None
+    if '--stream' in sys.argv:
+        output_format = sys.argv[sys.argv.index('--stream') + 1]
+    reader = None
+    if '--packed' in sys.argv:
+        II = packed_index.PackedIndex(sys.argv[sys.argv.index('--packed') + 1])
+    elif '--generations' in sys.argv:
+        reader = generations.Reader(sys.argv[sys.argv.index('--generations') + 1])
+        II = reader.ii
+        vocabulary_statistics = reader.vocabulary
+    else:
+        II = unpickle()
+    if '--vocabulary' in sys.argv:
+        vocabulary_statistics = vocabulary.Vocabulary(sys.argv[sys.argv.index('--vocabulary') + 1])
+    if '--warm' in sys.argv or '--warm-queries' in sys.argv:
+        if '--warm-queries' in sys.argv:
+            hot_terms = warmup.terms_by_queries(stat.read_query_log(sys.argv[sys.argv.index('--warm-queries') + 1]))
+        elif vocabulary_statistics is not None:
+            hot_terms = warmup.terms_by_frequency(vocabulary_statistics, limit=postings.max_cached)
+        else:
+            ci_file = open('1Mci.pickle', 'rb')
+            hot_terms = warmup.terms_by_frequency(pickle.load(ci_file), limit=postings.max_cached)
+            ci_file.close()
+        warm_seconds = float(sys.argv[sys.argv.index('--warm') + 1]) if '--warm' in sys.argv else None
+        warmup.warm(hot_terms, II, seconds=warm_seconds,
+                    progress=lambda done, total, size: print("warm-up: {}/{} terms, {} bytes".format(done, total, size)))
+    completions = None
+    store = None
+    if reader is not None:
+        # a generation brings its own document store, biword index and completions
+        store, searcher.biword_index, completions = reader.store, reader.biwords, reader.completions
+    if '--biwords' in sys.argv:
+        searcher.biword_index = biwords.load(sys.argv[sys.argv.index('--biwords') + 1])
+    if '--complete' in sys.argv:
+        completions = completion.Completion(sys.argv[sys.argv.index('--complete') + 1])
+    if '--docs' in sys.argv:
+        store = docstore.DocumentStore(sys.argv[sys.argv.index('--docs') + 1])
+    paged_query = None
+    page_cursor = None
+    coordinator = None
+    if '--shards' in sys.argv:
+        coordinator = shards.Coordinator.from_manifest(sys.argv[sys.argv.index('--shards') + 1])
+    collapse_store = None
+    if '--collapse' in sys.argv:
+        if coordinator is not None:
+            sys.exit("--collapse is not supported with --shards")
+        if store is None or store.clusters is None:
+            sys.exit("--collapse needs a document store with near-duplicate clusters, see --docs and --duplicates")
+        collapse_store = store
     while True:
         user_input = input('Enter search string: ')
         if user_input == '':
             break
-        end_result, stats = run_main(user_input, II)
-        pprint(stats)
+        if reader is not None and reader.refresh():
+            # a new generation was published
+            II = reader.ii
+            vocabulary_statistics = reader.vocabulary
+            if '--docs' not in sys.argv:
+                store = reader.store
+            if '--biwords' not in sys.argv:
+                searcher.biword_index = reader.biwords
+            if '--complete' not in sys.argv:
+                completions = reader.completions
+            if collapse_store is not None:
+                if store is None or store.clusters is None:
+                    print("the new generation has no near-duplicate clusters, results are no longer collapsed")
+                    collapse_store = None
+                else:
+                    collapse_store = store
+        if user_input.startswith('complete ') and completions is not None:
+            pprint(completions.complete(user_input[len('complete '):].strip()))
+        elif coordinator is not None:
+            # the shards answer searches, counts and ranked searches, the other commands need a local index
+            if user_input.startswith('count '):
+                found = coordinator.count(user_input[len('count '):])
+                if found is not None:
+                    print("{} documents found".format(found))
+            elif user_input.startswith('top '):
+                best = coordinator.search_ranked(user_input[len('top '):])
+                if best is None:
+                    print("top only supports a single term or terms joined by AND or OR")
+                else:
+                    pprint(best)
+            elif user_input.startswith(('page ', 'exists ', 'explain ')) or user_input == 'more':
+                print("{} is not supported with --shards".format(user_input.split(' ', 1)[0]))
+            else:
+                end_result = coordinator.search(user_input)
+                if end_result is not None:
+                    print("{} documents found".format(len(end_result)))
+                    pprint(end_result[:10])
+        elif user_input.startswith('count '):
+            try:
+                print("{} documents found".format(run_count(user_input[len('count '):], II, query_budget)))
+            except budget.BudgetExceeded as exceeded:
+                print(exceeded)
+        elif user_input.startswith('page ') or user_input == 'more':
+            if user_input != 'more':
+                paged_query = user_input[len('page '):]
+                page_cursor = None
+            elif page_cursor is None:
+                print("no more results")
+                continue
+            try:
+                page_results, page_cursor = run_page(paged_query, II, page_cursor,
+                                                     generation=reader.generation if reader is not None else None,
+                                                     collapse=collapse_store)
+            except cursors.CursorError as error:
+                print(error)
+                continue
+            pprint(page_results)
+            if page_cursor is not None:
+                print("cursor: {} (type 'more' for the next page)".format(page_cursor))
+        elif user_input.startswith('top '):
+            best = run_ranked(user_input[len('top '):], II)
+            if best is None:
+                print("top only supports a single term or terms joined by AND or OR")
+            else:
+                pprint(best)
+        elif user_input.startswith('exists '):
+            try:
+                print(run_exists(user_input[len('exists '):], II, query_budget))
+            except budget.BudgetExceeded as exceeded:
+                print(exceeded)
+        elif user_input.startswith('explain '):
+            user_input = user_input[len('explain '):].strip()
+            if run_main(user_input, II) is not None:
+                print(query_plan.explain(query_plan.last))
+        elif output_format is not None:
+            count = result_writer.writers[output_format](run_stream(user_input, II))
+            print("{} documents found".format(count))
+        else:
+            try:
+                answer = run_main(user_input, II, query_budget)
+            except budget.BudgetExceeded as exceeded:
+                print(exceeded)
+                continue
+            if answer is None:
+                continue
+            end_result, stats = answer
+            if collapse_store is not None:
+                collapsed = duplicates.collapse(end_result, collapse_store)
+                print("{} documents found, {} without near-duplicates".format(len(end_result), len(collapsed)))
+                end_result = collapsed
+            if budget.last is not None:
+                print("partial results, the query went over its budget of {}".format(budget.last))
+            if store is not None:
+                for ID, member, text in snippets.page(end_result, store, query_terms(user_input), II):
+                    print("{} ({}): {}".format(ID, member, text))
+            pprint(stat.generate(stats))
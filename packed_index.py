@@ -0,0 +1,240 @@
+"""
+In-RAM index mode. All postings lists are packed into a handful of contiguous buffers,
+so that the whole index can be served from memory without one Python object per posting:
+- a term table: the sorted terms as UTF-8 in one blob plus an offset array,
+- an array with the first posting of every term,
+- a DocID array with one unsigned int per posting,
+- a position offset array with the first position of every posting,
+- a positions array with one unsigned int per position.
+The file is loaded with a single mmap (or readinto) and the arrays are memoryviews into it.
+"""
+import mmap
+import operator
+import struct
+from array import array
+import postings
+
+magic = b'NCATPK01'
+header_format = '<8sQQQQ'
+header_size = struct.calcsize(header_format)
+
+
+def _padding(size):
+    """
+    :param size: size of a buffer in bytes.
+    :return: number of zero bytes needed to align the next buffer to 8 bytes.
+    """
+    return -size % 8
+
+
+def build(ii, file_name):
+    """
+    Packs an Inverted Index into a single file.
+    :param ii: Inverted Index mapping terms to postings paths.
+    :param file_name: name of the packed index file to write.
+    :return: None.
+    """
+    terms = sorted(ii, key=lambda term: term.encode('utf8'))
+    write(((term.encode('utf8'), postings.retrieve(term, ii[term])) for term in terms), file_name)
+
+
+def write(packed_postings, file_name):
+    """
+    Writes a packed index file.
+    :param packed_postings: iterable of tuples (term as UTF-8 bytes, postings list), sorted by term.
+    :param file_name: name of the packed index file to write.
+    :return: None.
+    """
+    term_offsets = array('Q', [0])
+    posting_starts = array('Q', [0])
+    position_starts = array('Q', [0])
+    doc_ids = array('I')
+    positions = array('I')
+    blob = bytearray()
+    for encoded, postings_list in packed_postings:
+        for ID, term_positions in postings_list:
+            doc_ids.append(int(ID))
+            positions.extend(term_positions)
+            position_starts.append(len(positions))
+        blob += encoded
+        term_offsets.append(len(blob))
+        posting_starts.append(len(doc_ids))
+    file = open(file_name, mode='wb')
+    file.write(struct.pack(header_format, magic, len(term_offsets) - 1, len(doc_ids), len(positions), len(blob)))
+    for buffer in [term_offsets, posting_starts, position_starts, doc_ids, positions, blob]:
+        data = bytes(buffer)
+        file.write(data)
+        file.write(b'\0' * _padding(len(data)))
+    file.close()
+
+
+class PackedPostings:
+    """
+    The postings list of a single term, or a slice of it, as a view into the buffers of a PackedIndex.
+    It behaves like a list of (ID, [pos1, pos2,...]) tuples, but the tuples are only created when accessed.
+    The DocIDs can be read without creating any object through the doc_ids attribute.
+    """
+    def __init__(self, index, start, end):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.doc_ids = index.doc_ids[start:end]
+
+    def __len__(self):
+        return self.end - self.start
+
+    def positions(self, i):
+        """
+        :param i: number of the posting within this postings list.
+        :return: memoryview of the positions of the posting.
+        """
+        starts = self.index.position_starts
+        return self.index.positions[starts[self.start + i]:starts[self.start + i + 1]]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, end, step = i.indices(len(self))
+            return PackedPostings(self.index, self.start + start, self.start + max(start, end))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.doc_ids[i], self.positions(i).tolist()
+
+    def __iter__(self):
+        starts = self.index.position_starts[self.start:self.end + 1]
+        positions = self.index.positions
+        for ID, start, end in zip(self.doc_ids, starts, starts[1:]):
+            yield ID, positions[start:end].tolist()
+
+
+class Frequencies:
+    """
+    The frequencies of a postings list of a PackedIndex, i.e. the number of positions of every posting.
+    They are the differences of the position offsets and are only computed when read.
+    """
+    def __init__(self, starts):
+        """
+        :param starts: memoryview of the position offsets of the postings and of the end of the last one.
+        """
+        self.starts = starts
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, end, step = i.indices(len(self))
+            return Frequencies(self.starts[start:max(start, end) + 1])
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.starts[i + 1] - self.starts[i]
+
+    def __iter__(self):
+        return map(operator.sub, self.starts[1:], self.starts[:-1])
+
+
+class PackedIndex:
+    """
+    Inverted Index served from a packed index file written by build().
+    Terms are found by binary search in the term table, so no dictionary of all terms is built.
+    """
+    def __init__(self, file_name, use_mmap=True):
+        # the buffers cannot be sent to another process, workers open the index again by its file name
+        self.file_name = file_name
+        file = open(file_name, mode='rb')
+        if use_mmap:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.buffer = bytearray(file.seek(0, 2))
+            file.seek(0)
+            file.readinto(self.buffer)
+        file.close()
+        view = memoryview(self.buffer)
+        file_magic, n_terms, n_postings, n_positions, blob_size = struct.unpack_from(header_format, view)
+        if file_magic != magic:
+            raise ValueError("{} is not a packed index".format(file_name))
+        offset = header_size
+        buffers = []
+        for code, length in [('Q', n_terms + 1), ('Q', n_terms + 1), ('Q', n_postings + 1),
+                             ('I', n_postings), ('I', n_positions)]:
+            size = length * struct.calcsize(code)
+            buffers.append(view[offset:offset + size].cast(code))
+            offset += size + _padding(size)
+        self.term_offsets, self.posting_starts, self.position_starts, self.doc_ids, self.positions = buffers
+        self.blob = view[offset:offset + blob_size]
+        self.size = n_terms
+
+    def term(self, n):
+        """
+        :param n: number of a term in the term table.
+        :return: the term as bytes.
+        """
+        return bytes(self.blob[self.term_offsets[n]:self.term_offsets[n + 1]])
+
+    def find(self, term):
+        """
+        Binary search for a term in the term table.
+        :param term: the term.
+        :return: number of the term in the term table, -1 if it is not in the index.
+        """
+        encoded = term.encode('utf8')
+        low = 0
+        high = self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.term(middle) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.size and self.term(low) == encoded:
+            return low
+        return -1
+
+    def __contains__(self, term):
+        return self.find(term) != -1
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for n in range(self.size):
+            yield self.term(n).decode('utf8')
+
+    def retrieve(self, term):
+        """
+        Counterpart of postings.retrieve for the packed index.
+        :param term: the term.
+        :return: PackedPostings of the term.
+        """
+        n = self.find(term)
+        if n == -1:
+            raise KeyError(term)
+        return PackedPostings(self, self.posting_starts[n], self.posting_starts[n + 1])
+
+    def retrieve_doc_ids(self, term):
+        """
+        Counterpart of postings.retrieve_doc_ids for the packed index, the positions buffer is not touched.
+        :param term: the term.
+        :return: DocIdPostings of the term.
+        """
+        n = self.find(term)
+        if n == -1:
+            raise KeyError(term)
+        start = self.posting_starts[n]
+        end = self.posting_starts[n + 1]
+        return postings.DocIdPostings(self.doc_ids[start:end], Frequencies(self.position_starts[start:end + 1]))
+
+    def __getitem__(self, term):
+        return self.retrieve(term)
+
+
+if __name__ == '__main__':
+    # python packed_index.py 100k_index.pickle 100k_index.pack
+    import pickle
+    import sys
+    pickle_in = open(sys.argv[1], 'rb')
+    build(pickle.load(pickle_in), sys.argv[2])
+    pickle_in.close()
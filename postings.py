@@ -2,37 +2,542 @@
 Organize postings lists according to letters of words.
 i.e. the postings list for 'hello' will be in folder
 postings/h/he/hel/hell/hello/hello$/hello.txt.
+
+Every postings list is split into two files:
+- hello$.ids, the DocID stream: the number of documents, their DocIDs and the frequency of the term in each,
+- hello$.pos, the positions stream: all positions, document after document.
+Boolean operators only need the DocID stream, the positions are only read for phrase, NEAR and WITHIN.
+Long postings lists get a third file, hello$.top, the first tier for ranked search: the tier_size documents
+with the highest frequency of the term, best first, and the highest frequency of all other documents.
+All numbers in these files are unsigned 32 bit integers in the native byte order, as written by array.
+Indexes written before the split have a single pickled hello$.dmp file, which is still read.
 """
 import os
 import pickle
-import lzma
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+import statistics_container as stat
+
+# largest number of postings lists kept in the cache, None keeps all of them.
+max_cached = 5000
+# number of documents in the first tier of a postings list, shorter lists get no tier file.
+tier_size = 1000
+
+
+class Cache(OrderedDict):
+    """
+    Postings lists that were already fetched, keyed by term. Once there are more than max_cached lists,
+    the least recently used ones are dropped. A warmup.Warmer fills the cache in a background thread while
+    queries read it, so every access holds a lock, and readers use get(), which cannot fail on a term
+    that was dropped after a check.
+    >>> lists = Cache(2)
+    >>> lists['a'], lists['b'] = [(1, [])], [(2, [])]
+    >>> lists['a']
+    [(1, [])]
+    >>> lists['c'] = [(3, [])]
+    >>> sorted(lists), lists.get('b')
+    (['a', 'c'], None)
+    """
+    def __init__(self, limit=None):
+        """
+        :param limit: largest number of postings lists, defaults to max_cached.
+        """
+        OrderedDict.__init__(self)
+        self.limit = limit
+        self.lock = threading.RLock()
+
+    def get(self, term, default=None):
+        with self.lock:
+            if not OrderedDict.__contains__(self, term):
+                return default
+            self.move_to_end(term)
+            return OrderedDict.__getitem__(self, term)
+
+    def __getitem__(self, term):
+        with self.lock:
+            self.move_to_end(term)
+            return OrderedDict.__getitem__(self, term)
+
+    def __setitem__(self, term, postings_list):
+        with self.lock:
+            OrderedDict.__setitem__(self, term, postings_list)
+            self.move_to_end(term)
+            limit = max_cached if self.limit is None else self.limit
+            while limit is not None and len(self) > limit:
+                self.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            OrderedDict.clear(self)
+
+
+# filled by preload() and warmup.Warmer so that several queries can share a single read.
+cache = Cache()
+
+
+class DocIdPostings:
+    """
+    Postings list read from the DocID stream only. It behaves like a list of (ID, []) tuples,
+    i.e. a postings list without positions, and keeps the DocIDs and frequencies in arrays
+    (or in views of the buffers of a packed index).
+    """
+    def __init__(self, doc_ids, frequencies):
+        self.doc_ids = doc_ids
+        self.frequencies = frequencies
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return DocIdPostings(self.doc_ids[i], self.frequencies[i])
+        return self.doc_ids[i], []
+
+    def __iter__(self):
+        for ID in self.doc_ids:
+            yield ID, []
+
+
+def stream_file(path, term, extension):
+    """
+    :param path: postings path of the term.
+    :param term: the term.
+    :param extension: 'ids', 'pos' or 'dmp'.
+    :return: name of the file.
+    """
+    return os.path.join(path, term + '$.' + extension)
+
+
+def write_streams(path, term, postings_list):
+    """
+    Writes the DocID stream and the positions stream of a term.
+    :param path: postings path of the term.
+    :param term: the term.
+    :param postings_list: list of (ID, [pos1, pos2,...]).
+    :return: None.
+    """
+    doc_ids = array('I', [int(posting[0]) for posting in postings_list])
+    frequencies = array('I', [len(posting[1]) for posting in postings_list])
+    positions = array('I')
+    for posting in postings_list:
+        positions.extend(posting[1])
+    file = open(stream_file(path, term, 'ids'), mode='wb')
+    file.write(struct.pack('=I', len(doc_ids)))
+    doc_ids.tofile(file)
+    frequencies.tofile(file)
+    file.close()
+    file = open(stream_file(path, term, 'pos'), mode='wb')
+    positions.tofile(file)
+    file.close()
+    if len(doc_ids) > tier_size:
+        write_tier(path, term, doc_ids, frequencies)
+
+
+def first_tier(doc_ids, frequencies, size):
+    """
+    Picks the documents with the highest frequency of a term, ties go to the lower DocID.
+    :param doc_ids: DocIDs of the postings list.
+    :param frequencies: frequency of the term in every document.
+    :param size: number of documents of the tier.
+    :return: tuple (array of DocIDs, array of frequencies, highest frequency outside of the tier),
+    the best document first.
+    >>> first_tier([1, 2, 3, 4], [2, 5, 2, 1], 2)
+    (array('I', [2, 1]), array('I', [5, 2]), 2)
+    """
+    order = sorted(range(len(doc_ids)), key=lambda n: (-frequencies[n], doc_ids[n]))
+    bound = frequencies[order[size]] if size < len(order) else 0
+    order = order[:size]
+    return array('I', [doc_ids[n] for n in order]), array('I', [frequencies[n] for n in order]), bound
+
+
+def write_tier(path, term, doc_ids, frequencies):
+    """
+    Writes the first tier of a term: the number of documents and the highest frequency outside of the tier,
+    then the DocIDs and the frequencies of the tier.
+    :param path: postings path of the term.
+    :param term: the term.
+    :param doc_ids: DocIDs of the postings list.
+    :param frequencies: frequency of the term in every document.
+    :return: None.
+    """
+    tier_ids, tier_frequencies, bound = first_tier(doc_ids, frequencies, tier_size)
+    file = open(stream_file(path, term, 'top'), mode='wb')
+    file.write(struct.pack('=II', len(tier_ids), bound))
+    tier_ids.tofile(file)
+    tier_frequencies.tofile(file)
+    file.close()
+
+
+def read_doc_ids(path, term):
+    """
+    Reads the DocID stream of a term.
+    :param path: postings path of the term.
+    :param term: the term.
+    :return: tuple (array of DocIDs, array of frequencies, bytes read).
+    """
+    file = open(stream_file(path, term, 'ids'), mode='rb')
+    data = file.read()
+    file.close()
+    count, = struct.unpack_from('=I', data)
+    doc_ids = array('I', data[4:4 + 4 * count])
+    frequencies = array('I', data[4 + 4 * count:4 + 8 * count])
+    return doc_ids, frequencies, len(data)
+
+
+def read_streams(path, term):
+    """
+    Reads both streams of a term and puts them back together.
+    :param path: postings path of the term.
+    :param term: the term.
+    :return: tuple (list of (ID, [pos1, pos2,...]), bytes read).
+    """
+    doc_ids, frequencies, size = read_doc_ids(path, term)
+    file = open(stream_file(path, term, 'pos'), mode='rb')
+    positions = array('I', file.read())
+    file.close()
+    postings_list = []
+    start = 0
+    for ID, frequency in zip(doc_ids, frequencies):
+        postings_list.append((ID, positions[start:start + frequency].tolist()))
+        start += frequency
+    return postings_list, size + 4 * len(positions)
+
 
 def retrieve(term, path):
     """
     This function is used by the searcher to quickly retrieve the postings list,
     thus allowing the index to be kept small.
     Quick path retrieval is left to the operating system.
+    If the postings list was preloaded, the cached copy is returned instead.
     """
-    os.chdir(path)
-    file = open(term + '$.dmp', mode='rb')
-    postings_list = pickle.load(file)
+    started = time.perf_counter()
+    postings_list = cache.get(term)
+    if postings_list is not None:
+        stat.fetch(term, 0, True, time.perf_counter() - started)
+        return postings_list
+    if os.path.exists(stream_file(path, term, 'ids')):
+        postings_list, size = read_streams(path, term)
+    else:
+        file = open(stream_file(path, term, 'dmp'), mode='rb')
+        postings_list = pickle.load(file)
+        size = file.tell()
+        file.close()
+    stat.fetch(term, size, False, time.perf_counter() - started)
+    return postings_list
+
+
+def retrieve_doc_ids(term, path):
+    """
+    Retrieves the postings list of a term without its positions, reading the DocID stream only.
+    :param term: the term.
+    :param path: postings path of the term.
+    :return: DocIdPostings, or the full postings list if it is cached or the index has no DocID streams.
+    """
+    if term in cache or not os.path.exists(stream_file(path, term, 'ids')):
+        return retrieve(term, path)
+    started = time.perf_counter()
+    doc_ids, frequencies, size = read_doc_ids(path, term)
+    stat.fetch(term, size, False, time.perf_counter() - started)
+    return DocIdPostings(doc_ids, frequencies)
+
+
+def retrieve_from(term, path, start, positions=True):
+    """
+    Retrieves the postings of a term from the first DocID which is not below start. The DocID is searched
+    for in the undecoded DocID stream, and only the postings from there on are decoded; their positions
+    are read from the offset the frequencies before them add up to.
+    :param term: the term.
+    :param path: postings path of the term.
+    :param start: the lowest DocID to keep.
+    :param positions: if False, the positions stream is not read at all, see retrieve_doc_ids.
+    :return: list of (ID, [pos1, pos2,...]), or DocIdPostings if positions is False.
+    """
+    if term in cache or not os.path.exists(stream_file(path, term, 'ids')):
+        postings_list = retrieve(term, path) if positions else retrieve_doc_ids(term, path)
+        if isinstance(postings_list, list):
+            return postings_list[bisect_left(postings_list, start, key=lambda posting: int(posting[0])):]
+        return postings_list[bisect_left(postings_list.doc_ids, start):]
+    started = time.perf_counter()
+    file = open(stream_file(path, term, 'ids'), mode='rb')
+    data = memoryview(file.read())
     file.close()
+    count, = struct.unpack_from('=I', data)
+    n = bisect_left(data[4:4 + 4 * count].cast('I'), start)
+    doc_ids = array('I')
+    doc_ids.frombytes(data[4 + 4 * n:4 + 4 * count])
+    frequencies = array('I')
+    frequencies.frombytes(data[4 + 4 * count + 4 * n:4 + 8 * count])
+    size = len(data)
+    if not positions:
+        stat.fetch(term, size, False, time.perf_counter() - started)
+        return DocIdPostings(doc_ids, frequencies)
+    file = open(stream_file(path, term, 'pos'), mode='rb')
+    file.seek(4 * sum(data[4 + 4 * count:4 + 4 * count + 4 * n].cast('I')))
+    following = array('I', file.read())
+    file.close()
+    postings_list = []
+    offset = 0
+    for ID, frequency in zip(doc_ids, frequencies):
+        postings_list.append((ID, following[offset:offset + frequency].tolist()))
+        offset += frequency
+    stat.fetch(term, size + 4 * len(following), False, time.perf_counter() - started)
     return postings_list
 
+
+def positions_in(postings_list, ids):
+    """
+    Picks the positions of some documents out of a postings list.
+    :param postings_list: list of (ID, [pos1, pos2,...]) or packed_index.PackedPostings.
+    :param ids: integer DocIDs.
+    :return: dictionary {DocID: list of positions} of the documents that are in the postings list.
+    >>> positions_in([(2, [4]), (5, [1, 7]), (9, [3])], [5, 6])
+    {5: [1, 7]}
+    """
+    found = dict()
+    for ID in ids:
+        if isinstance(postings_list, list):
+            n = bisect_left(postings_list, ID, key=lambda posting: int(posting[0]))
+        else:
+            n = bisect_left(postings_list.doc_ids, ID)
+        if n < len(postings_list) and int(postings_list[n][0]) == ID:
+            found[ID] = list(postings_list[n][1])
+    return found
+
+
+def retrieve_positions(term, path, ids):
+    """
+    Retrieves the positions of a term in some documents only. The frequencies of the DocID stream give
+    the offset of every document in the positions stream, which is only read at the offsets of the documents.
+    :param term: the term.
+    :param path: postings path of the term.
+    :param ids: integer DocIDs.
+    :return: dictionary {DocID: list of positions} of the documents that contain the term.
+    """
+    if term in cache or not os.path.exists(stream_file(path, term, 'ids')):
+        return positions_in(retrieve(term, path), ids)
+    started = time.perf_counter()
+    doc_ids, frequencies, size = read_doc_ids(path, term)
+    numbers = []
+    for ID in ids:
+        n = bisect_left(doc_ids, ID)
+        if n < len(doc_ids) and doc_ids[n] == ID:
+            numbers.append(n)
+    found = dict()
+    offset = 0
+    previous = 0
+    file = open(stream_file(path, term, 'pos'), mode='rb')
+    for n in sorted(set(numbers)):
+        offset += sum(frequencies[previous:n])
+        previous = n
+        file.seek(4 * offset)
+        positions = array('I', file.read(4 * frequencies[n]))
+        size += 4 * len(positions)
+        found[doc_ids[n]] = positions.tolist()
+    file.close()
+    stat.fetch(term, size, False, time.perf_counter() - started)
+    return found
+
+
+def retrieve_tier(term, path):
+    """
+    Retrieves the first tier of a term. Lists without a tier file are short, so their tier is
+    the whole DocID stream.
+    :param term: the term.
+    :param path: postings path of the term.
+    :return: tuple (array of DocIDs, array of frequencies, highest frequency outside of the tier),
+    the best document first.
+    """
+    if term in cache or not os.path.exists(stream_file(path, term, 'top')):
+        postings_list = retrieve_doc_ids(term, path)
+        return tier_of(postings_list)
+    started = time.perf_counter()
+    file = open(stream_file(path, term, 'top'), mode='rb')
+    data = file.read()
+    file.close()
+    count, bound = struct.unpack_from('=II', data)
+    doc_ids = array('I', data[8:8 + 4 * count])
+    frequencies = array('I', data[8 + 4 * count:8 + 8 * count])
+    stat.fetch(term, len(data), False, time.perf_counter() - started)
+    return doc_ids, frequencies, bound
+
+
+def tier_of(postings_list):
+    """
+    :param postings_list: DocIdPostings or list of (ID, [pos1, pos2,...]).
+    :return: the first tier of the whole postings list, see first_tier.
+    """
+    if isinstance(postings_list, DocIdPostings):
+        return first_tier(postings_list.doc_ids, postings_list.frequencies, tier_size)
+    return first_tier([int(posting[0]) for posting in postings_list],
+                      [len(posting[1]) for posting in postings_list], tier_size)
+
+
+def document_count(term, path):
+    """
+    :param term: the term.
+    :param path: postings path of the term.
+    :return: number of documents in the postings list, read from the head of the DocID stream.
+    """
+    if not os.path.exists(stream_file(path, term, 'ids')):
+        return len(retrieve(term, path))
+    file = open(stream_file(path, term, 'ids'), mode='rb')
+    count, = struct.unpack('=I', file.read(4))
+    file.close()
+    return count
+
+
+def postings_size(term, path):
+    """
+    :param term: the term.
+    :param path: postings path of the term.
+    :return: size of the postings files of the term in bytes.
+    """
+    size = 0
+    for extension in ['ids', 'pos', 'top', 'dmp']:
+        if os.path.exists(stream_file(path, term, extension)):
+            size += os.path.getsize(stream_file(path, term, extension))
+    return size
+
+
+def fetch(term, ii):
+    """
+    Returns the postings list of a term from any kind of index. A regular Inverted Index maps
+    terms to postings paths, other indexes (e.g. packed_index.PackedIndex) retrieve postings themselves.
+    :param term: the term.
+    :param ii: the index to be used.
+    :return: postings list of the term. Raises KeyError if the term is not in the index.
+    """
+    if isinstance(ii, dict):
+        return retrieve(term, ii[term])
+    return ii.retrieve(term)
+
+
+def fetch_doc_ids(term, ii):
+    """
+    Returns the postings list of a term without positions from any kind of index, see fetch.
+    :param term: the term.
+    :param ii: the index to be used.
+    :return: postings list of the term whose position lists may be empty.
+    """
+    if isinstance(ii, dict):
+        return retrieve_doc_ids(term, ii[term])
+    return ii.retrieve_doc_ids(term)
+
+
+def fetch_from(term, ii, start, positions=True):
+    """
+    Returns the postings of a term from the first DocID which is not below start, from any kind of index,
+    see retrieve_from.
+    :param term: the term.
+    :param ii: the index to be used.
+    :param start: the lowest DocID to keep.
+    :param positions: if False, the position lists may be empty.
+    :return: postings list of the term from start on. Raises KeyError if the term is not in the index.
+    """
+    if isinstance(ii, dict):
+        return retrieve_from(term, ii[term], start, positions)
+    postings_list = ii.retrieve(term) if positions else ii.retrieve_doc_ids(term)
+    return postings_list[bisect_left(postings_list.doc_ids, start):]
+
+
+def fetch_positions(term, ii, ids):
+    """
+    Returns the positions of a term in some documents from any kind of index, see retrieve_positions.
+    :param term: the term.
+    :param ii: the index to be used.
+    :param ids: integer DocIDs.
+    :return: dictionary {DocID: list of positions} of the documents that contain the term.
+    """
+    if isinstance(ii, dict):
+        return retrieve_positions(term, ii[term], ids)
+    return positions_in(ii.retrieve(term), ids)
+
+
+def fetch_tier(term, ii):
+    """
+    Returns the first tier of a term from any kind of index, see retrieve_tier.
+    :param term: the term.
+    :param ii: the index to be used.
+    :return: tuple (array of DocIDs, array of frequencies, highest frequency outside of the tier).
+    """
+    if isinstance(ii, dict):
+        return retrieve_tier(term, ii[term])
+    return tier_of(ii.retrieve_doc_ids(term))
+
+
+def length(term, ii):
+    """
+    Number of documents in the postings list of a term, found without reading the postings list.
+    :param term: the term.
+    :param ii: the index to be used.
+    :return: the number of documents.
+    """
+    if not isinstance(ii, dict):
+        return len(ii.retrieve(term))
+    postings_list = cache.get(term)
+    if postings_list is not None:
+        return len(postings_list)
+    return document_count(term, ii[term])
+
+
+def disk_order(terms, ii):
+    """
+    Sorts terms by the on-disk location of their postings file, so that
+    reading them one after another is as sequential as possible.
+    Terms which are not in the index are left out.
+    :param terms: iterable of terms.
+    :param ii: Inverted Index mapping terms to postings paths.
+    :return: list of terms sorted by inode number.
+    """
+    located = []
+    for term in set(terms):
+        if term not in ii:
+            continue
+        if os.path.exists(stream_file(ii[term], term, 'ids')):
+            inode = os.stat(stream_file(ii[term], term, 'ids')).st_ino
+        else:
+            inode = os.stat(stream_file(ii[term], term, 'dmp')).st_ino
+        located.append((inode, term))
+    return [term for inode, term in sorted(located)]
+
+
+def preload(terms, ii, vocabulary=None, max_bytes=None):
+    """
+    Reads the postings lists of all given terms exactly once, in on-disk order,
+    and puts them into the cache.
+    :param terms: iterable of terms.
+    :param ii: Inverted Index mapping terms to postings paths.
+    :param vocabulary: optional Vocabulary, needed for max_bytes.
+    :param max_bytes: optional limit, terms whose postings files are larger are not preloaded.
+    :return: dictionary {term: postings list} of everything that was read.
+    """
+    fetched = dict()
+    if not isinstance(ii, dict):
+        # other indexes are already held in memory
+        return fetched
+    for term in disk_order(terms, ii):
+        if vocabulary is not None and max_bytes is not None and vocabulary.size_of(term) > max_bytes:
+            continue
+        fetched[term] = retrieve(term, ii[term])
+    cache.update(fetched)
+    return fetched
+
 def read_postings(path, term):
     """
     Function that reads the postings list of a given term
     """
-    os.chdir(path)
-    term = term +'$'
-    file = open(term + '.dmp', mode='r+b')
+    if os.path.exists(stream_file(path, term, 'ids')):
+        return read_streams(path, term)[0]
+    file = open(stream_file(path, term, 'dmp'), mode='r+b')
     postings_list = pickle.load(file)
     file.close()
-    directory = '..'+('/..'*(len(term)))
-    os.chdir(directory)
     return postings_list
-    
-    
+
+
 def write_postings(term, postings_list, casefold=True, nonumbers=True):
     """
     function that generates a folder for a particular term.
@@ -53,14 +558,7 @@ def write_postings(term, postings_list, casefold=True, nonumbers=True):
         except FileExistsError:
             os.chdir(term[:n])
     path = os.getcwd()
-    file = open(term + '.dmp', mode='wb')
-    pickle.dump(postings_list, file)
-    file.close()
+    write_streams(path, term[:-1], postings_list)
     directory = '..'+('/..'*(len(term)))
     os.chdir(directory)
     return path
-    
-    
-    
-
-
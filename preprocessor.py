@@ -1,22 +1,17 @@
 """
-The preprocessor takes the legal raw input data and returns a list that reflects default binding,
-which is then used to generate the parsing tree.
+The preprocessor takes the legal raw input data and builds the parsing tree with default binding.
+The query is split into tokens by the lexer and the tree is built by a precedence climbing parser,
+so that the cost grows linearly with the length of the query.
 """
 
-import re
 import doctest
+import lexer
+import statistics_container as stat
+from parse_tree import ParseTree, TreeElement
 
 
-def test_parentheses(input_string):
-    """
-    This function is supposed to take an input string and test whether the parenteses are already
-    set. If they are, it removes duplicate parentheses.
-    :param input_string: input_string.
-    :return: corrected string.
-    """
-    output_string = re.sub(r'\((\s*?|\s*?")AND\s+', '(', input_string)
-    output_string = re.sub(r'\s+AND(\s*?|\s*?")\)', ')', output_string)
-    return output_string
+# binding power of the operators: NOT binds weakest, then OR, AND, NEAR, and WITHIN strongest.
+binding_power = {'NOT': 1, 'OR': 2, 'AND': 3, 'NEAR': 4, 'WITHIN': 5}
 
 
 def normalize_input(query_input):
@@ -33,167 +28,178 @@ def normalize_input(query_input):
     >>> normalize_input('word1 &word2 ~ word3|word4 &  word5&word6| word7 WITHIN15 word8  "word9 word10"')
     'word1 AND word2 NOT word3 OR word4 AND word5 AND word6 OR word7 WITHIN15 word8 AND "word9 word10"'
     """
-    # remove trailing spaces
-    query_input = query_input.strip()
-
-    # expand whitespaces around parentheses
-    query_parentheses = re.sub(r'\(', '( ', query_input)
-    query_parentheses = re.sub(r'\)', ' )', query_parentheses)
-
-    # replace all commas and | by OR, replace all ~ and BUT NOT by NOT and all & by AND.
-    not_regex = re.compile(r'\s*(?P<not_op>~|BUT\sNOT|NOT)\s*')
-    or_regex = re.compile(r'\s*(?P<or_op>\||,|OR)\s*')
-    and_regex = re.compile(r'\s*(?P<and_op>\&|AND)\s*')
-    query_not = re.sub(not_regex, ' NOT ', query_parentheses)
-    query_or = re.sub(or_regex, ' OR ', query_not)
-    query_and = re.sub(and_regex, ' AND ', query_or)
-
-    # replace all WITHINn and NEARn by the same but with whitespace around it.
-    for match in re.findall(r'NEAR\d{1,3}', query_and):
-        query_and = query_and.replace(match, ' NEAR' + re.search(r'\d+', match).group() + ' ')
-    for match in re.findall(r'WITHIN\d{1,3}', query_and):
-        query_and = query_and.replace(match, ' WITHIN' + re.search(r'\d+', match).group() + ' ')
-
-    # make all whitespaces single
-    query_whitespaced = re.sub(r'\s\s+', ' ', query_and)
-
-    # replace whitespaces between search words by AND except for exact phrases
-    big_and_regex = re.compile(
-        r'((?<!AND)(?<!OR)(?<!NOT)(?<!NEAR\d)(?<!NEAR\d\d)'
-        r'(?<!NEAR\d\d\d)(?<!WITHIN\d)(?<!WITHIN\d\d)(?<!WITHIN\d\d\d)(?<!\()(?<!\))\s+'
-        r'(?!\))(?!\()(?!AND)(?!OR)(?!NOT)(?!NEAR\d)(?!NEAR\d\d)'
-        r'(?!NEAR\d\d\d)(?!WITHIN\d)(?!WITHIN\d\d)(?!WITHIN\d\d\d))')
-    query_big_and = " ".join([re.sub(big_and_regex, ' AND ', x)
-                              if re.split(r'"', query_whitespaced).index(x) % 2 == 0
-                              else '"' + x + '"'
-                              for x in re.split(r'"', query_whitespaced)])
-
-    # finish by making whitespaces single again and remove trailing whitespaces
-    query_final = re.sub(r'\s\s+', ' ', query_big_and)
-    query_final = query_final.strip()
-
-    return query_final
-
-
-def binding(query):
-    """
-    This function takes the normalized query and returns a string with default binding.
-    :param query: normalized query
-    :return: normalized query with parentheses set to default binding.
-    """
-    if 'NOT' in query:
-        num = query.find('NOT')
-        query = '( ' + binding(query[:num - 1]) + ' )' + ' NOT ' + '( ' + binding(query[num + 4:]) + ' )'
-        return query
-    elif 'OR' in query:
-        num = query.find('OR')
-        query = '( ' + binding(query[:num - 1]) + ' )' + ' OR ' + '( ' + binding(query[num + 3:]) + ' )'
-        return query
-    elif 'AND' in query:
-        num = query.find('AND')
-        query = '( ' + binding(query[:num - 1]) + ' )' + ' AND ' + '( ' + binding(query[num + 4:]) + ' )'
-        return query
-    elif 'NEAR' in query:
-        num = query.find('NEAR')
-        near_num = re.search(r'(?<=NEAR)\d+(?=\s)', query).group()
-        near_dist = len(near_num)
-        query = '( ' + binding(query[:num - 1]) + ' )' + ' NEAR' + near_num + ' ( ' + binding(
-            query[num + 5 + near_dist:]) + ' )'
-        return query
-    elif 'WITHIN' in query:
-        num = query.find('WITHIN')
-        within_num = re.search(r'(?<=WITHIN)\d+(?=\s)', query).group()
-        within_dist = len(within_num)
-        query = '( ' + binding(query[:num - 1]) + ' )' + ' WITHIN' + within_num + ' ( ' + binding(
-            query[num + 7 + within_dist:]) + ' )'
-        return query
-    else:
-        return '&' + query + '&'
-
-
-def binding_main(query):
-    query = binding(query)
-    query = re.sub(r'\(\s&|&\s\)', '', query)
-    return query
-
-
-def alternate_binding(input_string):
-    """
-    This function takes the input string and checks whether parentheses are already set.
-    If there are it conducts the default binding in such a way that the preferred binding
-    is not changed. Otherwise it simply returns the default binding.
-    :param input_string: Normalized query of type string.
-    :return: Query with correct binding of type string.
-    """
-    plevel = 0
-    opindex = []
-    cpindex = []
-    index_pairs = []
-    strc = 0
-    # First, we count how many opening and closing parentheses are on a given level.
-    # In a string such as (...)...(..(...)..) we have two parentheses pairs on the highest level
-    # and one within two parentheses, i.e. a lower level.
-    while strc < len(input_string):
-        if input_string[strc] == '(':
-            plevel += 1
-            if plevel == 1:
-                opindex.append(strc)
-        if input_string[strc] == ')':
-            plevel -= 1
-            if plevel == 0:
-                cpindex.append(strc)
-                index_pairs.append((opindex[0], cpindex[-1]))
-                opindex = opindex[1:]
-                cpindex = cpindex[:-1]
-        strc += 1
-    # if the loop does not count any parentheses on a given level, it returns the default binding.
-    if not index_pairs:
-        result_string = binding_main(input_string)
-    # else it recursively calls alternate_binding on all strings within the parentheses.
-    else:
-        q_terms = []
-        result_string = ''
-        start = 0
-        for pair in index_pairs:
-            result_string += input_string[start:pair[0] + 2]
-            alternate_string = alternate_binding(input_string[pair[0] + 2:pair[1] - 1])
-            q_terms.append(['( ' + alternate_string + ' )', len(alternate_string) + 4])
-            result_string += alternate_string
-            start = pair[1] - 1
-        result_string += input_string[start:]
-        for term in q_terms:
-            # In a string like ...(...)... the parentheses and everything within
-            # is replaced by #. Default binding is done on the resulting string.
-            result_string = result_string.replace(term[0], '#' * term[1])
-        result_string = binding_main(result_string)
-        for term in q_terms:
-            # Finally the original string is put back in place.
-            result_string = result_string.replace('#' * term[1], term[0], 1)
-    return result_string
-
-
-def generate_list(query):
-    """
-    This function takes the input with parentheses and gives back a list for further use by the ParseTree.
-    :param query: normalized query with correct binding.
+    return ' '.join(value for kind, value, offset in lexer.insert_default_and(lexer.tokenize(query_input)))
+
+
+class ParseError(ValueError):
+    """
+    Raised for a query the parser cannot build a tree from, offset is its position in the raw query.
+    """
+    def __init__(self, message, offset):
+        ValueError.__init__(self, message)
+        self.offset = offset
+
+
+def operator_power(token):
+    """
+    :param token: a token or None at the end of the query.
+    :return: binding power of the token if it is an operator, otherwise 0.
+    """
+    if token is None or token[0] != lexer.OPERATOR:
+        return 0
+    return binding_power[token[1].rstrip('0123456789')]
+
+
+def join(operator, left, right):
+    """
+    :param operator: key of the new inner node.
+    :param left: TreeElement of the left operand.
+    :param right: TreeElement of the right operand.
+    :return: new TreeElement with the operands as children.
+    """
+    node = TreeElement(operator, left=left, right=right)
+    left.parent = node
+    right.parent = node
+    return node
+
+
+def balanced(operator, operands):
+    """
+    Joins a chain of operands of an associative operator into a balanced tree.
+    :param operator: AND or OR.
+    :param operands: list of TreeElements.
+    :return: TreeElement of the root.
+    """
+    if len(operands) == 1:
+        return operands[0]
+    middle = len(operands) // 2
+    return join(operator, balanced(operator, operands[:middle]), balanced(operator, operands[middle:]))
+
+
+class Parser:
+    """
+    Precedence climbing parser which builds the Parse Tree directly from the tokens of a query.
+    Each binding power is parsed as a chain of operands of the next stronger power, so that
+    the recursion depth only depends on the nesting of parentheses, not on the length of the query.
+    NOT, NEAR and WITHIN chains are bound to the right (a NOT b NOT c becomes a NOT (b NOT c)),
+    AND and OR chains are bound as balanced trees, which gives the same result.
+    """
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.index = 0
+
+    def peek(self):
+        if self.index < len(self.tokens):
+            return self.tokens[self.index]
+        return None
+
+    def advance(self):
+        token = self.tokens[self.index]
+        self.index += 1
+        return token
+
+    def expression(self, power):
+        """
+        Parses a chain of operands joined by operators of the given binding power.
+        :param power: the binding power, 1 (NOT) to 5 (WITHIN).
+        :return: the TreeElement of the expression.
+        """
+        if power > max(binding_power.values()):
+            return self.operand()
+        operands = [self.expression(power + 1)]
+        operators = []
+        while operator_power(self.peek()) == power:
+            operators.append(self.advance()[1])
+            operands.append(self.expression(power + 1))
+        if operators and operators[0] in ('AND', 'OR'):
+            return balanced(operators[0], operands)
+        node = operands[-1]
+        for operator, operand in zip(reversed(operators), reversed(operands[:-1])):
+            node = join(operator, operand, node)
+        return node
+
+    def operand(self):
+        """
+        Parses a word, an exact phrase or an expression in parentheses.
+        :return: the TreeElement of the operand.
+        """
+        token = self.peek()
+        if token is None:
+            raise ParseError("Query ends where a search word was expected",
+                             self.tokens[-1][2] if self.tokens else 0)
+        self.advance()
+        if token[0] in (lexer.WORD, lexer.PHRASE):
+            return TreeElement(token[1])
+        if token[0] == lexer.OPEN:
+            node = self.expression(1)
+            if self.peek() is None or self.peek()[0] != lexer.CLOSE:
+                raise ParseError("Parenthesis at {} is not closed".format(token[2]), token[2])
+            self.advance()
+            return node
+        raise ParseError("Unexpected {} at {}".format(token[1], token[2]), token[2])
+
+
+def parse_tokens(tokens):
+    """
+    Builds the Parse Tree from a list of tokens.
+    :param tokens: list of tokens as returned by lexer.tokenize.
+    :return: ParseTree whose current node is the root of the query.
+    """
+    with stat.stage('parse tree'):
+        parser = Parser(lexer.insert_default_and(tokens))
+        root = parser.expression(1)
+        if parser.peek() is not None:
+            raise ParseError("Unexpected {} at {}".format(parser.peek()[1], parser.peek()[2]), parser.peek()[2])
+    tree = ParseTree()
+    tree.root = root
+    tree.current = root
+    return tree
+
+
+def parse(query):
+    """
+    Tokenizes the query and builds the Parse Tree from it, both in linear time.
+    :param query: the raw query.
+    :return: ParseTree whose current node is the root of the query.
+    >>> print(parse('w1 | w2 w3 ~ w4'))
+    [[[None, 'w1', None], 'OR', [[None, 'w2', None], 'AND', [None, 'w3', None]]], 'NOT', [None, 'w4', None]]
+    >>> print(parse('(w1 | w2) NEAR3 "w3 w4"'))
+    [[[None, 'w1', None], 'OR', [None, 'w2', None]], 'NEAR3', [None, '"w3 w4"', None]]
+    >>> print(parse('w1 WITHIN5 w2 NEAR3 w3'))
+    [[[None, 'w1', None], 'WITHIN5', [None, 'w2', None]], 'NEAR3', [None, 'w3', None]]
+    >>> print(parse('w1 NEAR3 w2 WITHIN5 w3'))
+    [[None, 'w1', None], 'NEAR3', [[None, 'w2', None], 'WITHIN5', [None, 'w3', None]]]
+    """
+    return parse_tokens(lexer.tokenize(query))
+
+
+def tree_to_list(node):
+    """
+    Writes a Parse Tree as list with explicit parentheses.
+    :param node: TreeElement.
     :return: List containing as elements parentheses, words, exact phrases and operators.
     """
-    result_list = []
-    temp_list = [x.split()
-                 if re.split(r'"', query).index(x) % 2 == 0
-                 else ['"' + x + '"']
-                 for x
-                 in re.split(r'"', query)]
-    for x in temp_list:
-        result_list += x
-    return result_list
+    if node.left is None:
+        return [node.key]
+    result = []
+    for child, following in [(node.left, [node.key]), (node.right, [])]:
+        if child.left is None:
+            result += tree_to_list(child)
+        else:
+            result += ['('] + tree_to_list(child) + [')']
+        result += following
+    return result
 
 
 def run(query):
-    normalized_query = normalize_input(query)
-    binding_query = alternate_binding(normalized_query)
-    query_list = generate_list(binding_query)
-    return query_list
+    """
+    This function takes the raw query and returns a list with default binding for the ParseTree.
+    :param query: the raw query.
+    :return: List containing as elements parentheses, words, exact phrases and operators.
+    >>> run('w1 w2 w3')
+    ['w1', 'AND', '(', 'w2', 'AND', 'w3', ')']
+    """
+    return tree_to_list(parse(query).current)
 
 
 if __name__ == '__main__':
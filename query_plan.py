@@ -0,0 +1,458 @@
+"""
+Compiled query plans.
+A Parse Tree is compiled once into a flat list of typed steps in post order, with the terms resolved
+against the index, the distances of NEAR and WITHIN parsed and the number of results of every step
+estimated from document frequencies. Wherever no positions are needed, terms are read from their DocID
+stream only, and very frequent terms which have a bitmap are evaluated as bitmaps. A plan can be executed any number of times, and explain()
+shows the estimated against the actual number of results and the time of every step.
+"""
+import time
+import weakref
+from array import array
+from collections import OrderedDict
+import bitmap
+import budget
+import postings
+import preprocessor
+import searcher
+import statistics_container as stat
+
+# compiled plans {index: {query string: Plan}}, see compile_query. The index object itself is the key,
+# held weakly, so that the plans go away with their index and are never served for another one.
+plans = weakref.WeakKeyDictionary()
+# plans of indexes which cannot be weakly referenced, e.g. a plain dict: {id(index): (index, {query string: Plan})}.
+# The index is held with its plans, so that its id cannot be given to another object in the meantime, but only
+# for the max_held indexes used last, so that replaced indexes and their plans do not stay alive.
+held_plans = OrderedDict()
+max_held = 4
+# the plan that was executed last.
+last = None
+# the plans of an index are emptied once there are more than this.
+max_plans = 10000
+# if set, terms which have a bitmap are evaluated as bitmaps wherever no positions are needed.
+use_bitmaps = True
+
+
+def document_frequency(term, ii, frequencies=None):
+    """
+    Estimates in how many documents a term occurs.
+    :param term: the term.
+    :param ii: the index to be used.
+    :param frequencies: optional dictionary {term: frequency}, e.g. the counting index, or a Vocabulary.
+    :return: the estimate, or None if nothing is known about the term.
+    """
+    if term not in ii:
+        return 0
+    if hasattr(frequencies, 'document_frequency'):
+        return frequencies.document_frequency(term)
+    if frequencies is not None:
+        return frequencies.get(term, 0)
+    if hasattr(ii, 'posting_starts'):
+        # the packed index knows the exact length of every postings list
+        n = ii.find(term)
+        return ii.posting_starts[n + 1] - ii.posting_starts[n]
+    return None
+
+
+class Step:
+    """
+    A single step of a plan. Its inputs are the numbers of earlier steps.
+    """
+    name = ''
+
+    def __init__(self, inputs=()):
+        self.inputs = inputs
+        self.label = ''
+        # set if an operator above the step needs positions
+        self.positional = False
+        self.estimate = None
+        self.actual = None
+        self.time = None
+
+    def estimate_from(self, estimates):
+        """
+        :param estimates: estimates of the inputs.
+        :return: estimated number of results, None if any input is unknown.
+        """
+        return None
+
+    def evaluate(self, results, labels, ii):
+        """
+        :param results: results of the inputs.
+        :param labels: String representations of the inputs.
+        :param ii: the index to be used.
+        :return: DocID list of the step.
+        """
+        raise NotImplementedError
+
+
+class Term(Step):
+    """
+    Fetches the postings list of a single term.
+    """
+    name = 'TERM'
+
+    def __init__(self, term, ii, frequencies=None):
+        Step.__init__(self)
+        self.term = term
+        self.label = term
+        # the postings path of a regular index, the term number of a packed index
+        if term not in ii:
+            self.location = None
+        elif isinstance(ii, dict):
+            self.location = ii[term]
+        else:
+            self.location = ii.find(term)
+        self.estimate = document_frequency(term, ii, frequencies)
+
+    def evaluate(self, results, labels, ii):
+        started = time.perf_counter()
+        if self.location is None:
+            print("'{}' cannot be found".format(self.term))
+            postings_list = []
+        elif isinstance(ii, dict):
+            postings_list = postings.retrieve(self.term, self.location)
+        else:
+            postings_list = ii.retrieve(self.term)
+        searcher.record(self.label, postings_list, started)
+        return postings_list
+
+
+class DocIdTerm(Term):
+    """
+    Fetches the postings list of a term from its DocID stream, without positions.
+    """
+    name = 'DOCIDS'
+
+    def evaluate(self, results, labels, ii):
+        started = time.perf_counter()
+        if self.location is None:
+            print("'{}' cannot be found".format(self.term))
+            postings_list = []
+        elif isinstance(ii, dict):
+            postings_list = postings.retrieve_doc_ids(self.term, self.location)
+        else:
+            postings_list = ii.retrieve_doc_ids(self.term)
+        searcher.record(self.label, postings_list, started)
+        return postings_list
+
+
+class BitmapTerm(Term):
+    """
+    Fetches the bitmap of a very frequent term instead of its postings list.
+    """
+    name = 'BITMAP'
+
+    def evaluate(self, results, labels, ii):
+        started = time.perf_counter()
+        result = bitmap.retrieve(self.term, self.location)
+        searcher.record(self.label, result, started)
+        return result
+
+
+class Phrase(Step):
+    """
+    Searches an exact phrase.
+    """
+    name = 'PHRASE'
+
+    def __init__(self, words, ii, frequencies=None):
+        Step.__init__(self)
+        self.words = words
+        self.label = '"' + ' '.join(words) + '"'
+        estimates = [document_frequency(word, ii, frequencies) for word in words]
+        self.estimate = None if None in estimates else min(estimates)
+
+    def evaluate(self, results, labels, ii):
+        return searcher.exact_phrase(self.words, ii)[0]
+
+
+class And(Step):
+    """
+    Intersection of the two inputs.
+    """
+    name = 'AND'
+
+    def estimate_from(self, estimates):
+        return min(estimates)
+
+    def evaluate(self, results, labels, ii):
+        if isinstance(results[0], bitmap.Bitmap) or isinstance(results[1], bitmap.Bitmap):
+            return searcher.bitmap_operation(results[0], results[1], labels[0], labels[1], 'AND')[0]
+        return searcher.intersect(results[0], results[1], labels[0], labels[1])[0]
+
+
+class Or(Step):
+    """
+    Union of the two inputs.
+    """
+    name = 'OR'
+
+    def estimate_from(self, estimates):
+        return sum(estimates)
+
+    def evaluate(self, results, labels, ii):
+        if isinstance(results[0], bitmap.Bitmap) or isinstance(results[1], bitmap.Bitmap):
+            return searcher.bitmap_operation(results[0], results[1], labels[0], labels[1], 'OR')[0]
+        return searcher.union(results[0], results[1], labels[0], labels[1])[0]
+
+
+class Not(Step):
+    """
+    Complement of the second input in regards to the first input.
+    """
+    name = 'NOT'
+
+    def estimate_from(self, estimates):
+        return estimates[0]
+
+    def evaluate(self, results, labels, ii):
+        if isinstance(results[0], bitmap.Bitmap) or isinstance(results[1], bitmap.Bitmap):
+            return searcher.bitmap_operation(results[0], results[1], labels[0], labels[1], 'NOT')[0]
+        return searcher.complement(results[0], results[1], labels[0], labels[1])[0]
+
+
+class Near(Step):
+    """
+    Proximity search, the order of the inputs doesn't matter.
+    """
+    name = 'NEAR'
+    option = 'near'
+
+    def __init__(self, distance, inputs=()):
+        Step.__init__(self, inputs)
+        self.distance = distance
+
+    def estimate_from(self, estimates):
+        return min(estimates)
+
+    def evaluate(self, results, labels, ii):
+        return searcher.proximity(results[0], results[1], labels[0], labels[1],
+                                  options=self.option, distance=self.distance)[0]
+
+
+class Within(Near):
+    """
+    Proximity search, the first input has to come first.
+    """
+    name = 'WITHIN'
+    option = 'within'
+
+
+operators = {'AND': And, 'OR': Or, 'NOT': Not}
+
+
+class Plan:
+    """
+    A compiled query: the steps in post order, the last step gives the result.
+    """
+    def __init__(self, query):
+        self.query = query
+        self.steps = []
+
+    def add(self, step):
+        self.steps.append(step)
+        return len(self.steps) - 1
+
+    def execute(self, ii):
+        """
+        Runs all steps of the plan.
+        :param ii: the index the plan was compiled for.
+        :return: List of DocID tuples with list of positions (ID, [pos1, pos2,...]) and the stats.
+        """
+        global last
+        last = self
+        searcher.stats.clear()
+        results = []
+        # steps whose result may be incomplete because the query ran out of budget
+        partial = set()
+        with stat.stage('evaluation'):
+            for n, step in enumerate(self.steps):
+                budget.check()
+                started = time.perf_counter()
+                if isinstance(step, Not) and step.inputs[1] in partial:
+                    # removing an incomplete result could keep documents that have to be removed
+                    result = []
+                else:
+                    result = step.evaluate([results[n] for n in step.inputs],
+                                           [self.steps[n].label for n in step.inputs], ii)
+                step.time = time.perf_counter() - started
+                step.actual = len(result)
+                results.append(result)
+                if budget.truncated():
+                    partial.add(n)
+        return searcher.materialize(results[-1]), searcher.stats
+
+    def exists(self, ii):
+        """
+        Checks whether the plan has any result, see count. An AND as the last step stops at its first result.
+        :param ii: the index the plan was compiled for.
+        :return: True if there is at least one result.
+        """
+        return self.count(ii, first_only=True) > 0
+
+    def count(self, ii, first_only=False):
+        """
+        Computes the number of results without building the result list. A single term is answered from
+        its document frequency, AND, OR and NOT which need no positions work on DocIDs or Bitmaps only,
+        and the last of them only counts. Steps that need positions are evaluated as usual.
+        :param ii: the index the plan was compiled for.
+        :param first_only: if set, the last step only has to tell whether there is any result, see exists.
+        :return: the number of results.
+        """
+        global last
+        last = self
+        searcher.stats.clear()
+        results = []
+        with stat.stage('evaluation'):
+            for n, step in enumerate(self.steps):
+                budget.check()
+                started = time.perf_counter()
+                if isinstance(step, Term) and len(self.steps) == 1:
+                    # the document frequency is stored at the head of the DocID stream
+                    result = 0 if step.location is None else postings.length(step.term, ii)
+                elif step.name in operators and not step.positional:
+                    last_step = n == len(self.steps) - 1
+                    result = searcher.id_operation(ids_of(results[step.inputs[0]]), ids_of(results[step.inputs[1]]),
+                                                   step.name, count_only=last_step, first_only=first_only and last_step)
+                else:
+                    result = step.evaluate([results[i] for i in step.inputs],
+                                           [self.steps[i].label for i in step.inputs], ii)
+                step.time = time.perf_counter() - started
+                step.actual = result if isinstance(result, int) else len(result)
+                results.append(result)
+        return results[-1] if isinstance(results[-1], int) else len(results[-1])
+
+
+def ids_of(result):
+    """
+    :param result: result of a step.
+    :return: the result as Bitmap or as sorted sequence of integer DocIDs.
+    """
+    if isinstance(result, (bitmap.Bitmap, array)):
+        return result
+    return searcher.doc_ids(result)
+
+
+def compile_node(plan, node, ii, frequencies=None, positional=False):
+    """
+    Adds the steps of a subtree to a plan.
+    :param plan: the Plan.
+    :param node: TreeElement.
+    :param ii: the index to be used.
+    :param frequencies: optional dictionary {term: frequency} for the estimates.
+    :param positional: True if an operator above the subtree needs positions (NEAR, WITHIN).
+    :return: number of the step which gives the result of the subtree.
+    """
+    if node.left is None:
+        if node.key.startswith('"'):
+            step = Phrase(node.key[1:-1].split(), ii, frequencies)
+        elif use_bitmaps and not positional and isinstance(ii, dict) and node.key in ii \
+                and bitmap.exists(node.key, ii[node.key]):
+            step = BitmapTerm(node.key, ii, frequencies)
+        elif not positional:
+            step = DocIdTerm(node.key, ii, frequencies)
+        else:
+            step = Term(node.key, ii, frequencies)
+        step.positional = positional
+        return plan.add(step)
+    positional = positional or node.key.startswith('NEAR') or node.key.startswith('WITHIN')
+    inputs = (compile_node(plan, node.left, ii, frequencies, positional),
+              compile_node(plan, node.right, ii, frequencies, positional))
+    if node.key in operators:
+        step = operators[node.key](inputs)
+    elif node.key.startswith('NEAR'):
+        step = Near(int(node.key[4:]), inputs)
+    else:
+        step = Within(int(node.key[6:]), inputs)
+    step.positional = positional
+    labels = [plan.steps[n].label for n in inputs]
+    # same String representation as the one used by the searcher for the stats
+    step.label = '(' + labels[0] + (' BUT NOT ' if node.key == 'NOT' else ' ' + node.key + ' ') + labels[1] + ')'
+    estimates = [plan.steps[n].estimate for n in inputs]
+    if None not in estimates:
+        step.estimate = step.estimate_from(estimates)
+    return plan.add(step)
+
+
+def compile_tree(query, tree, ii, frequencies=None):
+    """
+    Compiles a Parse Tree into a plan.
+    :param query: The search string.
+    :param tree: ParseTree of the query.
+    :param ii: the index to be used.
+    :param frequencies: optional dictionary {term: frequency} for the estimates.
+    :return: Plan.
+    """
+    plan = Plan(query)
+    # a query of a single term returns its postings list with positions
+    compile_node(plan, tree.current, ii, frequencies, positional=tree.current.left is None)
+    return plan
+
+
+def plans_of(ii):
+    """
+    :param ii: the index.
+    :return: dictionary {query string: Plan} of the plans compiled against the index.
+    >>> index = dict()
+    >>> plans_of(index) is plans_of(index), plans_of(dict()) is plans_of(dict())
+    (True, False)
+    >>> others = [{term: ''} for term in range(max_held)]
+    >>> len([plans_of(other) for other in others]) == len(held_plans), id(index) in held_plans
+    (True, False)
+    """
+    try:
+        return plans.setdefault(ii, dict())
+    except TypeError:
+        pass
+    entry = held_plans.get(id(ii))
+    if entry is None or entry[0] is not ii:
+        entry = held_plans[id(ii)] = (ii, dict())
+    held_plans.move_to_end(id(ii))
+    while len(held_plans) > max_held:
+        held_plans.popitem(last=False)
+    return entry[1]
+
+
+def clear():
+    """
+    Drops all compiled plans, which has to be done when an index is changed in place.
+    :return: None.
+    """
+    plans.clear()
+    held_plans.clear()
+
+
+def compile_query(query, tokens, ii, frequencies=None):
+    """
+    Returns the plan of a query, compiling it only the first time the query is seen with the same index object.
+    :param query: The search string.
+    :param tokens: tokens of the query as returned by error_catcher.validate.
+    :param ii: the index to be used.
+    :param frequencies: optional dictionary {term: frequency} for the estimates.
+    :return: Plan.
+    """
+    index_plans = plans_of(ii)
+    if query not in index_plans:
+        if len(index_plans) >= max_plans:
+            index_plans.clear()
+        index_plans[query] = compile_tree(query, preprocessor.parse_tokens(tokens), ii, frequencies)
+    return index_plans[query]
+
+
+def explain(plan):
+    """
+    Describes a plan, with the actual number of results and times if it was executed.
+    :param plan: Plan.
+    :return: String with one line per step.
+    """
+    lines = ['{:>4}  {:<8} {:>10} {:>10} {:>10}  {}'.format('step', 'operator', 'estimated', 'actual',
+                                                          'time ms', 'expression')]
+    for n, step in enumerate(plan.steps):
+        lines.append('{:>4}  {:<8} {:>10} {:>10} {:>10}  {}'.format(
+            n, step.name,
+            '?' if step.estimate is None else step.estimate,
+            '-' if step.actual is None else step.actual,
+            '-' if step.time is None else '{:.3f}'.format(step.time * 1000),
+            step.label))
+    return '\n'.join(lines)
@@ -0,0 +1,122 @@
+"""
+Ranked search for a single term or terms joined by AND or OR. The score of a document is the number of
+matching positions, i.e. the sum of the frequencies of the query terms; shards rank with it as well.
+The first tiers of the postings lists (see postings.first_tier) hold the documents with the highest
+frequency of every term and a bound on the frequency of all other documents. The best k documents are
+taken from the tiers alone whenever no document outside of them can beat the k-th best; otherwise the
+DocID streams of the terms are read in full, still without any positions.
+"""
+import heapq
+import re
+import postings
+import statistics_container as stat
+
+
+def parse(query):
+    """
+    :param query: The search string.
+    :return: tuple (operator, list of terms), None if the query is not a single term or terms joined by
+    the same operator, AND or OR.
+    >>> parse('the OR of OR a'), parse('the'), parse('the AND of OR a'), parse('"of the"')
+    (('OR', ['the', 'of', 'a']), ('AND', ['the']), None, None)
+    """
+    words = query.split()
+    terms = words[::2]
+    operators = set(words[1::2])
+    if len(words) % 2 == 0 or len(operators) > 1 or not operators <= {'AND', 'OR'}:
+        return None
+    if not all(re.fullmatch(r'\w+', term) and term not in ('AND', 'OR') for term in terms):
+        return None
+    return operators.pop() if operators else 'AND', terms
+
+
+def from_tiers(tiers, operator, k):
+    """
+    Finds the best k documents from the first tiers only, if that is possible.
+    :param tiers: list of tuples (DocIDs, frequencies, highest frequency outside of the tier), one per term.
+    :param operator: AND or OR.
+    :param k: number of results.
+    :return: list of tuples (ID, score), the best first, or None if the tiers cannot guarantee the best k.
+    >>> from_tiers([([4, 2], [9, 3], 1), ([4], [2], 0)], 'AND', 2)
+    [(4, 11)]
+    >>> from_tiers([([4, 2], [9, 3], 3), ([4, 2], [2, 1], 1)], 'AND', 2) is None
+    True
+    """
+    if len(tiers) == 1 and (k <= len(tiers[0][0]) or tiers[0][2] == 0):
+        # a tier is ordered like the results, so a single term needs no scoring at all
+        return list(zip(tiers[0][0][:k], tiers[0][1][:k]))
+    known = dict()
+    for n, (doc_ids, frequencies, bound) in enumerate(tiers):
+        for ID, frequency in zip(doc_ids, frequencies):
+            known.setdefault(ID, [None] * len(tiers))[n] = frequency
+    bounds = [tier[2] for tier in tiers]
+    # best score a document which is in no tier can reach. A tier which holds the whole
+    # postings list has a bound of 0, so for AND nothing outside of it can match at all.
+    ceiling = 0 if operator == 'AND' and 0 in bounds else sum(bounds)
+    exact = []
+    for ID, frequencies in known.items():
+        missing = [bounds[n] for n, frequency in enumerate(frequencies) if frequency is None]
+        if operator == 'AND' and 0 in missing:
+            continue
+        found = sum(frequency for frequency in frequencies if frequency is not None)
+        if sum(missing) == 0:
+            exact.append((found, -ID))
+        else:
+            ceiling = max(ceiling, found + sum(missing))
+    best = heapq.nlargest(k, exact)
+    if ceiling == 0 or (len(best) == k and best[-1][0] > ceiling):
+        return [(-ID, found) for found, ID in best]
+    return None
+
+
+def from_postings(postings_lists, operator, k):
+    """
+    Finds the best k documents from the whole postings lists.
+    :param postings_lists: list of DocIdPostings or postings lists, one per term.
+    :param operator: AND or OR.
+    :param k: number of results.
+    :return: list of tuples (ID, score), the best first.
+    >>> from_postings([[(1, [3, 7]), (2, [1])], [(2, [4, 5])]], 'OR', 2)
+    [(2, 3), (1, 2)]
+    """
+    scores = dict()
+    hits = dict()
+    for postings_list in postings_lists:
+        if isinstance(postings_list, postings.DocIdPostings):
+            pairs = zip(postings_list.doc_ids, postings_list.frequencies)
+        else:
+            pairs = ((int(posting[0]), len(posting[1])) for posting in postings_list)
+        for ID, frequency in pairs:
+            scores[ID] = scores.get(ID, 0) + frequency
+            hits[ID] = hits.get(ID, 0) + 1
+    if operator == 'AND':
+        matches = (ID for ID in scores if hits[ID] == len(postings_lists))
+    else:
+        matches = iter(scores)
+    best = heapq.nlargest(k, ((scores[ID], -ID) for ID in matches))
+    return [(-ID, found) for found, ID in best]
+
+
+def search(query, ii, k=10):
+    """
+    :param query: The search string, a single term or terms joined by AND or OR.
+    :param ii: the index to be used.
+    :param k: number of results.
+    :return: list of tuples (ID, score), the best first, None if the query is not supported.
+    """
+    parsed = parse(query.strip())
+    if parsed is None:
+        return None
+    operator, terms = parsed
+    if operator == 'AND' and any(term not in ii for term in terms):
+        return []
+    terms = [term for term in terms if term in ii]
+    if not terms:
+        return []
+    with stat.stage('ranking'):
+        best = from_tiers([postings.fetch_tier(term, ii) for term in terms], operator, k)
+        if best is not None:
+            stat.count('answered from tiers')
+            return best
+        stat.count('read in full')
+        return from_postings([postings.fetch_doc_ids(term, ii) for term in terms], operator, k)
@@ -0,0 +1,80 @@
+"""
+Replays a query log against main.run_main for load tests.
+The queries are sent to a pool of worker processes, either flat out or at a target rate.
+The report holds the throughput and two kinds of latency percentiles:
+- service latency: the time run_main took in the worker,
+- response latency: the time from the moment the query was due until its answer arrived,
+  which includes the time it waited for a free worker.
+
+Usage: python replay.py queries.log [--qps 50] [--workers 4] [--packed index.pack]
+"""
+import json
+import sys
+import time
+from multiprocessing import Pool
+import benchmark
+import main
+import packed_index
+import statistics_container as stat
+
+
+def _replay_worker(query):
+    """
+    Runs a single query inside a worker process.
+    :param query: The search string.
+    :return: tuple (seconds run_main took, True if the query was valid).
+    """
+    started = time.perf_counter()
+    answer = main.run_main(query, main.batch_index)
+    return time.perf_counter() - started, answer is not None
+
+
+def replay(queries, ii, qps=None, workers=1):
+    """
+    Replays queries and measures throughput and latency.
+    :param queries: list of search strings.
+    :param ii: the index to be used.
+    :param qps: target queries per second, None runs the queries as fast as possible.
+    :param workers: number of worker processes.
+    :return: dictionary with the measurements.
+    """
+    service = []
+    response = []
+    invalid = []
+
+    def done(scheduled):
+        def callback(answer):
+            response.append(time.perf_counter() - scheduled)
+            service.append(answer[0])
+            if not answer[1]:
+                invalid.append(1)
+        return callback
+
+    with Pool(workers, initializer=main._batch_worker_init, initargs=(main.worker_index(ii),)) as pool:
+        started = time.perf_counter()
+        pending = []
+        for n, query in enumerate(queries):
+            scheduled = started + n / qps if qps else time.perf_counter()
+            wait = scheduled - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            pending.append(pool.apply_async(_replay_worker, (query,), callback=done(scheduled)))
+        for result in pending:
+            result.wait()
+        seconds = time.perf_counter() - started
+    report = {'queries': len(queries), 'invalid': len(invalid), 'workers': workers, 'target qps': qps,
+              'seconds': seconds, 'throughput qps': len(queries) / seconds if seconds else 0.0}
+    if queries:
+        report['service latency ms'] = benchmark.latencies(service)
+        report['response latency ms'] = benchmark.latencies(response)
+    return report
+
+
+if __name__ == '__main__':
+    target = float(sys.argv[sys.argv.index('--qps') + 1]) if '--qps' in sys.argv else None
+    processes = int(sys.argv[sys.argv.index('--workers') + 1]) if '--workers' in sys.argv else 1
+    if '--packed' in sys.argv:
+        II = packed_index.PackedIndex(sys.argv[sys.argv.index('--packed') + 1])
+    else:
+        II = main.unpickle()
+    print(json.dumps(replay(stat.read_query_log(sys.argv[1]), II, target, processes), indent=2))
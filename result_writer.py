@@ -0,0 +1,40 @@
+"""
+Writers for streamed search results.
+Each writer consumes an iterator over (ID, [pos1, pos2,...]) tuples and writes one line per document,
+so that the full result list never has to be held in memory.
+"""
+import csv
+import json
+import sys
+
+
+def write_jsonl(results, file=sys.stdout):
+    """
+    Writes results as JSON lines of format {"id": ID, "positions": [pos1, pos2,...]}.
+    :param results: iterator over (ID, [pos1, pos2,...]) tuples.
+    :param file: file object to write into.
+    :return: number of documents written.
+    """
+    count = 0
+    for ID, positions in results:
+        file.write(json.dumps({"id": ID, "positions": list(positions)}) + '\n')
+        count += 1
+    return count
+
+
+def write_csv(results, file=sys.stdout):
+    """
+    Writes results as CSV rows of format ID,"pos1 pos2 ...".
+    :param results: iterator over (ID, [pos1, pos2,...]) tuples.
+    :param file: file object to write into.
+    :return: number of documents written.
+    """
+    writer = csv.writer(file)
+    count = 0
+    for ID, positions in results:
+        writer.writerow([ID, ' '.join(str(pos) for pos in positions)])
+        count += 1
+    return count
+
+
+writers = {'jsonl': write_jsonl, 'csv': write_csv}
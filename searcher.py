@@ -6,12 +6,86 @@ and outputs a list of document IDs that fit the criteria.
 # import doctest
 from parse_tree import ParseTree
 import re
+import time
 from pprint import pprint
+from array import array
+from bisect import bisect_left
+import biwords
+import budget
 import postings
+import spill
+import statistics_container as stat
+from bitmap import Bitmap
 
 operators = ['AND', 'OR', 'BUT NOT']
 stats = dict()
 query_container = ""
+# if debug is set, the stats keep the full result list of every subexpression,
+# otherwise only its number of results and the time it took.
+debug = False
+# optional biword index used by exact_phrase, see biwords.py.
+biword_index = None
+
+
+def record(key, result_list, started, input_sizes=()):
+    """
+    Records the statistics of a single subexpression.
+    :param key: String representation of the subexpression.
+    :param result_list: DocID list of the subexpression.
+    :param started: time.perf_counter() value taken when the subexpression started.
+    :param input_sizes: number of results of every input if the subexpression is an operator.
+    :return: None.
+    """
+    stats[key] = dict()
+    stats[key]['Count'] = len(result_list)
+    stats[key]['Time'] = time.perf_counter() - started
+    if input_sizes:
+        stat.operator(key, input_sizes, stats[key]['Count'], stats[key]['Time'])
+    if debug:
+        stats[key]['Results'] = result_list
+
+
+def doc_ids(postings_list):
+    """
+    Returns the DocIDs of a postings list as integers, so that the merge loops of the operators
+    compare plain numbers. Packed postings lists hand out their DocID buffer without copying it.
+    :param postings_list: list of (ID, [pos1,...]) tuples or PackedPostings.
+    :return: sequence of integer DocIDs.
+    """
+    if isinstance(postings_list, list):
+        return [int(posting[0]) for posting in postings_list]
+    return postings_list.doc_ids
+
+
+def posting_at(postings_list):
+    """
+    Returns a function giving a posting of a postings list by its number. Postings read from the
+    DocID stream are built from their DocID alone, and packed postings lists only copy the positions
+    of the postings that are asked for, once each.
+    :param postings_list: list of (ID, [pos1,...]) tuples, DocIdPostings or PackedPostings.
+    :return: function of the number of a posting, giving its (ID, [pos1,...]) tuple.
+    """
+    if isinstance(postings_list, list):
+        return postings_list.__getitem__
+    ids = postings_list.doc_ids
+    if isinstance(postings_list, postings.DocIdPostings):
+        return lambda i: (ids[i], [])
+    return lambda i: (ids[i], postings_list.positions(i).tolist())
+
+
+def merge_positions(left_positions, right_positions):
+    """
+    Merges the positions of the same document in two postings lists.
+    Postings read from the DocID stream have no positions, so there is usually nothing to merge.
+    :param left_positions: sorted list of positions.
+    :param right_positions: sorted list of positions.
+    :return: sorted list of the positions in either list.
+    """
+    if not right_positions:
+        return left_positions
+    if not left_positions:
+        return right_positions
+    return sorted(set(left_positions + right_positions))
 
 
 def intersect(left_word, right_word, lws, rws, exact=False):
@@ -23,6 +97,13 @@ def intersect(left_word, right_word, lws, rws, exact=False):
     :param rws: String representation of right word.
     :return: DocID list of intersection of left and right words.
     """
+    started = time.perf_counter()
+    if spill.needed((left_word, right_word), min(len(left_word), len(right_word))):
+        intersection_list = spill.collect(checked(stream_intersect(iter(left_word), iter(right_word))))
+        if exact:
+            return intersection_list, ''
+        record('(' + lws + ' AND ' + rws + ')', intersection_list, started, (len(left_word), len(right_word)))
+        return intersection_list, '(' + lws + ' AND ' + rws + ')'
     # lwc = left word counter
     # rwc = right word counter
     # lwc = left word counter
@@ -30,23 +111,28 @@ def intersect(left_word, right_word, lws, rws, exact=False):
     intersection_list = []
     lwc = 0
     rwc = 0
+    steps = 0
     lw_len = len(left_word)
     rw_len = len(right_word)
     min_len = min(lw_len, rw_len)
+    left_ids = doc_ids(left_word)
+    right_ids = doc_ids(right_word)
+    left_posting = posting_at(left_word)
+    right_posting = posting_at(right_word)
 
     if min_len == lw_len:
         while lwc < min_len and rwc < rw_len:
             # the while loop runs over both lists and stops when
             # the shorter list is done
-            if int(left_word[lwc][0]) == int(right_word[rwc][0]):
-                intersection_list.append((left_word[lwc][0],
-                                          sorted(list(set(
-                                              left_word[lwc][1] +
-                                              right_word[rwc][1]
-                                          )))))
+            steps += 1
+            if steps % budget.check_every == 0 and budget.check(len(intersection_list)):
+                break
+            if left_ids[lwc] == right_ids[rwc]:
+                left = left_posting(lwc)
+                intersection_list.append((left[0], merge_positions(left[1], right_posting(rwc)[1])))
                 lwc += 1
                 rwc += 1
-            elif int(left_word[lwc][0]) < int(right_word[rwc][0]):
+            elif left_ids[lwc] < right_ids[rwc]:
                 lwc += 1
             else:
                 rwc += 1
@@ -54,21 +140,21 @@ def intersect(left_word, right_word, lws, rws, exact=False):
         while rwc < min_len and lwc < lw_len:
             # the while loop runs over both lists and stops when
             # the shorter list is done
-            if int(left_word[lwc][0]) == int(right_word[rwc][0]):
-                intersection_list.append((left_word[lwc][0],
-                                          sorted(list(set(
-                                              left_word[lwc][1] +
-                                              right_word[rwc][1]
-                                          )))))
+            steps += 1
+            if steps % budget.check_every == 0 and budget.check(len(intersection_list)):
+                break
+            if left_ids[lwc] == right_ids[rwc]:
+                left = left_posting(lwc)
+                intersection_list.append((left[0], merge_positions(left[1], right_posting(rwc)[1])))
                 lwc += 1
                 rwc += 1
-            elif int(left_word[lwc][0]) < int(right_word[rwc][0]):
+            elif left_ids[lwc] < right_ids[rwc]:
                 lwc += 1
             else:
                 rwc += 1
     if not exact:
-        stats['(' + lws + ' AND ' + rws + ')'] = dict()
-        stats['(' + lws + ' AND ' + rws + ')']['Results'] = intersection_list
+        record('(' + lws + ' AND ' + rws + ')', intersection_list, started,
+               (lw_len, rw_len))
         return intersection_list, '(' + lws + ' AND ' + rws + ')'
     else:
         return intersection_list, ''
@@ -83,6 +169,12 @@ def union(left_word, right_word, lws, rws):
     :param rws: String representation of right word.
     :return: DocID list of union of left and right words.
     """
+    started = time.perf_counter()
+    if spill.needed((left_word, right_word), len(left_word) + len(right_word)):
+        # the result could get too large for memory, so it is merged as a stream and spilled to disk
+        union_list = spill.collect(checked(stream_union(iter(left_word), iter(right_word))))
+        record('(' + lws + ' OR ' + rws + ')', union_list, started, (len(left_word), len(right_word)))
+        return union_list, '(' + lws + ' OR ' + rws + ')'
     # lwc = left word counter
     # rwc = right word counter
     # lwc = left word counter
@@ -90,57 +182,58 @@ def union(left_word, right_word, lws, rws):
     union_list = []
     lwc = 0
     rwc = 0
+    steps = 0
     lw_len = len(left_word)
     rw_len = len(right_word)
     min_len = min(lw_len, rw_len)
+    left_ids = doc_ids(left_word)
+    right_ids = doc_ids(right_word)
+    left_posting = posting_at(left_word)
+    right_posting = posting_at(right_word)
 
     if lw_len == min_len:
         while lwc < min_len and rwc < rw_len:
             # the while loop runs over both lists and stops when
             # the shorter list is done
-            if int(left_word[lwc][0]) == int(right_word[rwc][0]):
-                union_list.append((left_word[lwc][0],
-                                          sorted(list(set(
-                                              left_word[lwc][1] +
-                                              right_word[rwc][1]
-                                          )))))
+            steps += 1
+            if steps % budget.check_every == 0 and budget.check(len(union_list)):
+                break
+            if left_ids[lwc] == right_ids[rwc]:
+                left = left_posting(lwc)
+                union_list.append((left[0], merge_positions(left[1], right_posting(rwc)[1])))
                 lwc += 1
                 rwc += 1
-            elif int(left_word[lwc][0]) < int(right_word[rwc][0]):
-                union_list.append(left_word[lwc])
+            elif left_ids[lwc] < right_ids[rwc]:
+                union_list.append(left_posting(lwc))
                 lwc += 1
             else:
-                union_list.append(right_word[rwc])
+                union_list.append(right_posting(rwc))
                 rwc += 1
     else:
         while rwc < min_len and lwc < lw_len:
             # the while loop runs over both lists and stops when
             # the shorter list is done
-            if int(left_word[lwc][0]) == int(right_word[rwc][0]):
-                union_list.append((left_word[lwc][0],
-                                          sorted(list(set(
-                                              left_word[lwc][1] +
-                                              right_word[rwc][1]
-                                          )))))
+            steps += 1
+            if steps % budget.check_every == 0 and budget.check(len(union_list)):
+                break
+            if left_ids[lwc] == right_ids[rwc]:
+                left = left_posting(lwc)
+                union_list.append((left[0], merge_positions(left[1], right_posting(rwc)[1])))
                 lwc += 1
                 rwc += 1
-            elif int(left_word[lwc][0]) < int(right_word[rwc][0]):
-                union_list.append(left_word[lwc])
+            elif left_ids[lwc] < right_ids[rwc]:
+                union_list.append(left_posting(lwc))
                 lwc += 1
             else:
-                union_list.append(right_word[rwc])
+                union_list.append(right_posting(rwc))
                 rwc += 1
 
-    # what's left of the longer list, is simply added at the end
-    if lwc > rwc:
-        union_list += right_word[rwc:]
-    elif lwc < rwc:
+    # what's left of the longer list, is simply added at the end, unless the query ran out of budget
+    if not budget.truncated():
         union_list += left_word[lwc:]
-    else:
-        pass
+        union_list += right_word[rwc:]
 
-    stats['(' + lws + ' OR ' + rws + ')'] = dict()
-    stats['(' + lws + ' OR ' + rws + ')']['Results'] = union_list
+    record('(' + lws + ' OR ' + rws + ')', union_list, started, (lw_len, rw_len))
     return union_list, '(' + lws + ' OR ' + rws + ')'
 
 
@@ -156,6 +249,11 @@ def complement(left_word, right_word, lws, rws):
     :return: DocID list of complement of right word in regards to the left word, i.e. all
     elements of the left word list which don't appear in the right word list.
     """
+    started = time.perf_counter()
+    if spill.needed((left_word, right_word), len(left_word)):
+        complement_list = spill.collect(checked(stream_complement(iter(left_word), iter(right_word))))
+        record('(' + lws + ' BUT NOT ' + rws + ')', complement_list, started, (len(left_word), len(right_word)))
+        return complement_list, '(' + lws + ' BUT NOT ' + rws + ')'
     # lwc = left word counter
     # rwc = right word counter
     # lwc = left word counter
@@ -163,18 +261,25 @@ def complement(left_word, right_word, lws, rws):
     complement_list = []
     lwc = 0
     rwc = 0
+    steps = 0
     lw_len = len(left_word)
     rw_len = len(right_word)
     min_len = min(lw_len, rw_len)
+    left_ids = doc_ids(left_word)
+    right_ids = doc_ids(right_word)
+    left_posting = posting_at(left_word)
 
     if lw_len == min_len:
         while lwc < min_len and rwc < rw_len:
             # the while loop runs over both lists and stops when
             # the shorter list is done
-            if int(left_word[lwc][0]) < int(right_word[rwc][0]):
-                complement_list.append(left_word[lwc])
+            steps += 1
+            if steps % budget.check_every == 0 and budget.check(len(complement_list)):
+                break
+            if left_ids[lwc] < right_ids[rwc]:
+                complement_list.append(left_posting(lwc))
                 lwc += 1
-            elif int(left_word[lwc][0]) == int(right_word[rwc][0]):
+            elif left_ids[lwc] == right_ids[rwc]:
                 lwc += 1
                 rwc += 1
             else:
@@ -183,79 +288,258 @@ def complement(left_word, right_word, lws, rws):
         while rwc < min_len and lwc < lw_len:
             # the while loop runs over both lists and stops when
             # the shorter list is done
-            if int(left_word[lwc][0]) < int(right_word[rwc][0]):
-                complement_list.append(left_word[lwc])
+            steps += 1
+            if steps % budget.check_every == 0 and budget.check(len(complement_list)):
+                break
+            if left_ids[lwc] < right_ids[rwc]:
+                complement_list.append(left_posting(lwc))
                 lwc += 1
-            elif int(left_word[lwc][0]) == int(right_word[rwc][0]):
+            elif left_ids[lwc] == right_ids[rwc]:
                 lwc += 1
                 rwc += 1
             else:
                 rwc += 1
 
-    complement_list += left_word[lwc:]
+    if not budget.truncated():
+        complement_list += left_word[lwc:]
 
-    stats['(' + lws + ' BUT NOT ' + rws + ')'] = dict()
-    stats['(' + lws + ' BUT NOT ' + rws + ')']['Results'] = complement_list
+    record('(' + lws + ' BUT NOT ' + rws + ')', complement_list, started, (lw_len, rw_len))
     return complement_list, '(' + lws + ' BUT NOT ' + rws + ')'
 
 
+def as_bitmap(result):
+    """
+    :param result: DocID list or Bitmap.
+    :return: the DocIDs of the result as Bitmap.
+    """
+    if isinstance(result, Bitmap):
+        return result
+    return Bitmap.from_ids(doc_ids(result))
+
+
+def bitmap_operation(left_word, right_word, lws, rws, operator):
+    """
+    Computes AND, OR or NOT if at least one side is a Bitmap. If both sides are Bitmaps, the operation
+    is done container by container. If only one side is a Bitmap, AND and NOT keep the DocID list
+    and probe every DocID in the Bitmap, OR gives a Bitmap.
+    Bitmaps carry no positions, so only the positions of the DocID list side end up in the result.
+    :param left_word: DocID list or Bitmap of left word.
+    :param right_word: DocID list or Bitmap of right word.
+    :param lws: String representation of left word.
+    :param rws: String representation of right word.
+    :param operator: AND, OR or NOT.
+    :return: DocID list or Bitmap of the result.
+    """
+    started = time.perf_counter()
+    left_is_bitmap = isinstance(left_word, Bitmap)
+    right_is_bitmap = isinstance(right_word, Bitmap)
+    if operator == 'AND':
+        key = '(' + lws + ' AND ' + rws + ')'
+        if left_is_bitmap and right_is_bitmap:
+            result = left_word & right_word
+        elif right_is_bitmap:
+            result = spill.collect(posting for posting in left_word if int(posting[0]) in right_word)
+        else:
+            result = spill.collect(posting for posting in right_word if int(posting[0]) in left_word)
+    elif operator == 'OR':
+        key = '(' + lws + ' OR ' + rws + ')'
+        result = as_bitmap(left_word) | as_bitmap(right_word)
+    else:
+        key = '(' + lws + ' BUT NOT ' + rws + ')'
+        if right_is_bitmap and not left_is_bitmap:
+            result = spill.collect(posting for posting in left_word if int(posting[0]) not in right_word)
+        else:
+            result = as_bitmap(left_word) - as_bitmap(right_word)
+    record(key, result, started, (len(left_word), len(right_word)))
+    return result, key
+
+
+def materialize(result):
+    """
+    Turns a Bitmap result into a DocID list without positions, spilled to disk if it is too long.
+    :param result: DocID list or Bitmap.
+    :return: DocID list.
+    """
+    if not isinstance(result, Bitmap):
+        return result
+    return spill.collect((ID, []) for ID in result)
+
+
+def intersect_ids(left_ids, right_ids, output=None, limit=None):
+    """
+    Merges two sorted DocID sequences without creating any result tuple.
+    :param left_ids: sorted sequence of integer DocIDs.
+    :param right_ids: sorted sequence of integer DocIDs.
+    :param output: optional array the common DocIDs are appended to.
+    :param limit: optional number of common DocIDs after which the merge stops.
+    :return: number of common DocIDs.
+    >>> intersect_ids([1, 3, 5, 7], [3, 4, 7]), intersect_ids([1, 3, 5, 7], [3, 4, 7], limit=1)
+    (2, 1)
+    """
+    count = 0
+    lwc = 0
+    rwc = 0
+    lw_len = len(left_ids)
+    rw_len = len(right_ids)
+    steps = 0
+    while lwc < lw_len and rwc < rw_len:
+        steps += 1
+        if steps % budget.check_every == 0 and budget.check(count):
+            break
+        if left_ids[lwc] == right_ids[rwc]:
+            count += 1
+            if output is not None:
+                output.append(left_ids[lwc])
+            if count == limit:
+                break
+            lwc += 1
+            rwc += 1
+        elif left_ids[lwc] < right_ids[rwc]:
+            lwc += 1
+        else:
+            rwc += 1
+    return count
+
+
+def id_operation(left_ids, right_ids, operator, count_only=False, first_only=False):
+    """
+    Computes AND, OR or NOT on DocIDs only, for queries that only need the number of results.
+    :param left_ids: sorted sequence of integer DocIDs or Bitmap.
+    :param right_ids: sorted sequence of integer DocIDs or Bitmap.
+    :param operator: AND, OR or NOT.
+    :param count_only: if set, only the number of results is computed.
+    :param first_only: if set together with count_only, an AND stops at its first result, so that the
+    number is 1 if there is any result.
+    :return: array of DocIDs, Bitmap, or the number of results if count_only is set.
+    >>> id_operation([1, 3, 5], [3, 4], 'OR', count_only=True), list(id_operation([1, 3, 5], [3, 4], 'NOT'))
+    (4, [1, 5])
+    """
+    if isinstance(left_ids, Bitmap) or isinstance(right_ids, Bitmap):
+        left = left_ids if isinstance(left_ids, Bitmap) else Bitmap.from_ids(left_ids)
+        right = right_ids if isinstance(right_ids, Bitmap) else Bitmap.from_ids(right_ids)
+        result = left & right if operator == 'AND' else left | right if operator == 'OR' else left - right
+        return len(result) if count_only else result
+    if count_only:
+        # |A OR B| = |A| + |B| - |A AND B| and |A NOT B| = |A| - |A AND B|
+        common = intersect_ids(left_ids, right_ids, limit=1 if first_only and operator == 'AND' else None)
+        if operator == 'AND':
+            return common
+        if operator == 'OR':
+            return len(left_ids) + len(right_ids) - common
+        return len(left_ids) - common
+    result = array('I')
+    if operator == 'AND':
+        intersect_ids(left_ids, right_ids, result)
+        return result
+    lwc = 0
+    rwc = 0
+    lw_len = len(left_ids)
+    rw_len = len(right_ids)
+    steps = 0
+    while lwc < lw_len and rwc < rw_len:
+        steps += 1
+        if steps % budget.check_every == 0 and budget.check(len(result)):
+            break
+        if left_ids[lwc] == right_ids[rwc]:
+            if operator == 'OR':
+                result.append(left_ids[lwc])
+            lwc += 1
+            rwc += 1
+        elif left_ids[lwc] < right_ids[rwc]:
+            result.append(left_ids[lwc])
+            lwc += 1
+        else:
+            if operator == 'OR':
+                result.append(right_ids[rwc])
+            rwc += 1
+    if not budget.truncated():
+        result.extend(left_ids[lwc:])
+        if operator == 'OR':
+            result.extend(right_ids[rwc:])
+    return result
+
+
+def phrase_pieces(query, ii):
+    """
+    Lists the postings lists a phrase can be checked with: the postings list of every word,
+    and that of every pair of adjacent words which is in the biword index.
+    :param query: list of words in query in sequential order.
+    :param ii: inverted index.
+    :return: list of tuples (number of documents, offset of the first word in the phrase, number of words,
+    function returning the postings list), the shortest postings list first.
+    """
+    pieces = []
+    for offset, word in enumerate(query):
+        if word not in ii:
+            raise KeyError(word)
+        pieces.append((postings.length(word, ii), offset, 1, lambda word=word: postings.fetch(word, ii)))
+    if biword_index is not None:
+        for offset in range(len(query) - 1):
+            term = biwords.pair(query[offset], query[offset + 1])
+            if term in biword_index:
+                pair_postings = biword_index.retrieve(term)
+                pieces.append((len(pair_postings), offset, 2, lambda pair_postings=pair_postings: pair_postings))
+    pieces.sort(key=lambda piece: (piece[0], -piece[2]))
+    return pieces
+
+
 def exact_phrase(query, ii):
     """
     Function that computes all docIDs and positions such that the words in the query
     occur exactly one after another.
+    The shortest postings lists which together cover every word of the phrase are chosen,
+    pairs of the biword index included. The shortest one gives the candidates, which are then
+    checked against the others, so the long postings lists of frequent words are avoided wherever possible.
     :param query: list of words in query in sequential order.
     :param ii: inverted index.
     :return: list of tuples (ID, [pos1,...]) where pos is position of first word in query
     within a given document.
     """
+    started = time.perf_counter()
     try:
-        result = postings.retrieve(query[0], ii[query[0]])
+        pieces = phrase_pieces(query, ii)
     except KeyError as w:
         print("{} cannot be found".format(w))
         return [], {}
-    for word in query[1:]:
-        # first create list of the intersection of all words in query
-        # empty is only necessary because of how the intersect function creates
-        # a string for the statistics container
-        try:
-            ii_word = postings.retrieve(word, ii[word])
-            result, empty = intersect(result, ii_word, "", "", exact=True)
-        except KeyError as w:
-            print("{} cannot be found".format(w))
-            return [], {}
-    # create list of intersection IDs only
-    result = [x[0] for x in result]
-    # final result is list of tuples of form (ID, num), where num is position of first word
-    final_result = []
-    for ID in result:
-        # returns position list of word in given ID
-        ii_query0 = postings.retrieve(query[0], ii[query[0]])
-        for num in ii_query0[[w[0] for w in ii_query0].index(ID)][1]:
-            match = True
-            i = 1
-            # check if the words in query have positions right after one another
-            while match and i < len(query):
-                ii_queryi = postings.retrieve(query[i], ii[query[i]])
-                if num + i in ii_queryi[[w[0] for w in ii_queryi].index(ID)][1]:
-                    i += 1
-                else:
-                    match = False
-            # only if all positions align do we add to the final list
-            if match is True:
-                if not final_result:
-                    final_result.append((ID, [num]))
-                elif final_result[-1][0] == ID:
-                    final_result[-1][1].append(num)
-                else:
-                    final_result.append((ID, [num]))
+    chosen = []
+    covered = set()
+    for piece in pieces:
+        words = set(range(piece[1], piece[1] + piece[2]))
+        if not words <= covered:
+            chosen.append(piece)
+            covered |= words
+    # candidates are tuples (ID, [positions of the first word of the phrase])
+    length, offset, size, load = chosen[0]
+    candidates = [(int(posting[0]), [num - offset for num in posting[1] if num > offset])
+                  for posting in load()]
+    checked = len(candidates)
+    steps = 0
+    for length, offset, size, load in chosen[1:]:
+        postings_list = load()
+        ids = doc_ids(postings_list)
+        remaining = []
+        for ID, starts in candidates:
+            # out of budget, the candidates checked so far still have to pass the other pieces
+            steps += 1
+            if steps % budget.check_every == 0 and not budget.truncated() and budget.check(len(remaining)):
+                break
+            n = bisect_left(ids, ID)
+            if n < len(ids) and ids[n] == ID:
+                following = set(postings_list[n][1])
+                starts = [num for num in starts if num + offset in following]
+                if starts:
+                    remaining.append((ID, starts))
+        candidates = remaining
+        if not candidates:
+            break
+    final_result = [(ID, starts) for ID, starts in candidates if starts]
 
     if not final_result:
         print("No exact match found")
         return [], {}
     else:
         query = '"' + ' '.join(query) + '"'
-        stats[query] = dict()
-        stats[query]["results"] = final_result
+        record(query, final_result, started, (checked,))
         return final_result, query
 
 
@@ -269,6 +553,12 @@ def proximity(first_word, second_word, lws, rws, options, distance):
     :param distance: how many words are in between the first and second word.
     :return: List of docIDs of words for which the conditions are met.
     """
+    started = time.perf_counter()
+    if spill.needed((first_word, second_word), min(len(first_word), len(second_word))):
+        final_result = spill.collect(checked(stream_proximity(iter(first_word), iter(second_word), options, distance)))
+        key = '(' + lws + (' NEAR' if options == 'near' else ' WITHIN') + str(distance) + ' ' + rws + ')'
+        record(key, final_result, started, (len(first_word), len(second_word)))
+        return final_result, key
     hash_print = dict()
     final_result = []
     if options == "near":
@@ -287,6 +577,8 @@ def proximity(first_word, second_word, lws, rws, options, distance):
         lw_rw = []
 
         for ID in doclist:
+            if budget.check(len(final_result)):
+                break
             # returns position list of word in given ID
             for num in first_word[first_word_doclist.index(ID)][1]:
                 match = False
@@ -337,14 +629,14 @@ def proximity(first_word, second_word, lws, rws, options, distance):
 
         hash_print["{} followed by {}".format(rws, lws)] = rw_lw
         hash_print["{} followed by {}".format(lws, rws)] = lw_rw
-        stats['(' + lws + ' NEAR' + str(distance) + ' ' + rws + ')'] = dict()
-        stats['(' + lws + ' NEAR' + str(distance) + ' ' + rws + ')']['Results'] = final_result
+        record('(' + lws + ' NEAR' + str(distance) + ' ' + rws + ')', final_result, started,
+               (len(first_word), len(second_word)))
         string_result = '(' + lws + ' NEAR' + str(distance) + ' ' + rws + ')'
 
     elif options == "within":
         # check if words are in the same document
         try:
-            doclist = intersect(first_word, second_word, "", "", exact=True)
+            doclist, empty = intersect(first_word, second_word, "", "", exact=True)
             assert doclist
             doclist = [w[0] for w in doclist]
         except AssertionError:
@@ -353,6 +645,8 @@ def proximity(first_word, second_word, lws, rws, options, distance):
         first_word_doclist = [w[0] for w in first_word]
         second_word_doclist = [w[0] for w in second_word]
         for ID in doclist:
+            if budget.check(len(final_result)):
+                break
             # returns position list of word in given ID
             for num in first_word[first_word_doclist.index(ID)][1]:
                 match = False
@@ -362,7 +656,6 @@ def proximity(first_word, second_word, lws, rws, options, distance):
                     if num + i in second_word[second_word_doclist.index(ID)][1]:
                         i += 1
                         match = True
-                        distance = int(i)
                     else:
                         i += 1
                 # if at least one match is found within the specified distance, we add it to the list
@@ -374,8 +667,8 @@ def proximity(first_word, second_word, lws, rws, options, distance):
                     else:
                         final_result.append((ID, [num]))
         hash_print["{} followed by {}".format(lws, rws)] = final_result
-        stats['(' + lws + ' WITHIN' + str(distance) + ' ' + rws + ')'] = dict()
-        stats['(' + lws + ' WITHIN' + str(distance) + ' ' + rws + ')']['Results'] = final_result
+        record('(' + lws + ' WITHIN' + str(distance) + ' ' + rws + ')', final_result, started,
+               (len(first_word), len(second_word)))
         string_result = '(' + lws + ' WITHIN' + str(distance) + ' ' + rws + ')'
     return final_result, string_result
 
@@ -390,16 +683,16 @@ def run(current, ii):
     :param ii: The Inverted Index to be used
     :return: The final DocID list for a given query.
     """
-    if not re.search(r'AND|OR|NOT|WITHIN\d{1,3}|NEAR\d{1,3}', current.key):
+    if current.left is None:
         if '"' in current.key:
             query_words = current.key[1:-1]
             query_list = query_words.split()
             return exact_phrase(query_list, ii)
         else:
             try:
-                postings_list = postings.retrieve(current.key, ii[current.key])
-                stats[current.key] = dict()
-                stats[current.key]["results"] = postings_list
+                started = time.perf_counter()
+                postings_list = postings.fetch(current.key, ii)
+                record(current.key, postings_list, started)
                 return postings_list, current.key
             except KeyError as w:
                 print("{} cannot be found".format(w))
@@ -420,7 +713,209 @@ def run(current, ii):
             near_num = re.search(r'(?<=NEAR)\d+', current.key).group()
             return proximity(lw, rw, lws, rws, options='near', distance=int(near_num))
 
+def stream_intersect(left_stream, right_stream):
+    """
+    Streaming version of intersect. Consumes two DocID streams sorted by DocID and yields
+    the documents contained in both, one at a time.
+    :param left_stream: iterator over (ID, [pos1,...]) of the left word.
+    :param right_stream: iterator over (ID, [pos1,...]) of the right word.
+    :return: generator of (ID, [pos1,...]) tuples with merged position lists.
+    """
+    left = next(left_stream, None)
+    right = next(right_stream, None)
+    while left is not None and right is not None:
+        if int(left[0]) == int(right[0]):
+            yield left[0], merge_positions(left[1], right[1])
+            left = next(left_stream, None)
+            right = next(right_stream, None)
+        elif int(left[0]) < int(right[0]):
+            left = next(left_stream, None)
+        else:
+            right = next(right_stream, None)
+
+
+def stream_union(left_stream, right_stream):
+    """
+    Streaming version of union. Consumes two DocID streams sorted by DocID and yields
+    the documents contained in either of them, one at a time.
+    :param left_stream: iterator over (ID, [pos1,...]) of the left word.
+    :param right_stream: iterator over (ID, [pos1,...]) of the right word.
+    :return: generator of (ID, [pos1,...]) tuples.
+    """
+    left = next(left_stream, None)
+    right = next(right_stream, None)
+    while left is not None and right is not None:
+        if int(left[0]) == int(right[0]):
+            yield left[0], merge_positions(left[1], right[1])
+            left = next(left_stream, None)
+            right = next(right_stream, None)
+        elif int(left[0]) < int(right[0]):
+            yield left
+            left = next(left_stream, None)
+        else:
+            yield right
+            right = next(right_stream, None)
+    # what's left of the longer stream, is simply passed on
+    if left is not None:
+        yield left
+        yield from left_stream
+    if right is not None:
+        yield right
+        yield from right_stream
+
+
+def stream_complement(left_stream, right_stream):
+    """
+    Streaming version of complement. Yields the documents of the left stream which
+    do not appear in the right stream, one at a time.
+    :param left_stream: iterator over (ID, [pos1,...]) of the left word.
+    :param right_stream: iterator over (ID, [pos1,...]) of the right word.
+    :return: generator of (ID, [pos1,...]) tuples.
+    """
+    left = next(left_stream, None)
+    right = next(right_stream, None)
+    while left is not None and right is not None:
+        if int(left[0]) < int(right[0]):
+            yield left
+            left = next(left_stream, None)
+        elif int(left[0]) == int(right[0]):
+            left = next(left_stream, None)
+            right = next(right_stream, None)
+        else:
+            right = next(right_stream, None)
+    if left is not None:
+        yield left
+        yield from left_stream
+
+
+def checked(postings_stream):
+    """
+    Passes a stream on until the running query goes over its budget, see budget.py.
+    :param postings_stream: iterator over (ID, [pos1,...]).
+    :return: generator of (ID, [pos1,...]) tuples.
+    """
+    for n, posting in enumerate(postings_stream, 1):
+        if n % budget.check_every == 0 and budget.check(n):
+            return
+        yield posting
+
+
+def near_positions(first_positions, second_positions, distance, ordered):
+    """
+    Finds the positions of a single document at which two words are within a given distance.
+    :param first_positions: position list of the first word.
+    :param second_positions: position list of the second word.
+    :param distance: how many words may be in between the first and second word.
+    :param ordered: if True (WITHIN), the first word has to come first,
+    otherwise (NEAR) the order doesn't matter.
+    :return: List of matching positions of the first word, followed by those of the second word
+    if the order doesn't matter.
+    """
+    second_set = set(second_positions)
+    result = [num for num in first_positions
+              if any(num + i in second_set for i in range(1, distance + 1))]
+    if not ordered:
+        first_set = set(first_positions)
+        result += [num for num in second_positions
+                   if any(num + i in first_set for i in range(1, distance + 1))]
+    return result
+
+
+def stream_proximity(first_stream, second_stream, options, distance):
+    """
+    Streaming version of proximity.
+    :param first_stream: iterator over (ID, [pos1,...]) of the first word.
+    :param second_stream: iterator over (ID, [pos1,...]) of the second word.
+    :param options: "near" (order doesn't matter) or "within" (order matters)
+    :param distance: how many words are in between the first and second word.
+    :return: generator of (ID, [pos1,...]) tuples for which the conditions are met.
+    """
+    first = next(first_stream, None)
+    second = next(second_stream, None)
+    while first is not None and second is not None:
+        if int(first[0]) == int(second[0]):
+            positions = near_positions(first[1], second[1], distance, options == 'within')
+            if positions:
+                yield first[0], positions
+            first = next(first_stream, None)
+            second = next(second_stream, None)
+        elif int(first[0]) < int(second[0]):
+            first = next(first_stream, None)
+        else:
+            second = next(second_stream, None)
+
+
+def stream_exact_phrase(query, ii, start=0):
+    """
+    Streaming version of exact_phrase.
+    :param query: list of words in query in sequential order.
+    :param ii: inverted index.
+    :param start: the lowest DocID to look at.
+    :return: generator of (ID, [pos1,...]) tuples where pos is position of first word in query
+    within a given document.
+    """
+    try:
+        streams = [iter(postings.fetch_from(word, ii, start)) for word in query]
+    except KeyError as w:
+        print("{} cannot be found".format(w))
+        return
+    current = [next(stream, None) for stream in streams]
+    while None not in current:
+        highest = max(int(x[0]) for x in current)
+        if all(int(x[0]) == highest for x in current):
+            following = [set(x[1]) for x in current[1:]]
+            positions = [num for num in current[0][1]
+                         if all(num + i + 1 in following[i] for i in range(len(following)))]
+            if positions:
+                yield current[0][0], positions
+            current = [next(stream, None) for stream in streams]
+        else:
+            # advance every word which is behind the highest DocID
+            current = [next(streams[i], None) if int(current[i][0]) < highest else current[i]
+                       for i in range(len(current))]
+
+
+def stream(current, ii, start=0, positional=None):
+    """
+    Streaming version of run. Instead of building the DocID list of every subexpression,
+    the Parse Tree is turned into a chain of generators, so that only one document per node
+    is held in memory at a time. As in query_plan.compile_node, terms are read from their DocID
+    stream only wherever no positions are needed.
+    :param current: The current node in the Parse Tree.
+    :param ii: The Inverted Index to be used.
+    :param start: the lowest DocID to look at, every postings list is entered there, see postings.fetch_from.
+    :param positional: True if an operator above the node needs positions, defaults to True for a single term.
+    :return: generator of (ID, [pos1,...]) tuples for a given query.
+    """
+    if positional is None:
+        positional = current.left is None
+    if current.left is None:
+        if '"' in current.key:
+            return stream_exact_phrase(current.key[1:-1].split(), ii, start)
+        try:
+            return iter(postings.fetch_from(current.key, ii, start, positional))
+        except KeyError as w:
+            print("{} cannot be found".format(w))
+            return iter([])
+    positional = positional or current.key.startswith('NEAR') or current.key.startswith('WITHIN')
+    left_stream = stream(current.left, ii, start, positional)
+    right_stream = stream(current.right, ii, start, positional)
+    if current.key == 'AND':
+        return stream_intersect(left_stream, right_stream)
+    elif current.key == 'OR':
+        return stream_union(left_stream, right_stream)
+    elif current.key == 'NOT':
+        return stream_complement(left_stream, right_stream)
+    elif re.match(r'WITHIN\d{1,3}', current.key):
+        within_num = re.search(r'(?<=WITHIN)\d+', current.key).group()
+        return stream_proximity(left_stream, right_stream, 'within', int(within_num))
+    elif re.match(r'NEAR\d{1,3}', current.key):
+        near_num = re.search(r'(?<=NEAR)\d+', current.key).group()
+        return stream_proximity(left_stream, right_stream, 'near', int(near_num))
+
+
 def run_main(current, ii):
     stats.clear()
-    end_result, empty = run(current, ii)
+    with stat.stage('evaluation'):
+        end_result, empty = run(current, ii)
     return end_result, stats
@@ -0,0 +1,289 @@
+"""
+Sharded index. At index time the corpus is partitioned by DocID range into shards, every shard gets its
+own directory with its own postings, bitmaps, vocabulary and pickled Inverted Index.
+At query time a Coordinator validates and parses the query once, sends the Parse Tree to one worker per
+shard and merges the answers in DocID order. Workers are either local processes started by the
+Coordinator or servers started with serve(), which are reached over a local socket; both speak the
+same messages over a multiprocessing connection.
+"""
+import heapq
+import json
+import os
+import pickle
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Client, Listener
+import bitmap
+import docstore
+import error_catcher
+import indexer
+import preprocessor
+import query_plan
+import ranked
+import vocabulary
+
+manifest_name = 'shards.json'
+index_name = 'index.pickle'
+vocabulary_name = 'index.vocab'
+docstore_name = 'index.docs'
+# authentication key of the socket transport.
+authkey = b'ncat shards'
+
+
+def partition(file_dict, shards):
+    """
+    Splits a corpus into DocID ranges of about the same number of documents.
+    :param file_dict: dictionary {ID: (MemberID, Wordlist of PostContent)} as returned by indexer.read_file.
+    :param shards: number of shards.
+    :return: list of dictionaries in the format of file_dict, in ascending DocID order.
+    >>> [list(part) for part in partition({'3': 0, '1': 0, '10': 0, '2': 0, '7': 0}, 2)]
+    [['1', '2', '3'], ['7', '10']]
+    """
+    ids = sorted(file_dict, key=int)
+    size = -(-len(ids) // shards)
+    return [{ID: file_dict[ID] for ID in ids[start:start + size]} for start in range(0, len(ids), size)]
+
+
+def build(file_name, shards, directory='.'):
+    """
+    Indexes a corpus into shards and writes the manifest.
+    :param file_name: name of the CSV file to be indexed.
+    :param shards: number of shards.
+    :param directory: directory below which the shard directories are created.
+    :return: name of the manifest file.
+    """
+    file_dict = indexer.read_file(file_name)
+    directory = os.path.abspath(directory)
+    manifest = []
+    old_directory = os.getcwd()
+    try:
+        for number, part in enumerate(partition(file_dict, shards)):
+            shard_directory = os.path.join(directory, 'shard_{}'.format(number))
+            os.makedirs(os.path.join(shard_directory, 'postings_1M'), exist_ok=True)
+            # the indexer writes its postings below ./postings_1M
+            os.chdir(shard_directory)
+            indexer.inverted_index.clear()
+            indexer.counting_index.clear()
+            indexer.generate_index_new(part)
+            bitmap.write_bitmaps(indexer.inverted_index, len(part), indexer.counting_index)
+            vocabulary.build(indexer.inverted_index, indexer.counting_index, vocabulary_name, len(part))
+            docstore.build(part, docstore_name)
+            pickle_out = open(index_name, mode='wb')
+            pickle.dump(indexer.inverted_index, pickle_out)
+            pickle_out.close()
+            ids = [int(ID) for ID in part]
+            manifest.append({'directory': shard_directory, 'first': min(ids), 'last': max(ids)})
+    finally:
+        os.chdir(old_directory)
+    manifest_file = os.path.join(directory, manifest_name)
+    file = open(manifest_file, mode='w')
+    json.dump(manifest, file, indent=2)
+    file.close()
+    return manifest_file
+
+
+def load_shard(shard_directory):
+    """
+    :param shard_directory: directory of a shard.
+    :return: tuple (Inverted Index of the shard, Vocabulary of the shard).
+    """
+    pickle_in = open(os.path.join(shard_directory, index_name), mode='rb')
+    ii = pickle.load(pickle_in)
+    pickle_in.close()
+    return ii, vocabulary.Vocabulary(os.path.join(shard_directory, vocabulary_name))
+
+
+def score(result):
+    """
+    Sort key of a ranked result of a shard, see ranked.search.
+    :param result: tuple (ID, score).
+    :return: tuple that sorts better results first with heapq.nlargest, ties go to the lower DocID.
+    """
+    return result[1], -int(result[0])
+
+
+def answer(message, ii, statistics):
+    """
+    Evaluates a single message of the coordinator on a shard.
+    :param message: tuple ('search', query, ParseTree), ('count', query, ParseTree)
+    or ('ranked', query, ParseTree, k).
+    :param ii: Inverted Index of the shard.
+    :param statistics: Vocabulary of the shard.
+    :return: DocID list of the shard, its number of results for 'count', or its k best results as tuples
+    (ID, score) for 'ranked', None if ranked search does not support the query.
+    """
+    if message[0] == 'ranked':
+        # the same term frequency scores as a local ranked search, which do not depend on the other shards
+        return ranked.search(message[1], ii, message[3])
+    plan = query_plan.compile_tree(message[1], message[2], ii, statistics)
+    if message[0] == 'count':
+        return plan.count(ii)
+    return list(plan.execute(ii)[0])
+
+
+def work(connection, shard_directory):
+    """
+    Serves the messages of a coordinator on a connection until it sends 'stop' or closes the connection.
+    Every message is answered with ('ok', DocID list) or ('error', description).
+    :param connection: multiprocessing connection.
+    :param shard_directory: directory of the shard.
+    :return: None.
+    """
+    ii, statistics = load_shard(shard_directory)
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message[0] == 'stop':
+            break
+        try:
+            connection.send(('ok', answer(message, ii, statistics)))
+        except Exception as error:
+            connection.send(('error', repr(error)))
+    connection.close()
+
+
+def serve(shard_directory, address):
+    """
+    Serves a shard over a local socket, one coordinator connection after another.
+    :param shard_directory: directory of the shard.
+    :param address: tuple (host, port).
+    :return: None.
+    """
+    listener = Listener(address, authkey=authkey)
+    try:
+        while True:
+            work(listener.accept(), shard_directory)
+    finally:
+        listener.close()
+
+
+class Coordinator:
+    """
+    Scatters queries to the shard workers and gathers their answers.
+    """
+    def __init__(self, shard_directories=(), addresses=()):
+        """
+        :param shard_directories: directories of shards, one local worker process is started for each.
+        :param addresses: (host, port) tuples of shard servers started with serve().
+        """
+        self.connections = []
+        self.processes = []
+        for shard_directory in shard_directories:
+            connection, worker_connection = Pipe()
+            process = Process(target=work, args=(worker_connection, shard_directory), daemon=True)
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+        for address in addresses:
+            self.connections.append(Client(address, authkey=authkey))
+
+    @classmethod
+    def from_manifest(cls, manifest_file):
+        """
+        :param manifest_file: manifest written by build().
+        :return: Coordinator with one local worker process per shard.
+        """
+        file = open(manifest_file)
+        manifest = json.load(file)
+        file.close()
+        return cls([shard['directory'] for shard in manifest])
+
+    def scatter(self, message):
+        """
+        Sends a message to every shard and collects the answers.
+        :param message: tuple, see answer().
+        :return: list of DocID lists, one per shard.
+        """
+        for connection in self.connections:
+            connection.send(message)
+        answers = [connection.recv() for connection in self.connections]
+        for status, result in answers:
+            if status == 'error':
+                raise RuntimeError("shard failed: {}".format(result))
+        return [result for status, result in answers]
+
+    def parse(self, query):
+        """
+        :param query: The search string.
+        :return: ParseTree of the query, None if the query is invalid.
+        """
+        query = query.strip()
+        tokens, errors = error_catcher.validate(query)
+        if errors:
+            print(*error_catcher.describe(errors))
+            return None
+        try:
+            return preprocessor.parse_tokens(tokens)
+        except ValueError as error:
+            print(*error_catcher.describe([error_catcher.parse_error(error)]))
+            return None
+
+    def search(self, query):
+        """
+        :param query: The search string.
+        :return: List of DocID tuples with list of positions (ID, [pos1, pos2,...]) in DocID order,
+        None if the query is invalid.
+        """
+        tree = self.parse(query)
+        if tree is None:
+            return None
+        return list(heapq.merge(*self.scatter(('search', query.strip(), tree)),
+                                key=lambda posting: int(posting[0])))
+
+    def count(self, query):
+        """
+        :param query: The search string.
+        :return: number of documents found over all shards, None if the query is invalid.
+        """
+        tree = self.parse(query)
+        if tree is None:
+            return None
+        return sum(self.scatter(('count', query.strip(), tree)))
+
+    def search_ranked(self, query, k=10):
+        """
+        :param query: The search string.
+        :param k: number of results.
+        :return: the k best results over all shards as tuples (ID, score), best first, see ranked.search.
+        None if the query is invalid or not supported by ranked search.
+        """
+        tree = self.parse(query)
+        if tree is None:
+            return None
+        answers = self.scatter(('ranked', query.strip(), tree, k))
+        if None in answers:
+            return None
+        return heapq.nlargest(k, [result for shard in answers for result in shard], key=score)
+
+    def close(self):
+        """
+        Stops the local workers and closes all connections.
+        :return: None.
+        """
+        for connection in self.connections:
+            try:
+                connection.send(('stop',))
+            except (BrokenPipeError, EOFError, OSError):
+                pass
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == '__main__':
+    # python shards.py build corpus.csv 4 [directory]
+    # python shards.py serve shard_directory port
+    import sys
+    if sys.argv[1] == 'build':
+        print(build(sys.argv[2], int(sys.argv[3]), sys.argv[4] if len(sys.argv) > 4 else '.'))
+    else:
+        serve(sys.argv[2], ('localhost', int(sys.argv[3])))
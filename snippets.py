@@ -0,0 +1,114 @@
+"""
+Snippets of search results. The positions of a result are word numbers of the post, as counted by the
+indexer, so they point straight into the word list kept in the document store and nothing has to be
+tokenized again. The snippet is the window of the post with the most matched positions, with the
+matched words highlighted. Snippets are made for a whole page of results at once, so that every
+block of the document store is decompressed only once per page.
+"""
+import postings
+
+# put around every matched word.
+highlight = ('[', ']')
+# number of words of a snippet.
+width = 20
+# number of results of a page.
+page_size = 10
+
+
+def best_window(positions, size):
+    """
+    Finds the window of consecutive words that contains the most positions.
+    :param positions: sorted list of matched positions, 1 is the first word.
+    :param size: number of words of the window.
+    :return: tuple (first position, number of positions within the window).
+    >>> best_window([1, 30, 31, 33, 60], 5)
+    (30, 3)
+    >>> best_window([], 5)
+    (1, 0)
+    """
+    best = (positions[0] if positions else 1, 0)
+    end = 0
+    for start in range(len(positions)):
+        while end < len(positions) and positions[end] < positions[start] + size:
+            end += 1
+        if end - start > best[1]:
+            best = (positions[start], end - start)
+    return best
+
+
+def snippet(words, positions, size=None, highlighted=None):
+    """
+    :param words: the word list of a post.
+    :param positions: sorted list of matched positions.
+    :param size: number of words of the snippet, defaults to width.
+    :param highlighted: positions of the words to highlight, defaults to the matched positions.
+    :return: the best window of the post with the highlighted words marked.
+    >>> snippet('a b c d e f g h'.split(), [4, 6], 4)
+    '... c [d] e [f] ...'
+    >>> snippet('a b c d e f g h'.split(), [2], 3, [2, 3, 8])
+    'a [b] [c] ...'
+    """
+    size = size or width
+    first, matches = best_window(positions, size)
+    # put the matched words into the middle of the window
+    last_match = max([p for p in positions if first <= p < first + size], default=first)
+    start = max(1, first - (size - (last_match - first)) // 2)
+    start = max(1, min(start, len(words) - size + 1))
+    end = min(len(words), start + size - 1)
+    matched = set(positions if highlighted is None else highlighted)
+    parts = []
+    for position in range(start, end + 1):
+        word = words[position - 1]
+        parts.append(highlight[0] + word + highlight[1] if position in matched else word)
+    if start > 1:
+        parts.insert(0, '...')
+    if end < len(words):
+        parts.append('...')
+    return ' '.join(parts)
+
+
+def term_positions(terms, ids, ii):
+    """
+    Looks up the positions of the query terms in the results of a page. Results of boolean operators
+    come without positions, as those are evaluated on DocIDs only, and results of phrases and proximity
+    searches only carry the positions of the matches, not those of every query term. Only the positions
+    of the documents of the page are read, see postings.retrieve_positions.
+    :param terms: the search words of the query.
+    :param ids: integer DocIDs of a page.
+    :param ii: the index to be used.
+    :return: dictionary {DocID: sorted list of positions}.
+    """
+    found = {ID: set() for ID in ids}
+    for term in terms:
+        if term not in ii:
+            continue
+        for ID, positions in postings.fetch_positions(term, ii, ids).items():
+            found[ID].update(positions)
+    return {ID: sorted(positions) for ID, positions in found.items()}
+
+
+def page(results, store, terms=(), ii=None, number=0, size=None):
+    """
+    Makes the snippets of a page of results.
+    :param results: List of DocID tuples with list of positions (ID, [pos1, pos2,...]).
+    :param store: docstore.DocumentStore.
+    :param terms: the search words of the query, all of their occurrences are highlighted.
+    :param ii: the index to be used, needed to find the occurrences of the terms.
+    :param number: number of the page, 0 is the first.
+    :param size: number of results per page, defaults to page_size.
+    :return: list of tuples (ID, MemberID, snippet).
+    """
+    size = size or page_size
+    shown = results[number * size:(number + 1) * size]
+    ids = [int(posting[0]) for posting in shown]
+    looked_up = term_positions(terms, ids, ii) if ii is not None else dict()
+    snippets = []
+    for ID, posting, post in zip(ids, shown, store.get_many(ids)):
+        if post is None:
+            continue
+        occurrences = looked_up.get(ID, [])
+        # the window is put around the matches, if the result has any
+        positions = list(posting[1]) or occurrences
+        highlighted = sorted(set(positions) | set(occurrences))
+        snippets.append((ID, post[0], snippet(post[1], positions, highlighted=highlighted)))
+    return snippets
@@ -0,0 +1,227 @@
+"""
+External-memory intermediate results. Once an operator would hold more than max_postings postings,
+its inputs are merged as streams and its output is written to a temporary file in batches, so that
+no more than one batch is ever kept in memory. The operators produce their output in DocID order,
+so the file is a single sorted run which the next operator reads back as a stream.
+Every batch is stored as its number of postings and number of values ('<II'), followed by the
+values as unsigned 32 bit integers: DocID, number of positions, positions, for every posting.
+"""
+import itertools
+import struct
+import tempfile
+from array import array
+from bisect import bisect_right
+
+# largest number of postings an operator keeps in memory, None never spills.
+max_postings = 1000000
+# directory of the temporary files, None uses the default of the tempfile module.
+directory = None
+
+batch_header = '<II'
+batch_header_size = struct.calcsize(batch_header)
+
+
+class SpilledPostings:
+    """
+    Postings list kept in a temporary file. It behaves like a read-only list of (ID, [pos1, pos2,...])
+    tuples which is read from the file on every pass; the file is deleted once the object is gone.
+    A block index of the batches, their first posting, file offset and first DocID, lets an access by
+    number or DocID read a single batch, and the batch that was accessed last is kept in memory.
+    >>> spilled = SpilledPostings()
+    >>> spilled.write([(2, [1]), (4, [])])
+    >>> spilled.write([(7, [3, 5])])
+    >>> spilled[2], spilled[1:], list(spilled.seek(3)), list(spilled.doc_ids)
+    ((7, [3, 5]), [(4, []), (7, [3, 5])], [(4, []), (7, [3, 5])], [2, 4, 7])
+    """
+    def __init__(self):
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.size = 0
+        self.end = 0
+        # the block index: number of the first posting, file offset and first DocID of every batch
+        self.starts = []
+        self.offsets = []
+        self.first_ids = []
+        # tuple (number of a batch, its postings) of the batch that was accessed last
+        self.current = (-1, None)
+
+    def write(self, postings_list):
+        """
+        Appends a batch of postings, which have to follow the postings written before in DocID order.
+        :param postings_list: list of (ID, [pos1, pos2,...]).
+        :return: None.
+        """
+        if not postings_list:
+            return
+        values = array('I')
+        for ID, positions in postings_list:
+            values.append(int(ID))
+            values.append(len(positions))
+            values.extend(positions)
+        self.starts.append(self.size)
+        self.offsets.append(self.end)
+        self.first_ids.append(int(postings_list[0][0]))
+        self.file.seek(self.end)
+        self.file.write(struct.pack(batch_header, len(postings_list), len(values)))
+        values.tofile(self.file)
+        self.end = self.file.tell()
+        self.size += len(postings_list)
+
+    def read(self, k):
+        """
+        :param k: number of a batch.
+        :return: the batch as list of (ID, [pos1, pos2,...]).
+        """
+        # every read seeks to its own batch, so that several passes can run side by side
+        self.file.seek(self.offsets[k])
+        count, length = struct.unpack(batch_header, self.file.read(batch_header_size))
+        values = array('I')
+        values.frombytes(self.file.read(4 * length))
+        batch = []
+        n = 0
+        for i in range(count):
+            frequency = values[n + 1]
+            batch.append((values[n], values[n + 2:n + 2 + frequency].tolist()))
+            n += 2 + frequency
+        return batch
+
+    def batch(self, k):
+        """
+        :param k: number of a batch.
+        :return: the batch as list of (ID, [pos1, pos2,...]), read from the file only if it is not the current one.
+        """
+        if self.current[0] != k:
+            self.current = (k, self.read(k))
+        return self.current[1]
+
+    def batch_of(self, i):
+        """
+        :param i: number of a posting, 0 <= i < len(self).
+        :return: number of the batch that holds the posting.
+        """
+        return bisect_right(self.starts, i) - 1
+
+    def batches(self, first=0):
+        """
+        :param first: number of the first batch.
+        :return: generator of the batches of the file as lists of (ID, [pos1, pos2,...]).
+        """
+        for k in range(first, len(self.offsets)):
+            yield self.read(k)
+
+    def postings_from(self, i):
+        """
+        :param i: number of a posting.
+        :return: generator of the postings from the i-th one on.
+        """
+        if i >= self.size:
+            return
+        k = self.batch_of(i)
+        yield from self.read(k)[i - self.starts[k]:]
+        for batch in self.batches(k + 1):
+            yield from batch
+
+    def seek(self, start):
+        """
+        :param start: the lowest DocID to keep.
+        :return: generator of the postings from the first DocID which is not below start.
+        """
+        k = max(0, bisect_right(self.first_ids, start) - 1)
+        for batch in self.batches(k):
+            for posting in batch:
+                if posting[0] >= start:
+                    yield posting
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield from batch
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.size)
+            return list(itertools.islice(self.postings_from(start), 0, max(0, stop - start), step))
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError(i)
+        k = self.batch_of(i)
+        return self.batch(k)[i - self.starts[k]]
+
+    @property
+    def doc_ids(self):
+        """
+        :return: SpilledDocIds, the DocIDs as sequence which is read batch by batch.
+        """
+        return SpilledDocIds(self)
+
+    def close(self):
+        self.file.close()
+
+
+class SpilledDocIds:
+    """
+    The DocIDs of a SpilledPostings as a read-only sequence of integers. Only the DocIDs of the batch
+    that was accessed last are kept in memory, so that reading them in order reads every batch once.
+    Slices are iterators, e.g. for array.extend.
+    """
+    def __init__(self, spilled):
+        self.spilled = spilled
+        # tuple (number of a batch, array of its DocIDs)
+        self.current = (-1, None)
+
+    def __len__(self):
+        return self.spilled.size
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            ids = (posting[0] for posting in self.spilled.postings_from(start))
+            return itertools.islice(ids, 0, max(0, stop - start), step)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        k = self.spilled.batch_of(i)
+        if self.current[0] != k:
+            self.current = (k, array('I', [posting[0] for posting in self.spilled.read(k)]))
+        return self.current[1][i - self.spilled.starts[k]]
+
+    def __iter__(self):
+        return (posting[0] for posting in self.spilled)
+
+
+def needed(inputs, size):
+    """
+    :param inputs: the inputs of an operator.
+    :param size: largest possible number of results of the operator.
+    :return: True if the operator has to merge its inputs as streams and spill its output.
+    >>> needed([[(1, [])], [(2, [])]], 2)
+    False
+    """
+    if max_postings is None:
+        return False
+    return size > max_postings or any(isinstance(postings_list, SpilledPostings) for postings_list in inputs)
+
+
+def collect(postings_stream):
+    """
+    Consumes a stream of postings sorted by DocID, spilling it to a temporary file once it gets too long.
+    :param postings_stream: iterator over (ID, [pos1, pos2,...]).
+    :return: list of the postings, or SpilledPostings if there were more than max_postings.
+    """
+    batch = []
+    spilled = None
+    for posting in postings_stream:
+        batch.append(posting)
+        if max_postings is not None and len(batch) >= max_postings:
+            if spilled is None:
+                spilled = SpilledPostings()
+            spilled.write(batch)
+            batch = []
+    if spilled is None:
+        return batch
+    if batch:
+        spilled.write(batch)
+    return spilled
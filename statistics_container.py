@@ -1,11 +1,171 @@
 """
 This program will contain all the statistics to be displayed on the interface.
+It also keeps a profile of the running query: the wall time of every stage of the pipeline,
+every postings fetch and every operator. Recording is cheap enough to be left on, and queries
+slower than slow_query_seconds are written to the slow query log.
+Optionally every query is written to a query log, one JSON line with the query string, the timestamp,
+the latency and the number of results, so that the traffic can be replayed later, see replay.py.
 """
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+# queries that take longer than this many seconds are written to the slow query log.
+slow_query_seconds = 1.0
+slow_query_log = logging.getLogger('slow_queries')
+
+# open query log file, see log_queries.
+query_log = None
+
+# profile of the query that is currently running, None if no query is running.
+current = None
+# profile of the last finished query.
+last = None
+
+
+def begin(query):
+    """
+    Starts the profile of a new query.
+    :param query: The search string.
+    :return: None.
+    """
+    global current
+    current = {'query': query,
+               'stages': dict(),
+               'counters': dict(),
+               'fetches': dict(),
+               'operators': [],
+               'started': time.perf_counter()}
+
+
+@contextmanager
+def stage(name):
+    """
+    Context manager that adds the wall time of the enclosed block to the given stage.
+    Does nothing if no query is running.
+    :param name: name of the stage, e.g. 'validation'.
+    """
+    if current is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        # the profile might have been finished inside the block
+        if current is not None:
+            current['stages'][name] = current['stages'].get(name, 0.0) + time.perf_counter() - started
+
+
+def count(name, n=1):
+    """
+    Increments a counter of the running query.
+    :param name: name of the counter.
+    :param n: amount to add.
+    :return: None.
+    """
+    if current is not None:
+        current['counters'][name] = current['counters'].get(name, 0) + n
+
+
+def fetch(term, size, hit, elapsed):
+    """
+    Records a single postings fetch of the running query.
+    Fetches are summed up per term, so that the profile stays small even if a term is fetched often.
+    :param term: the term whose postings list was fetched.
+    :param size: number of bytes read, 0 on a cache hit.
+    :param hit: True if the postings list came from the cache.
+    :param elapsed: seconds the fetch took.
+    :return: None.
+    """
+    if current is None:
+        return
+    if term not in current['fetches']:
+        current['fetches'][term] = {'hits': 0, 'misses': 0, 'bytes': 0, 'time': 0.0}
+    term_fetches = current['fetches'][term]
+    term_fetches['hits' if hit else 'misses'] += 1
+    term_fetches['bytes'] += size
+    term_fetches['time'] += elapsed
+    count('cache hits' if hit else 'cache misses')
+    count('bytes read', size)
+
+
+def operator(key, input_sizes, output_size, elapsed):
+    """
+    Records a single operator of the running query.
+    :param key: String representation of the subexpression.
+    :param input_sizes: tuple of the number of results of every input.
+    :param output_size: number of results of the operator.
+    :param elapsed: seconds the operator took.
+    :return: None.
+    """
+    if current is not None:
+        current['operators'].append({'operator': key, 'inputs': input_sizes,
+                                     'output': output_size, 'time': elapsed})
+
+
+def log_queries(file_name):
+    """
+    Starts writing every finished query to a query log, or stops it.
+    :param file_name: name of the log file, new lines are appended. None stops logging.
+    :return: None.
+    """
+    global query_log
+    if query_log is not None:
+        query_log.close()
+    query_log = open(file_name, mode='a', encoding='utf8') if file_name is not None else None
+
+
+def read_query_log(file_name):
+    """
+    Reads the queries of a query log written by log_queries.
+    Lines which are not JSON are taken as plain queries, so a file with one query per line works as well.
+    :param file_name: name of the log file.
+    :return: list of search strings in the order they were logged.
+    """
+    queries = []
+    file = open(file_name, encoding='utf8')
+    for line in file:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('{'):
+            queries.append(json.loads(line)['query'])
+        else:
+            queries.append(line)
+    file.close()
+    return queries
+
+
+def finish(result_count=None):
+    """
+    Finishes the profile of the running query and writes it to the slow query log if necessary.
+    :param result_count: number of documents found.
+    :return: the finished profile, or None if no query was running.
+    """
+    global current, last
+    if current is None:
+        return None
+    profile = current
+    current = None
+    profile['total'] = time.perf_counter() - profile.pop('started')
+    profile['results'] = result_count
+    if profile['total'] >= slow_query_seconds:
+        slow_query_log.warning(json.dumps(profile))
+    if query_log is not None:
+        query_log.write(json.dumps({'query': profile['query'], 'timestamp': time.time(),
+                                    'latency': round(profile['total'], 6), 'results': result_count},
+                                   separators=(',', ':')) + '\n')
+        query_log.flush()
+    last = profile
+    return profile
+
 
 def generate(stats):
     """
     generates a container for the statistical information to be displayed on interface.
-    :param stats: dictionary with relevant information.
-    :return: unknown
+    :param stats: dictionary with relevant information, i.e. the stats of every subexpression.
+    :return: dictionary with the subexpression stats and the profile of the last query.
     """
-    pass
\ No newline at end of file
+    return {'Subexpressions': stats, 'Profile': last}
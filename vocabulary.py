@@ -0,0 +1,215 @@
+"""
+Vocabulary statistics. For every term the file holds
+- the collection frequency: how often the term occurs, as counted by the indexer in counting_index,
+- the document frequency: in how many documents the term occurs,
+- the postings bytes: the size of the postings files of the term on disk.
+The terms are kept sorted in one blob with an offset array, so that every term has a term ID,
+the statistics of a term ID are found by a single array access and all terms with a common prefix
+have consecutive term IDs. A second array holds the term IDs by descending collection frequency for top-k.
+Like the packed index, the file is loaded with a single mmap and the arrays are memoryviews into it.
+"""
+import mmap
+import os
+import struct
+from array import array
+import postings
+
+magic = b'NCATVC01'
+# magic, number of terms, number of documents, size of the term blob
+header_format = '<8sQQQ'
+header_size = struct.calcsize(header_format)
+
+
+def _padding(size):
+    """
+    :param size: size of a buffer in bytes.
+    :return: number of zero bytes needed to align the next buffer to 8 bytes.
+    """
+    return -size % 8
+
+
+def build(ii, counting_index, file_name, documents=0):
+    """
+    Writes the vocabulary statistics of an Inverted Index.
+    :param ii: Inverted Index mapping terms to postings paths.
+    :param counting_index: dictionary {term: collection frequency} written by the indexer.
+    :param file_name: name of the vocabulary file to write.
+    :param documents: number of indexed documents.
+    :return: None.
+    """
+    terms = sorted(term.encode('utf8') for term in ii)
+    term_offsets = array('Q', [0])
+    collection_frequencies = array('Q')
+    document_frequencies = array('Q')
+    postings_bytes = array('Q')
+    blob = bytearray()
+    for encoded in terms:
+        term = encoded.decode('utf8')
+        collection_frequencies.append(counting_index.get(term, 0))
+        document_frequencies.append(postings.document_count(term, ii[term]))
+        postings_bytes.append(postings.postings_size(term, ii[term]))
+        blob += encoded
+        term_offsets.append(len(blob))
+    ranking = array('Q', sorted(range(len(terms)), key=lambda n: -collection_frequencies[n]))
+    file = open(file_name, mode='wb')
+    file.write(struct.pack(header_format, magic, len(terms), documents, len(blob)))
+    for buffer in [term_offsets, collection_frequencies, document_frequencies, postings_bytes, ranking, blob]:
+        data = bytes(buffer)
+        file.write(data)
+        file.write(b'\0' * _padding(len(data)))
+    file.close()
+
+
+class Vocabulary:
+    """
+    Vocabulary statistics served from a file written by build().
+    get() gives the collection frequency like the counting index does, so a Vocabulary can be used
+    wherever the counting index is expected.
+    """
+    def __init__(self, file_name, use_mmap=True):
+        file = open(file_name, mode='rb')
+        if use_mmap:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.buffer = bytearray(os.fstat(file.fileno()).st_size)
+            file.readinto(self.buffer)
+        file.close()
+        view = memoryview(self.buffer)
+        file_magic, n_terms, self.documents, blob_size = struct.unpack_from(header_format, view)
+        if file_magic != magic:
+            raise ValueError("{} is not a vocabulary file".format(file_name))
+        offset = header_size
+        buffers = []
+        for length in [n_terms + 1, n_terms, n_terms, n_terms, n_terms]:
+            size = length * 8
+            buffers.append(view[offset:offset + size].cast('Q'))
+            offset += size + _padding(size)
+        self.term_offsets, self.collection_frequencies, self.document_frequencies, \
+            self.postings_bytes, self.ranking = buffers
+        self.blob = view[offset:offset + blob_size]
+        self.size = n_terms
+
+    def term(self, n):
+        """
+        :param n: term ID.
+        :return: the term.
+        """
+        return bytes(self.blob[self.term_offsets[n]:self.term_offsets[n + 1]]).decode('utf8')
+
+    def lower_bound(self, encoded):
+        """
+        :param encoded: a term as bytes.
+        :return: the first term ID whose term is not smaller than the given one.
+        """
+        low = 0
+        high = self.size
+        while low < high:
+            middle = (low + high) // 2
+            if bytes(self.blob[self.term_offsets[middle]:self.term_offsets[middle + 1]]) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, term):
+        """
+        :param term: the term.
+        :return: term ID, -1 if the term is not in the vocabulary.
+        """
+        n = self.lower_bound(term.encode('utf8'))
+        if n < self.size and self.term(n) == term:
+            return n
+        return -1
+
+    def __contains__(self, term):
+        return self.find(term) != -1
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for n in range(self.size):
+            yield self.term(n)
+
+    def statistics(self, n):
+        """
+        :param n: term ID.
+        :return: tuple (collection frequency, document frequency, postings bytes).
+        """
+        return self.collection_frequencies[n], self.document_frequencies[n], self.postings_bytes[n]
+
+    def get(self, term, default=None):
+        """
+        :param term: the term.
+        :param default: returned if the term is not in the vocabulary.
+        :return: collection frequency of the term.
+        """
+        n = self.find(term)
+        return default if n == -1 else self.collection_frequencies[n]
+
+    def document_frequency(self, term):
+        """
+        :param term: the term.
+        :return: number of documents the term occurs in, 0 if it is not in the vocabulary.
+        """
+        n = self.find(term)
+        return 0 if n == -1 else self.document_frequencies[n]
+
+    def size_of(self, term):
+        """
+        :param term: the term.
+        :return: size of the postings files of the term in bytes, 0 if it is not in the vocabulary.
+        """
+        n = self.find(term)
+        return 0 if n == -1 else self.postings_bytes[n]
+
+    def top(self, k):
+        """
+        :param k: number of terms.
+        :return: list of the k most frequent terms as tuples (term, collection frequency).
+        """
+        return [(self.term(n), self.collection_frequencies[n]) for n in self.ranking[:k]]
+
+    def prefix_range(self, prefix):
+        """
+        :param prefix: beginning of a term.
+        :return: tuple (first term ID, last term ID + 1) of the terms starting with the prefix.
+        """
+        encoded = prefix.encode('utf8')
+        # no UTF-8 encoded term contains the byte 0xff, so every term with the prefix sorts before this
+        return self.lower_bound(encoded), self.lower_bound(encoded + b'\xff')
+
+    def prefix(self, prefix):
+        """
+        :param prefix: beginning of a term.
+        :return: list of all terms starting with the prefix.
+        """
+        start, end = self.prefix_range(prefix)
+        return [self.term(n) for n in range(start, end)]
+
+    def stop_words(self, share=0.5):
+        """
+        :param share: share of the documents a term has to occur in.
+        :return: set of the terms which occur in more than the given share of the documents.
+        """
+        stop_words = set()
+        for n in self.ranking:
+            if self.collection_frequencies[n] <= self.documents * share:
+                # the document frequency is never larger than the collection frequency
+                break
+            if self.document_frequencies[n] > self.documents * share:
+                stop_words.add(self.term(n))
+        return stop_words
+
+
+if __name__ == '__main__':
+    # python vocabulary.py 1Mii.pickle 1Mci.pickle 1M.vocab [number of documents]
+    import pickle
+    import sys
+    pickle_in = open(sys.argv[1], 'rb')
+    inverted_index = pickle.load(pickle_in)
+    pickle_in.close()
+    pickle_in = open(sys.argv[2], 'rb')
+    counting = pickle.load(pickle_in)
+    pickle_in.close()
+    build(inverted_index, counting, sys.argv[3], int(sys.argv[4]) if len(sys.argv) > 4 else 0)
@@ -0,0 +1,167 @@
+"""
+Warm-up of the postings cache. After a start or an index swap every first query of a term pays for
+reading its postings from a cold disk. A Warmer reads the hottest postings lists into postings.cache
+in the background, hottest first, until its time or byte budget is used up.
+How hot a term is comes either from the vocabulary statistics (or the counting index) or from the
+queries of a query log. The operating system is told about the reads ahead with posix_fadvise,
+and a packed index is prefetched with madvise on its mmap.
+"""
+import mmap
+import os
+import threading
+import time
+from collections import Counter
+import lexer
+import postings
+
+
+def terms_by_frequency(frequencies, limit=None):
+    """
+    :param frequencies: Vocabulary or dictionary {term: collection frequency}, e.g. the counting index.
+    :param limit: optional maximal number of terms.
+    :return: list of terms, the most frequent first.
+    >>> terms_by_frequency({'a': 3, 'b': 7, 'c': 5}, 2)
+    ['b', 'c']
+    """
+    if hasattr(frequencies, 'top'):
+        return [term for term, frequency in frequencies.top(limit if limit is not None else len(frequencies))]
+    ordered = sorted(frequencies, key=lambda term: -frequencies[term])
+    return ordered if limit is None else ordered[:limit]
+
+
+def terms_by_queries(queries, limit=None):
+    """
+    :param queries: iterable of search strings, e.g. from a query log.
+    :param limit: optional maximal number of terms.
+    :return: list of the search words of the queries, the most often searched first.
+    >>> terms_by_queries(['w1 AND w2', '"w2 w3" OR w1', 'w2'])
+    ['w2', 'w1', 'w3']
+    """
+    counts = Counter()
+    for query in queries:
+        for kind, value, offset in lexer.tokenize(query):
+            if kind == lexer.WORD:
+                counts[value] += 1
+            elif kind == lexer.PHRASE:
+                counts.update(value[1:-1].split())
+    return [term for term, count in counts.most_common(limit)]
+
+
+def advise(term, path):
+    """
+    Tells the operating system that the postings files of a term will be read soon.
+    :param term: the term.
+    :param path: postings path of the term.
+    :return: None.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for extension in ['ids', 'pos']:
+        try:
+            descriptor = os.open(postings.stream_file(path, term, extension), os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            os.posix_fadvise(descriptor, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(descriptor)
+
+
+def advise_mapping(buffer):
+    """
+    Tells the operating system that a whole mmap will be read soon.
+    :param buffer: mmap or any other buffer, other buffers are ignored.
+    :return: None.
+    """
+    if isinstance(buffer, mmap.mmap) and hasattr(mmap, 'MADV_WILLNEED'):
+        buffer.madvise(mmap.MADV_WILLNEED)
+
+
+class Warmer(threading.Thread):
+    """
+    Background thread reading the postings lists of the given terms into the cache.
+    The progress can be read from the attributes done, total and bytes at any time.
+    """
+    def __init__(self, terms, ii, seconds=None, max_bytes=None, progress=None, report_every=100):
+        """
+        :param terms: list of terms, the hottest first.
+        :param ii: the index to be used.
+        :param seconds: optional time budget.
+        :param max_bytes: optional budget of postings bytes read.
+        :param progress: optional function called with (done, total, bytes) every report_every terms and at the end.
+        :param report_every: number of terms between two calls of progress.
+        """
+        threading.Thread.__init__(self, daemon=True)
+        # the cache drops its least recently used lists first, so more terms than it holds would
+        # end up replacing the hottest lists by the coldest ones
+        self.terms = [term for term in terms if term in ii][:postings.max_cached]
+        self.ii = ii
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.progress = progress
+        self.report_every = report_every
+        self.done = 0
+        self.total = len(self.terms)
+        self.bytes = 0
+        self.stopped = threading.Event()
+
+    def stop(self):
+        """
+        Asks the thread to stop after the current term.
+        :return: None.
+        """
+        self.stopped.set()
+
+    def report(self):
+        """
+        Passes the progress to the progress function.
+        :return: None.
+        """
+        if self.progress is not None:
+            self.progress(self.done, self.total, self.bytes)
+
+    def run(self):
+        started = time.perf_counter()
+        if not isinstance(self.ii, dict):
+            # a packed index is a single mapping, prefetching it is all that can be done
+            advise_mapping(getattr(self.ii, 'buffer', None))
+            self.done = self.total
+            self.report()
+            return
+        # read ahead of the term that is decoded
+        for term in self.terms[:self.report_every]:
+            advise(term, self.ii[term])
+        for n, term in enumerate(self.terms):
+            if self.stopped.is_set():
+                break
+            if self.seconds is not None and time.perf_counter() - started > self.seconds:
+                break
+            size = postings.postings_size(term, self.ii[term])
+            if self.max_bytes is not None and self.bytes + size > self.max_bytes:
+                break
+            if n + self.report_every < self.total:
+                following = self.terms[n + self.report_every]
+                advise(following, self.ii[following])
+            if term not in postings.cache:
+                # read directly, so that the profile of a running query is not touched
+                postings.cache[term] = postings.read_postings(self.ii[term], term)
+                self.bytes += size
+            self.done += 1
+            if self.done % self.report_every == 0:
+                self.report()
+        self.report()
+
+
+def warm(terms, ii, seconds=None, max_bytes=None, progress=None):
+    """
+    Starts warming the cache in the background.
+    :param terms: list of terms, the hottest first, see terms_by_frequency and terms_by_queries.
+    :param ii: the index to be used.
+    :param seconds: optional time budget.
+    :param max_bytes: optional budget of postings bytes read.
+    :param progress: optional function called with (done, total, bytes).
+    :return: the running Warmer, join() waits for it.
+    """
+    warmer = Warmer(terms, ii, seconds, max_bytes, progress)
+    warmer.start()
+    return warmer